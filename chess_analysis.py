@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+# analyse many positions at once across a process pool
+
+import Queue
+import argparse
+import collections
+import itertools
+import multiprocessing
+import sys
+
+import chess_engine
+import chess_game
+import chess_pgn
+
+# positions out in the pool at a time for each worker, one more is sent as
+# each result comes back, so a long input is never read into memory all at
+# once and a slow position holds up no other worker
+WINDOW = 16
+
+# seconds between looks for a job that failed outside analyseone, unordered
+# results come back through callbacks that such a job never calls
+POLL = 1
+
+class Analysis:
+   def __init__(self, index, position):
+      self.index    = index
+      self.position = position
+      self.fen      = None
+      self.best     = None
+      self.san      = None
+      self.score    = 0
+      self.depth    = 0
+      self.nodes    = 0
+      self.error    = None
+
+# a position is a FEN, a list of moves from the standard start or a
+# (FEN, moves) pair, moves are SAN text or packed moves
+def __board(position):
+   if isinstance(position, basestring):
+      return chess_game.ChessBoard.from_fen(position)
+   if isinstance(position, tuple):
+      fen, moves = position
+   else:
+      fen, moves = chess_game.STANDARD_FEN, position
+   board = chess_game.ChessBoard.from_fen(fen)
+   for move in moves:
+      if isinstance(move, basestring):
+         move = chess_game.decodesan(board, move)
+      board.make_move(move)
+   return board
+
+__worker = None
+
+def initworker(mb):
+   global __worker
+   __worker = chess_engine.Engine(table=chess_engine.TranspositionTable(mb))
+
+def analyseone(args):
+   index, position, depth, seconds = args
+   analysis = Analysis(index, position)
+   try:
+      board = __board(position)
+      analysis.fen  = board.to_fen()
+      analysis.best = __worker.search(board, seconds, depth)
+      if analysis.best is not None:
+         analysis.san = chess_game.encodesan(board, analysis.best)
+      analysis.score = __worker.score
+      analysis.depth = __worker.depth
+      analysis.nodes = __worker.nodes
+   except Exception, e:
+      # one bad position should not stop a night's run
+      analysis.error = str(e) or e.__class__.__name__
+   return analysis
+
+# the next unordered result, a job that failed instead is raised here
+def __next(finished, running):
+   while True:
+      try:
+         return finished.get(True, POLL)
+      except Queue.Empty:
+         for result in running.itervalues():
+            if result.ready() and not result.successful():
+               result.get()
+
+# search every position to a depth or for some seconds each, yielding
+# Analysis results in input order or, unordered, as soon as they finish
+def analyse(positions, depth=None, seconds=None, workers=None, ordered=True, mb=chess_engine.TABLE_MB):
+   if depth is None and seconds is None:
+      raise TypeError, 'Analysis needs a depth or a time limit'
+   if workers is None:
+      workers = multiprocessing.cpu_count()
+   pool = multiprocessing.Pool(workers, initworker, (mb,))
+   try:
+      jobs     = ((index, position, depth, seconds) for index, position in enumerate(positions))
+      # jobs out by index, and their order when results go in input order
+      running  = {}
+      order    = collections.deque()
+      finished = Queue.Queue()
+      def send(jobs):
+         for job in jobs:
+            if ordered:
+               running[job[0]] = pool.apply_async(analyseone, (job,))
+               order.append(job[0])
+            else:
+               running[job[0]] = pool.apply_async(analyseone, (job,), callback=finished.put)
+      send(itertools.islice(jobs, workers * WINDOW))
+      while running:
+         if ordered:
+            analysis = running.pop(order.popleft()).get()
+         else:
+            analysis = __next(finished, running)
+            del running[analysis.index]
+         send(itertools.islice(jobs, 1))
+         yield analysis
+      pool.close()
+   finally:
+      # also reached when the caller stops reading early
+      pool.terminate()
+      pool.join()
+
+# the FEN of every position of a game before each move, ready for
+# analyse, played through once.  a move that does not decode ends the game
+# with its position and that move, which analyse reports as an error
+def gamepositions(game):
+   board = game.board()
+   yield board.to_fen()
+   for san in game.sans:
+      fen = board.to_fen()
+      try:
+         board.make_move(chess_game.decodesan(board, san, board.legal_moves()))
+      except TypeError:
+         yield (fen, [san])
+         return
+      board.markCheck()
+      yield board.to_fen()
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description='Analyse every position of PGN files or FEN lists.')
+   parser.add_argument('files', nargs='+', help='.pgn files, any other file has one FEN per line')
+   parser.add_argument('-d', '--depth', type=int, help='search depth')
+   parser.add_argument('-s', '--seconds', type=float, help='time limit per position')
+   parser.add_argument('-w', '--workers', type=int, help='worker processes (default one per core)')
+   parser.add_argument('-m', '--mb', type=int, default=chess_engine.TABLE_MB, help='transposition table megabytes per worker (default %d)' % chess_engine.TABLE_MB)
+   parser.add_argument('-u', '--unordered', action='store_true', help='print results as they finish')
+   args = parser.parse_args(argv)
+   if args.depth is None and args.seconds is None:
+      args.depth = 4
+
+   def positions():
+      for fn in args.files:
+         if fn.lower().endswith('.pgn'):
+            for game in chess_pgn.readpgnfile(fn):
+               for position in gamepositions(game):
+                  yield position
+         else:
+            f = open(fn, 'r')
+            try:
+               for line in f:
+                  if line.strip():
+                     yield line.strip()
+            finally:
+               f.close()
+
+   failures = 0
+   for analysis in analyse(positions(), args.depth, args.seconds, args.workers, not args.unordered, args.mb):
+      if analysis.error is not None:
+         failures += 1
+         print '%d error %s' % (analysis.index, analysis.error)
+      else:
+         print '%d %s %s %d %d' % (analysis.index, analysis.fen, analysis.san or '-', analysis.score, analysis.depth)
+   return failures and 1 or 0
+
+if __name__ == '__main__':
+   sys.exit(main())
@@ -0,0 +1,217 @@
+# bitboard position representation
+#
+# every board is a 64 bit int where bit n is square n using the same layout
+# as ChessBoard.board: n = y * 8 + x with a8 = 0 and h1 = 63
+
+import random
+
+WHITE = 0
+BLACK = 1
+
+PAWN   = 0
+KNIGHT = 1
+BISHOP = 2
+ROOK   = 3
+QUEEN  = 4
+KING   = 5
+
+ALL_SQUARES = (1 << 64) - 1
+
+BIT = [1 << sq for sq in xrange(64)]
+
+def lsb(b):
+   return (b & -b).bit_length() - 1
+
+def msb(b):
+   return b.bit_length() - 1
+
+def popcount(b):
+   return bin(b).count('1')
+
+def squares(b):
+   while b:
+      low = b & -b
+      yield low.bit_length() - 1
+      b ^= low
+
+# attack tables, all built at import time
+
+def __onboard(sq, deltas):
+   x = sq % 8
+   y = sq / 8
+   b = 0
+   for dx, dy in deltas:
+      if 0 <= x + dx < 8 and 0 <= y + dy < 8:
+         b |= BIT[(y + dy) * 8 + x + dx]
+   return b
+
+def __ray(sq, dx, dy):
+   x = sq % 8 + dx
+   y = sq / 8 + dy
+   b = 0
+   while 0 <= x < 8 and 0 <= y < 8:
+      b |= BIT[y * 8 + x]
+      x += dx
+      y += dy
+   return b
+
+KNIGHT_ATTACKS = [__onboard(sq, [(1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)]) for sq in xrange(64)]
+KING_ATTACKS   = [__onboard(sq, [(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)]) for sq in xrange(64)]
+
+# squares attacked by a pawn of each color standing on a square, white moves up (towards y = 0)
+PAWN_ATTACKS = [
+   [__onboard(sq, [(-1, -1), (1, -1)]) for sq in xrange(64)],
+   [__onboard(sq, [(-1, 1), (1, 1)]) for sq in xrange(64)],
+]
+
+# rays grow towards higher squares for the first four directions and
+# towards lower squares for the rest, which decides how to find the blocker
+DIRECTIONS = [(1, 0), (0, 1), (1, 1), (-1, 1), (-1, 0), (0, -1), (-1, -1), (1, -1)]
+RAYS = [[__ray(sq, dx, dy) for sq in xrange(64)] for dx, dy in DIRECTIONS]
+
+EAST, SOUTH, SOUTH_EAST, SOUTH_WEST, WEST, NORTH, NORTH_WEST, NORTH_EAST = RAYS
+
+ROOK_RAYS   = [EAST[sq] | SOUTH[sq] | WEST[sq] | NORTH[sq] for sq in xrange(64)]
+BISHOP_RAYS = [SOUTH_EAST[sq] | SOUTH_WEST[sq] | NORTH_WEST[sq] | NORTH_EAST[sq] for sq in xrange(64)]
+
+# squares strictly between two squares on a common line, 0 otherwise
+def __between(a, b):
+   for ray in RAYS:
+      if ray[a] & BIT[b]:
+         return ray[a] & ~ray[b] & ~BIT[b]
+   return 0
+
+BETWEEN = [[__between(a, b) for b in xrange(64)] for a in xrange(64)]
+
+def rook_attacks(sq, occ):
+   attacks = 0
+   ray = EAST[sq]
+   b = ray & occ
+   if b:
+      ray ^= EAST[(b & -b).bit_length() - 1]
+   attacks |= ray
+   ray = SOUTH[sq]
+   b = ray & occ
+   if b:
+      ray ^= SOUTH[(b & -b).bit_length() - 1]
+   attacks |= ray
+   ray = WEST[sq]
+   b = ray & occ
+   if b:
+      ray ^= WEST[b.bit_length() - 1]
+   attacks |= ray
+   ray = NORTH[sq]
+   b = ray & occ
+   if b:
+      ray ^= NORTH[b.bit_length() - 1]
+   return attacks | ray
+
+def bishop_attacks(sq, occ):
+   attacks = 0
+   ray = SOUTH_EAST[sq]
+   b = ray & occ
+   if b:
+      ray ^= SOUTH_EAST[(b & -b).bit_length() - 1]
+   attacks |= ray
+   ray = SOUTH_WEST[sq]
+   b = ray & occ
+   if b:
+      ray ^= SOUTH_WEST[(b & -b).bit_length() - 1]
+   attacks |= ray
+   ray = NORTH_WEST[sq]
+   b = ray & occ
+   if b:
+      ray ^= NORTH_WEST[b.bit_length() - 1]
+   attacks |= ray
+   ray = NORTH_EAST[sq]
+   b = ray & occ
+   if b:
+      ray ^= NORTH_EAST[b.bit_length() - 1]
+   return attacks | ray
+
+# zobrist keys, from a fixed seed so every process agrees on them
+__random = random.Random(0x5eed)
+
+ZOBRIST_PIECES = [[[__random.getrandbits(64) for sq in xrange(64)] for kind in xrange(6)] for color in xrange(2)]
+ZOBRIST_CASTLE = [__random.getrandbits(64) for rights in xrange(16)]
+ZOBRIST_EP     = [__random.getrandbits(64) for x in xrange(8)]
+ZOBRIST_SIDE   = __random.getrandbits(64)
+
+class Position:
+   def __init__(self):
+      self.clear()
+
+   def clear(self):
+      self.pieces   = [[0] * 6, [0] * 6]
+      self.occupied = [0, 0]
+      self.all      = 0
+      # zobrist key of the piece placement only
+      self.key      = 0
+
+   def add(self, color, kind, sq):
+      bit = BIT[sq]
+      self.pieces[color][kind] |= bit
+      self.occupied[color]     |= bit
+      self.all                 |= bit
+      self.key                 ^= ZOBRIST_PIECES[color][kind][sq]
+
+   def remove(self, color, kind, sq):
+      mask = ~BIT[sq]
+      self.pieces[color][kind] &= mask
+      self.occupied[color]     &= mask
+      self.all                 &= mask
+      self.key                 ^= ZOBRIST_PIECES[color][kind][sq]
+
+   def move(self, color, kind, frm, to):
+      bits = BIT[frm] | BIT[to]
+      self.pieces[color][kind] ^= bits
+      self.occupied[color]     ^= bits
+      self.all                 ^= bits
+      keys = ZOBRIST_PIECES[color][kind]
+      self.key ^= keys[frm] ^ keys[to]
+
+   def king(self, color):
+      return lsb(self.pieces[color][KING])
+
+   # is a square attacked by any piece of color, optionally with a
+   # different set of occupied squares blocking the sliders
+   def attacked(self, sq, color, occupied=None):
+      pieces = self.pieces[color]
+      if KNIGHT_ATTACKS[sq] & pieces[KNIGHT] or \
+         PAWN_ATTACKS[color ^ 1][sq] & pieces[PAWN] or \
+         KING_ATTACKS[sq] & pieces[KING]:
+            return True
+      if occupied is None:
+         occupied = self.all
+      rooks = (pieces[ROOK] | pieces[QUEEN]) & ROOK_RAYS[sq]
+      if rooks and rook_attacks(sq, occupied) & rooks:
+         return True
+      bishops = (pieces[BISHOP] | pieces[QUEEN]) & BISHOP_RAYS[sq]
+      if bishops and bishop_attacks(sq, occupied) & bishops:
+         return True
+      return False
+
+   # pieces of color giving check to the king on sq
+   def checkers(self, sq, color):
+      pieces = self.pieces[color]
+      return (KNIGHT_ATTACKS[sq] & pieces[KNIGHT]) | \
+             (PAWN_ATTACKS[color ^ 1][sq] & pieces[PAWN]) | \
+             (rook_attacks(sq, self.all) & (pieces[ROOK] | pieces[QUEEN])) | \
+             (bishop_attacks(sq, self.all) & (pieces[BISHOP] | pieces[QUEEN]))
+
+   # pieces of color pinned to their king on sq, as a map from the pinned
+   # square to the squares it may still move to
+   def pins(self, sq, color):
+      pins     = {}
+      other    = self.pieces[color ^ 1]
+      snipers  = ROOK_RAYS[sq] & (other[ROOK] | other[QUEEN])
+      snipers |= BISHOP_RAYS[sq] & (other[BISHOP] | other[QUEEN])
+      while snipers:
+         low = snipers & -snipers
+         snipers ^= low
+         sniper  = low.bit_length() - 1
+         between = BETWEEN[sq][sniper]
+         blockers = between & self.all
+         if blockers and not blockers & (blockers - 1) and blockers & self.occupied[color]:
+            pins[blockers.bit_length() - 1] = between | low
+      return pins
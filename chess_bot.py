@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# computer player that joins a game on a chess server and takes a seat
+
+import argparse
+import sys
+
+from twisted.internet import defer, reactor
+
+import chess_engine
+import chess_game
+import chess_server
+
+# thinking time per move in seconds
+SECONDS = 3
+
+class ChessBotGUI(chess_game.ChessGUI):
+   def __init__(self, bot):
+      self.bot = bot
+
+   def add_move(self, move):
+      self.bot.addMove(move)
+
+# stands in for the gui Application as the parent of a client connection,
+# playing on a headless board
+class ChessBot:
+   def __init__(self, name='computer', color=chess_game.BLACK, seconds=SECONDS, workers=None):
+      self.name     = name
+      self.color    = color
+      self.seconds  = seconds
+      self.engine   = chess_engine.ParallelEngine(workers, underpromotions=False)
+      self.board    = chess_game.ChessBoard(ChessBotGUI(self))
+      self.net      = chess_server.ChessNetwork(self)
+      self.users    = []
+      self.thinking = False
+
+      self.lastRemoteMove = None
+      self.board.sitColor = color
+      self.board.start()
+
+   def connect(self, host, port):
+      connected = defer.Deferred()
+      connected.addCallback(self.connected)
+      self.net.connect(host, port, False, connected=connected, binary=True)
+
+   # run the server as well and sit at it
+   def serve(self, port):
+      connected = defer.Deferred()
+      connected.addCallback(self.connected)
+      self.net.serve(port, connected)
+
+   def connected(self, client):
+      self.net.sit(chess_game.COLORS[self.color])
+      self.turn()
+
+   def stop(self):
+      self.board.stop()
+      self.engine.close()
+      return self.net.stop()
+
+   def turn(self):
+      if self.board.running and self.board.color == self.color and not self.thinking:
+         self.thinking = True
+         reactor.callLater(0, self.think)
+
+   # the search runs in the engine's worker processes, the connection keeps
+   # being served meanwhile
+   def think(self):
+      board = self.board
+      if board.running and board.color == self.color:
+         d = self.engine.searchDeferred(board, self.seconds)
+         d.addCallback(self.play, (board.key, len(board.history)))
+         d.addErrback(self.failed)
+      else:
+         self.thinking = False
+
+   def play(self, move, position):
+      self.thinking = False
+      board = self.board
+      if move is not None and board.running and (board.key, len(board.history)) == position:
+         board.playMove(move)
+      else:
+         # a new game may have started while the workers ran
+         self.turn()
+
+   def failed(self, failure):
+      self.thinking = False
+      failure.printTraceback()
+
+   def addMove(self, move):
+      if move[0] != self.lastRemoteMove:
+         self.net.sendMove(move[0])
+
+   def getUser(self):
+      return self.name
+
+   def addUser(self, user):
+      self.users.append(user)
+
+   def removeUser(self, user):
+      if user in self.users:
+         self.users.remove(user)
+
+   def removeUsers(self, users):
+      self.users = [user for user in self.users if user not in users]
+
+   def addChatLine(self, text):
+      pass
+
+   def remoteSit(self, name, color):
+      pass
+
+   def remoteNewGame(self):
+      self.lastRemoteMove = None
+      self.board.standardBoard()
+      self.board.start()
+      self.turn()
+
+   def remotePosition(self, fen, seconds):
+      self.lastRemoteMove = None
+      self.board.load_fen(fen)
+      self.board.start()
+      self.turn()
+
+   def handleMove(self, move):
+      self.lastRemoteMove = move
+      self.board.handleMove(move)
+      self.turn()
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description='Play on a chess server.')
+   parser.add_argument('host', nargs='?', default='localhost', help='server host (default localhost)')
+   parser.add_argument('-p', '--port', type=int, default=chess_server.DEFAULT_PORT, help='server port (default %d)' % chess_server.DEFAULT_PORT)
+   parser.add_argument('-c', '--color', choices=chess_game.COLORS, default='black', help='seat to take (default black)')
+   parser.add_argument('-s', '--seconds', type=float, default=SECONDS, help='thinking time per move (default %d)' % SECONDS)
+   parser.add_argument('-n', '--name', default='computer', help='user name (default computer)')
+   parser.add_argument('-w', '--workers', type=int, help='search processes (default one per core)')
+   parser.add_argument('--serve', action='store_true', help='run the server on the port as well')
+   args = parser.parse_args(argv)
+
+   bot = ChessBot(args.name, chess_game.COLORS.index(args.color), args.seconds, args.workers)
+   if args.serve:
+      bot.serve(args.port)
+   else:
+      bot.connect(args.host, args.port)
+   reactor.run()
+   return 0
+
+if __name__ == '__main__':
+   sys.exit(main())
@@ -0,0 +1,575 @@
+#!/usr/bin/env python
+
+# computer player: negamax alpha-beta search with iterative deepening and
+# quiescence over the ChessBoard move generator
+
+import argparse
+import array
+import multiprocessing
+import sys
+import time
+
+from twisted.internet import threads
+
+import chess_game
+import chess_tablebase
+
+WHITE = chess_game.WHITE
+BLACK = chess_game.BLACK
+
+PAWN   = chess_game.PAWN
+KNIGHT = chess_game.KNIGHT
+BISHOP = chess_game.BISHOP
+ROOK   = chess_game.ROOK
+QUEEN  = chess_game.QUEEN
+KING   = chess_game.KING
+
+INFINITY = 1000000
+MATE     = 100000
+MAX_PLY  = 64
+
+# the benchmark in main must reach this many nodes per second
+NPS_TARGET = 15000
+
+# how many nodes between looks at the clock
+CLOCK_NODES = 1024
+
+# default transposition table size in megabytes
+TABLE_MB = 16
+
+# transposition table bounds
+EXACT = 1
+LOWER = 2
+UPPER = 3
+
+VALUES = [100, 320, 330, 500, 900, 0]
+
+# piece square tables from white's side, laid out like the board with a8 first
+PIECE_SQUARES = [
+   [  0,   0,   0,   0,   0,   0,   0,   0,
+     50,  50,  50,  50,  50,  50,  50,  50,
+     10,  10,  20,  30,  30,  20,  10,  10,
+      5,   5,  10,  25,  25,  10,   5,   5,
+      0,   0,   0,  20,  20,   0,   0,   0,
+      5,  -5, -10,   0,   0, -10,  -5,   5,
+      5,  10,  10, -20, -20,  10,  10,   5,
+      0,   0,   0,   0,   0,   0,   0,   0],
+   [-50, -40, -30, -30, -30, -30, -40, -50,
+    -40, -20,   0,   0,   0,   0, -20, -40,
+    -30,   0,  10,  15,  15,  10,   0, -30,
+    -30,   5,  15,  20,  20,  15,   5, -30,
+    -30,   0,  15,  20,  20,  15,   0, -30,
+    -30,   5,  10,  15,  15,  10,   5, -30,
+    -40, -20,   0,   5,   5,   0, -20, -40,
+    -50, -40, -30, -30, -30, -30, -40, -50],
+   [-20, -10, -10, -10, -10, -10, -10, -20,
+    -10,   0,   0,   0,   0,   0,   0, -10,
+    -10,   0,   5,  10,  10,   5,   0, -10,
+    -10,   5,   5,  10,  10,   5,   5, -10,
+    -10,   0,  10,  10,  10,  10,   0, -10,
+    -10,  10,  10,  10,  10,  10,  10, -10,
+    -10,   5,   0,   0,   0,   0,   5, -10,
+    -20, -10, -10, -10, -10, -10, -10, -20],
+   [  0,   0,   0,   0,   0,   0,   0,   0,
+      5,  10,  10,  10,  10,  10,  10,   5,
+     -5,   0,   0,   0,   0,   0,   0,  -5,
+     -5,   0,   0,   0,   0,   0,   0,  -5,
+     -5,   0,   0,   0,   0,   0,   0,  -5,
+     -5,   0,   0,   0,   0,   0,   0,  -5,
+     -5,   0,   0,   0,   0,   0,   0,  -5,
+      0,   0,   0,   5,   5,   0,   0,   0],
+   [-20, -10, -10,  -5,  -5, -10, -10, -20,
+    -10,   0,   0,   0,   0,   0,   0, -10,
+    -10,   0,   5,   5,   5,   5,   0, -10,
+     -5,   0,   5,   5,   5,   5,   0,  -5,
+      0,   0,   5,   5,   5,   5,   0,  -5,
+    -10,   5,   5,   5,   5,   5,   0, -10,
+    -10,   0,   5,   0,   0,   0,   0, -10,
+    -20, -10, -10,  -5,  -5, -10, -10, -20],
+   [-30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -20, -30, -30, -40, -40, -30, -30, -20,
+    -10, -20, -20, -20, -20, -20, -20, -10,
+     20,  20,   0,   0,   0,   0,  20,  20,
+     20,  30,  10,   0,   0,  10,  30,  20],
+]
+
+# the king comes out once the queens are off
+ENDGAME_KING = [
+   -50, -40, -30, -20, -20, -30, -40, -50,
+   -30, -20, -10,   0,   0, -10, -20, -30,
+   -30, -10,  20,  30,  30,  20, -10, -30,
+   -30, -10,  30,  40,  40,  30, -10, -30,
+   -30, -10,  30,  40,  40,  30, -10, -30,
+   -30, -10,  20,  30,  30,  20, -10, -30,
+   -30, -30,   0,   0,   0,   0, -30, -30,
+   -50, -30, -30, -30, -30, -30, -30, -50,
+]
+
+# value plus square bonus for each color, kind and square, black reads
+# the white tables upside down
+def __tables(squares):
+   return [
+      [[VALUES[kind] + squares[kind][sq] for sq in xrange(64)] for kind in xrange(6)],
+      [[VALUES[kind] + squares[kind][sq ^ 56] for sq in xrange(64)] for kind in xrange(6)],
+   ]
+
+SCORES         = __tables(PIECE_SQUARES)
+ENDGAME_SCORES = __tables(PIECE_SQUARES[:KING] + [ENDGAME_KING])
+
+# static score in centipawns for the side to move
+def evaluate(board):
+   pieces = board.position.pieces
+   if pieces[WHITE][QUEEN] or pieces[BLACK][QUEEN]:
+      scores = SCORES
+   else:
+      scores = ENDGAME_SCORES
+   # the square loops are inlined, this runs at every leaf
+   score = 0
+   for kind in xrange(6):
+      table = scores[WHITE][kind]
+      b = pieces[WHITE][kind]
+      while b:
+         low    = b & -b
+         score += table[low.bit_length() - 1]
+         b     ^= low
+      table = scores[BLACK][kind]
+      b = pieces[BLACK][kind]
+      while b:
+         low    = b & -b
+         score -= table[low.bit_length() - 1]
+         b     ^= low
+   if board.color == BLACK:
+      return -score
+   return score
+
+class SearchTimeout(Exception):
+   pass
+
+# transposition table of a fixed size set in megabytes, in flat arrays of
+# 32 bit words so memory never grows with use: the check word is the top
+# half of the key, the info word packs move, depth, bound and age, and the
+# score sits in its own signed word.  each bucket has a depth preferred slot
+# and an always replace slot
+class TranspositionTable:
+   ENTRY_BYTES = 12
+
+   def __init__(self, mb=TABLE_MB):
+      buckets = 1
+      while buckets * 4 * self.ENTRY_BYTES <= mb * (1 << 20):
+         buckets *= 2
+      self.mask   = buckets - 1
+      self.size   = buckets * 2
+      self.checks = array.array('I', [0]) * self.size
+      self.infos  = array.array('I', [0]) * self.size
+      self.scores = array.array('i', [0]) * self.size
+      self.age    = 0
+
+   def clear(self):
+      self.infos = array.array('I', [0]) * self.size
+      self.age   = 0
+
+   # entries from earlier searches give way in the depth preferred slot
+   def newSearch(self):
+      self.age = (self.age + 1) & 255
+
+   # (depth, bound, score, move) for a key or None
+   def probe(self, key):
+      i     = (key & self.mask) << 1
+      check = key >> 32
+      infos = self.infos
+      if self.checks[i] == check and infos[i]:
+         info = infos[i]
+      elif self.checks[i + 1] == check and infos[i + 1]:
+         i   += 1
+         info = infos[i]
+      else:
+         return None
+      return (info >> 15) & 127, (info >> 22) & 3, self.scores[i], info & 32767
+
+   def store(self, key, depth, bound, score, move):
+      depth = min(depth, 127)
+      i     = (key & self.mask) << 1
+      check = key >> 32
+      info  = self.infos[i]
+      if self.checks[i] != check and info and info >> 24 == self.age and (info >> 15) & 127 > depth:
+         i += 1
+      self.checks[i] = check
+      self.infos[i]  = move | depth << 15 | bound << 22 | self.age << 24
+      self.scores[i] = score
+
+class Engine:
+   def __init__(self, maxdepth=MAX_PLY, underpromotions=True, table=None, tablebase=None):
+      self.maxdepth = maxdepth
+      # the network protocol only carries queen promotions
+      self.underpromotions = underpromotions
+      # engines may share a table to cap memory across many searches
+      if table is None:
+         table = TranspositionTable()
+      self.table    = table
+      # a chess_tablebase.Tablebase for exact endgame scores
+      self.tablebase = tablebase
+      self.best     = None
+      self.score    = 0
+      self.depth    = 0
+      self.nodes    = 0
+      self.elapsed  = 0
+      self.deadline = None
+
+   def nps(self):
+      return int(self.nodes / max(self.elapsed, 1e-6))
+
+   # best move for the side to move as a packed move, or None without any
+   # legal move, searching deeper until depth or the time runs out, moves
+   # limits the search to some of the root moves.  only a position with a
+   # single legal move stops after the first iteration, not a single root
+   # move handed in
+   def search(self, board, seconds=None, depth=None, moves=None):
+      start = time.time()
+      if seconds is not None:
+         self.deadline = start + seconds
+      else:
+         self.deadline = None
+      if depth is None:
+         depth = self.maxdepth
+      self.best    = None
+      self.score   = 0
+      self.depth   = 0
+      self.nodes   = 0
+      self.killers = [[0, 0] for ply in xrange(MAX_PLY + 1)]
+      self.history = [0] * 4096
+      self.table.newSearch()
+
+      forced = moves is None
+      if moves is None:
+         moves = board.legal_moves()
+      else:
+         moves = list(moves)
+      if not self.underpromotions:
+         moves = [move for move in moves if move >> 12 in (0, QUEEN)]
+      forced = forced and len(moves) == 1
+      if not moves:
+         self.elapsed = time.time() - start
+         return None
+      self.best = moves[0]
+      length    = len(board.history)
+      try:
+         for d in xrange(1, depth + 1):
+            self.score = self.__root(board, d, moves)
+            self.depth = d
+            moves.remove(self.best)
+            moves.insert(0, self.best)
+            if forced or abs(self.score) >= MATE - MAX_PLY:
+               break
+      except SearchTimeout:
+         # unwind whatever the search had on the board
+         while len(board.history) > length:
+            board.unmake_move()
+      self.elapsed = time.time() - start
+      return self.best
+
+   # the previous best move goes first, so any move that beats it at the
+   # new depth is safe to keep even if the iteration is cut short
+   def __root(self, board, depth, moves):
+      alpha = -INFINITY
+      for move in moves:
+         board.make_move(move)
+         score = -self.__search(board, depth - 1, -INFINITY, -alpha, 1)
+         board.unmake_move()
+         if score > alpha:
+            alpha     = score
+            self.best = move
+      return alpha
+
+   # the deadline holds from the first iteration on, cut short there the
+   # best move is still the first root move or one that beat it
+   def __clock(self):
+      self.nodes += 1
+      if not self.nodes % CLOCK_NODES and self.deadline is not None and time.time() > self.deadline:
+         raise SearchTimeout
+
+   # draw by repetition since the last capture or pawn move
+   def __repeated(self, board):
+      key     = board.key
+      history = board.history
+      i       = len(history) - 2
+      stop    = max(len(history) - board.halfmove, 0)
+      while i >= stop:
+         if history[i][7] == key:
+            return True
+         i -= 2
+      return False
+
+   def __search(self, board, depth, alpha, beta, ply):
+      if board.halfmove >= 100 or self.__repeated(board):
+         return 0
+      if self.tablebase is not None:
+         value = self.tablebase.probe(board)
+         if value is not None:
+            self.nodes += 1
+            if value > 0:
+               return MATE - ply - value
+            elif value < 0:
+               return -MATE + ply - value - 1
+            return 0
+      check = board.inCheck(board.color)
+      if check:
+         depth += 1
+      if depth <= 0 or ply >= MAX_PLY:
+         return self.__quiesce(board, alpha, beta, ply)
+      self.__clock()
+
+      key   = board.key
+      first = 0
+      entry = self.table.probe(key)
+      if entry is not None:
+         edepth, bound, score, first = entry
+         if edepth >= depth:
+            # mate scores are stored from this node, not the root
+            if score > MATE - MAX_PLY:
+               score -= ply
+            elif score < MAX_PLY - MATE:
+               score += ply
+            if bound == EXACT or \
+               bound == LOWER and score >= beta or \
+               bound == UPPER and score <= alpha:
+                  return score
+
+      moves = board.legal_moves()
+      if not moves:
+         if check:
+            return -MATE + ply
+         return 0
+
+      start    = alpha
+      best     = -INFINITY
+      bestmove = 0
+      killers  = self.killers[ply]
+      for move in self.__order(board, moves, killers, first):
+         board.make_move(move)
+         score = -self.__search(board, depth - 1, -beta, -alpha, ply + 1)
+         board.unmake_move()
+         if score > best:
+            best     = score
+            bestmove = move
+            if score > alpha:
+               alpha = score
+               if alpha >= beta:
+                  if self.__quiet(board, move) and move != killers[0]:
+                     killers[1] = killers[0]
+                     killers[0] = move
+                     self.history[move & 4095] += depth * depth
+                  break
+
+      if best >= beta:
+         bound = LOWER
+      elif best > start:
+         bound = EXACT
+      else:
+         bound = UPPER
+      score = best
+      if score > MATE - MAX_PLY:
+         score += ply
+      elif score < MAX_PLY - MATE:
+         score -= ply
+      self.table.store(key, depth, bound, score, bestmove)
+      return best
+
+   # captures and promotions only until the position is quiet, all the
+   # evasions when in check
+   def __quiesce(self, board, alpha, beta, ply):
+      self.__clock()
+      if ply >= MAX_PLY:
+         return evaluate(board)
+      if board.inCheck(board.color):
+         moves = board.legal_moves()
+         if not moves:
+            return -MATE + ply
+         best = -INFINITY
+      else:
+         best = evaluate(board)
+         if best >= beta:
+            return best
+         if best > alpha:
+            alpha = best
+         moves = board.legal_moves(captures=True)
+      for move in self.__order(board, moves, None):
+         board.make_move(move)
+         score = -self.__quiesce(board, -beta, -alpha, ply + 1)
+         board.unmake_move()
+         if score > best:
+            best = score
+            if score > alpha:
+               alpha = score
+               if alpha >= beta:
+                  break
+      return best
+
+   def __quiet(self, board, move):
+      to = (move >> 6) & 63
+      if move >> 12 or board.board[to] is not None:
+         return False
+      return not (to == board.epSquare and board.board[move & 63].kind == PAWN)
+
+   # the table move, then captures by most valuable victim then least
+   # valuable attacker, then promotions, killer moves and the rest by history
+   def __order(self, board, moves, killers, first=0):
+      squares = board.board
+      history = self.history
+      scored  = []
+      for move in moves:
+         victim = squares[(move >> 6) & 63]
+         if move == first:
+            score = 1 << 25
+         elif victim is not None:
+            score = 1 << 24 | VALUES[victim.kind] << 8 | 255 - VALUES[squares[move & 63].kind] / 4
+         elif move >> 12:
+            score = 1 << 23 | VALUES[move >> 12]
+         elif killers is not None and move in killers:
+            score = 1 << 22
+         else:
+            score = history[move & 4095]
+         scored.append((score, move))
+      scored.sort(reverse=True)
+      return [move for score, move in scored]
+
+# parallel search splits the root moves across a process pool, each
+# worker keeps one engine and its table for the life of the process
+__worker = None
+
+def initworker(mb, underpromotions, tablebases=None):
+   global __worker
+   tablebase = None
+   if tablebases is not None:
+      tablebase = chess_tablebase.Tablebase(tablebases)
+   __worker = Engine(underpromotions=underpromotions, table=TranspositionTable(mb), tablebase=tablebase)
+
+# search part of the root moves in a worker, the board is rebuilt from the
+# start position and the moves played so repetitions are still seen.  the
+# replay cannot tell which kings have been in check, those lose castling
+# the same as on the caller's board
+def searchroots(args):
+   fen, played, checked, roots, seconds, depth = args
+   board = chess_game.ChessBoard.from_fen(fen)
+   for move in played:
+      board.make_move(move)
+   for color in checked:
+      board.king(color).hasBeenInCheck = True
+   board.rehash()
+   move = __worker.search(board, seconds, depth, roots)
+   return move, __worker.score, __worker.depth, __worker.nodes
+
+class ParallelEngine:
+   def __init__(self, workers=None, mb=TABLE_MB, underpromotions=True, tablebases=None):
+      if workers is None:
+         workers = multiprocessing.cpu_count()
+      self.workers  = workers
+      self.underpromotions = underpromotions
+      # each worker maps the tablebase files in this directory
+      self.pool     = multiprocessing.Pool(workers, initworker, (mb, underpromotions, tablebases))
+      self.best     = None
+      self.score    = 0
+      self.depth    = 0
+      self.nodes    = 0
+      self.elapsed  = 0
+
+   def nps(self):
+      return int(self.nodes / max(self.elapsed, 1e-6))
+
+   def close(self):
+      self.pool.close()
+      self.pool.join()
+
+   # root moves dealt out in turn so each worker gets a share of the good
+   # ones, a forced move goes to one worker as the whole position so it
+   # knows not to search on
+   def __jobs(self, board, seconds, depth):
+      moves = board.legal_moves()
+      if not self.underpromotions:
+         moves = [move for move in moves if move >> 12 in (0, QUEEN)]
+      played  = [undo[0] for undo in board.history]
+      checked = [color for color in (WHITE, BLACK) if board.king(color).hasBeenInCheck]
+      if len(moves) == 1:
+         return [(board.startFen, played, checked, None, seconds, depth)]
+      workers = min(self.workers, len(moves))
+      groups  = [moves[i::workers] for i in xrange(workers)]
+      return [(board.startFen, played, checked, group, seconds, depth) for group in groups]
+
+   # the best score over the workers, the deeper search wins a tie
+   def __finish(self, results, start):
+      self.best  = None
+      self.score = -INFINITY
+      self.depth = 0
+      self.nodes = 0
+      for move, score, depth, nodes in results:
+         self.nodes += nodes
+         if move is not None and (score, depth) > (self.score, self.depth):
+            self.best  = move
+            self.score = score
+            self.depth = depth
+      self.elapsed = time.time() - start
+      return self.best
+
+   # blocks until the workers are done
+   def search(self, board, seconds=None, depth=None):
+      start = time.time()
+      return self.__finish(self.pool.map(searchroots, self.__jobs(board, seconds, depth)), start)
+
+   # a Deferred firing with the best move, the reactor keeps running while
+   # a thread waits on the workers
+   def searchDeferred(self, board, seconds=None, depth=None):
+      start = time.time()
+      d = threads.deferToThread(self.pool.map, searchroots, self.__jobs(board, seconds, depth))
+      d.addCallback(self.__finish, start)
+      return d
+
+def main(argv=None):
+   # avoid a circular import, perft has the standard test positions
+   import chess_perft
+   parser = argparse.ArgumentParser(description='Time the search over the standard test positions.')
+   parser.add_argument('positions', nargs='*', help='positions to run (default all): ' + ', '.join(p[0] for p in chess_perft.POSITIONS))
+   parser.add_argument('-d', '--depth', type=int, default=4, help='search depth (default 4)')
+   parser.add_argument('-s', '--seconds', type=float, help='time limit per position instead of a depth')
+   parser.add_argument('-f', '--fen', help='search this position instead')
+   parser.add_argument('-m', '--mb', type=int, default=TABLE_MB, help='transposition table megabytes (default %d)' % TABLE_MB)
+   parser.add_argument('-w', '--workers', type=int, help='split the root moves across this many processes')
+   parser.add_argument('-t', '--tablebases', help='directory of endgame tablebase files to probe')
+   args = parser.parse_args(argv)
+
+   if args.fen:
+      positions = [('fen', args.fen, [])]
+   else:
+      positions = [p for p in chess_perft.POSITIONS if not args.positions or p[0] in args.positions]
+   if args.seconds:
+      depth = None
+   else:
+      depth = args.depth
+
+   if args.workers:
+      engine = ParallelEngine(args.workers, args.mb, tablebases=args.tablebases)
+   else:
+      tablebase = None
+      if args.tablebases:
+         tablebase = chess_tablebase.Tablebase(args.tablebases)
+      engine = Engine(table=TranspositionTable(args.mb), tablebase=tablebase)
+   nodes  = 0
+   total  = 0
+   for name, fen, expected in positions:
+      board = chess_game.ChessBoard.from_fen(fen)
+      move  = engine.search(board, args.seconds, depth)
+      nodes += engine.nodes
+      total += engine.elapsed
+      print '%-10s depth %2d %6s %6d cp %10d nodes %8.2fs %8d nps' % (name, engine.depth, chess_game.movename(move),
+         engine.score, engine.nodes, engine.elapsed, engine.nps())
+
+   if args.workers:
+      engine.close()
+
+   nps = int(nodes / max(total, 1e-6))
+   print 'total %d nodes %.2fs %d nps, target %d nps' % (nodes, total, nps, NPS_TARGET)
+   return nps < NPS_TARGET and 1 or 0
+
+if __name__ == '__main__':
+   sys.exit(main())
@@ -1,6 +1,9 @@
 import time
 import traceback
 
+import chess_bitboard
+import chess_pgn
+
 WHITE  = 0
 BLACK  = 1
 COLORS = ['white', 'black']
@@ -11,11 +14,59 @@ STATE_MATE  = 2
 STATE_STALE = 3
 STATE_TIME  = 4
 
-# any common gui routines
+PAWN   = chess_bitboard.PAWN
+KNIGHT = chess_bitboard.KNIGHT
+BISHOP = chess_bitboard.BISHOP
+ROOK   = chess_bitboard.ROOK
+QUEEN  = chess_bitboard.QUEEN
+KING   = chess_bitboard.KING
+
+# board coordinates of each square
+COORDS = [(sq % 8, sq / 8) for sq in xrange(64)]
+
+# castling rights bits, with the king and rook home squares for each
+CASTLE_WHITE_KING  = 1
+CASTLE_WHITE_QUEEN = 2
+CASTLE_BLACK_KING  = 4
+CASTLE_BLACK_QUEEN = 8
+
+CASTLES = [
+   (CASTLE_WHITE_KING , WHITE, 60, 63),
+   (CASTLE_WHITE_QUEEN, WHITE, 60, 56),
+   (CASTLE_BLACK_KING , BLACK, 4 , 7 ),
+   (CASTLE_BLACK_QUEEN, BLACK, 4 , 0 ),
+]
+
+# default piece dimensions when there are no sprites to measure
+PIECE_SIZE = 50
+
+# any common gui routines, the base class doubles as a headless ui that
+# creates no sprites and ignores all display updates
 class ChessGUI:
    def __init__(self):
       pass
 
+   def make_sprite(self, model, name, coords):
+      return None
+
+   def timer(self, func):
+      pass
+
+   def set_clock(self, seconds):
+      pass
+
+   def set_turn(self, color):
+      pass
+
+   def add_move(self, move):
+      pass
+
+   def in_check(self, color):
+      pass
+
+   def finish(self, state):
+      pass
+
 def movelabels(piece, capture, check, oldpos, newpos):
    # simple format for clients
    simple = chr(ord('A') + oldpos[0]) + \
@@ -23,10 +74,7 @@ def movelabels(piece, capture, check, oldpos, newpos):
             chr(ord('A') + newpos[0]) + \
             chr(ord('8') - newpos[1])
 
-   # SAN
-   # TODO:
-   # pawn promotion: =<NEW PIECE>
-   # two moves per line (white followed by black)
+   # long algebraic, SAN comes from encodesan
    if piece.abbreviation == 'K' and abs(oldpos[0] - newpos[0]) == 2:
       if oldpos[0] < newpos[0]:
          label = 'O-O'
@@ -48,13 +96,146 @@ def decodemove(move):
    dy = ord('8') - ord(move[3])
    return sx, sy, dx, dy
 
+# engine moves are packed ints: source square, destination square and the
+# promotion piece kind (0 for none, a pawn is never a promotion target)
+def packmove(frm, to, promotion=0):
+   return frm | (to << 6) | (promotion << 12)
+
+def unpackmove(move):
+   return move & 63, (move >> 6) & 63, move >> 12
+
+def squarename(sq):
+   return chr(ord('a') + sq % 8) + chr(ord('8') - sq / 8)
+
+# coordinate text for a packed move, e.g. e2e4 or e7e8q
+def movename(move):
+   frm, to, promotion = unpackmove(move)
+   name = squarename(frm) + squarename(to)
+   if promotion:
+      name += 'pnbrqk'[promotion]
+   return name
+
+# standard algebraic notation for a packed move, other candidates for the
+# destination come from the legal move list so nothing is simulated
+# except the move itself when a check or mate suffix is wanted
+def encodesan(board, move, moves=None, suffix=True):
+   frm, to, promotion = unpackmove(move)
+   piece = board.board[frm]
+   kind  = piece.kind
+   if kind == KING and (to - frm == 2 or frm - to == 2):
+      if to > frm:
+         san = 'O-O'
+      else:
+         san = 'O-O-O'
+   elif kind == PAWN:
+      if frm % 8 != to % 8:
+         san = squarename(frm)[0] + 'x' + squarename(to)
+      else:
+         san = squarename(to)
+      if promotion:
+         san += '=' + 'PNBRQK'[promotion]
+   else:
+      if moves is None:
+         moves = board.legal_moves()
+      ambiguous = sameFile = sameRank = False
+      for other in moves:
+         ofrm = other & 63
+         if ofrm != frm and (other >> 6) & 63 == to and board.board[ofrm].kind == kind:
+            ambiguous = True
+            if ofrm % 8 == frm % 8:
+               sameFile = True
+            if ofrm / 8 == frm / 8:
+               sameRank = True
+      san = piece.abbreviation
+      if ambiguous:
+         if not sameFile:
+            san += squarename(frm)[0]
+         elif not sameRank:
+            san += squarename(frm)[1]
+         else:
+            san += squarename(frm)
+      if board.board[to] is not None:
+         san += 'x'
+      san += squarename(to)
+   if suffix:
+      board.make_move(move)
+      if board.inCheck(board.color):
+         if board.legal_moves():
+            san += '+'
+         else:
+            san += '#'
+      board.unmake_move()
+   return san
+
+# packed move for standard algebraic notation, matched against the legal move list
+def decodesan(board, text, moves=None):
+   if moves is None:
+      moves = board.legal_moves()
+   san = text.rstrip('+#!?')
+   if san in ('O-O', 'O-O-O', '0-0', '0-0-0'):
+      ksq = board.position.king(board.color)
+      if len(san) == 3:
+         move = packmove(ksq, ksq + 2)
+      else:
+         move = packmove(ksq, ksq - 2)
+      if move in moves and board.board[ksq].kind == KING:
+         return move
+      raise TypeError, 'Invalid move: ' + text
+
+   promotion = 0
+   if len(san) > 2 and san[-1] in 'NBRQ':
+      promotion = 'PNBRQK'.index(san[-1])
+      san = san[:-1].rstrip('=')
+   kind = PAWN
+   if san and san[0] in 'NBRQK':
+      kind = 'PNBRQK'.index(san[0])
+      san  = san[1:]
+   san = san.replace('x', '').replace('-', '')
+   if len(san) < 2 or not 'a' <= san[-2] <= 'h' or not '1' <= san[-1] <= '8':
+      raise TypeError, 'Invalid move: ' + text
+   to = (ord('8') - ord(san[-1])) * 8 + ord(san[-2]) - ord('a')
+   fromFile = fromRank = None
+   for c in san[:-2]:
+      if 'a' <= c <= 'h':
+         fromFile = ord(c) - ord('a')
+      elif '1' <= c <= '8':
+         fromRank = ord('8') - ord(c)
+      else:
+         raise TypeError, 'Invalid move: ' + text
+
+   found = None
+   for move in moves:
+      if (move >> 6) & 63 != to or move >> 12 != promotion:
+         continue
+      frm = move & 63
+      if board.board[frm].kind != kind or \
+         (fromFile is not None and frm % 8 != fromFile) or \
+         (fromRank is not None and frm / 8 != fromRank):
+            continue
+      if found is not None:
+         raise TypeError, 'Ambiguous move: ' + text
+      found = move
+   if found is None:
+      raise TypeError, 'Invalid move: ' + text
+   return found
+
 class Piece:
-   def __init__(self, board, color, coords, piece, abbreviation):
+   # only pawns, rooks and kings track their first move
+   firstMove = False
+
+   def __init__(self, board, color, coords, piece, abbreviation, sprite=True):
       self.board        = board
       self.color        = color
       self.coords       = coords
       self.abbreviation = abbreviation
-      self.sprite       = board.ui.make_sprite(self, piece + '_' + COLORS[color], coords)
+      self.name         = piece + '_' + COLORS[color]
+      self.sprite       = None
+      if sprite:
+         self.show()
+
+   def show(self):
+      if self.sprite is None:
+         self.sprite = self.board.ui.make_sprite(self, self.name, self.coords)
 
    def canMove(self):
       return self.board.running and \
@@ -62,31 +243,18 @@ class Piece:
              self.color == self.board.color
 
    def remove(self):
-      self.sprite.remove()
-
-   def update(self, x, y):
-      pass
+      if self.sprite is not None:
+         self.sprite.remove()
+         self.sprite = None
 
    def checkMove(self, x, y):
       return (x != self.coords[0] or y != self.coords[1]) and self.isValidMove(x, y) and not self.inCheck(x, y)
 
    def inCheck(self, x, y):
-      oldpos = self.board.pos(self.coords[0], self.coords[1])
-      newpos = self.board.pos(x, y)
-
-      oldcoords = self.coords
-      oldpiece  = self.board.board[newpos]
-
-      self.board.board[oldpos] = None
-      self.board.board[newpos] = self
-      self.coords = [x, y]
-
-      in_check = self.board.inCheck(self.color)
-
-      self.board.board[oldpos] = self
-      self.board.board[newpos] = oldpiece
-      self.coords = oldcoords
-
+      board = self.board
+      board.make_move(packmove(board.pos(self.coords[0], self.coords[1]), board.pos(x, y)))
+      in_check = board.inCheck(self.color)
+      board.unmake_move()
       return in_check
 
    def isValidMove(self, x, y):
@@ -101,6 +269,11 @@ class Piece:
             return True
       return False
 
+   # every square checkMove would allow, from one run of the move generator
+   def getLegalMoves(self):
+      frm = self.board.pos(self.coords[0], self.coords[1])
+      return set(COORDS[move >> 6 & 63] for move in self.board.legal_moves(self.color) if move & 63 == frm)
+
    def addMove(self, x, y, moves):
       if x >= 0 and x < self.board.width and y >= 0 and y < self.board.height:
          pos = self.board[(x, y)]
@@ -121,34 +294,18 @@ class Piece:
          x += xDelta
          y += yDelta
 
-   def makeMove(self, newpos, local=False):
-      self.board.makeMove(self, self.coords, newpos, local=local)
-      self.coords = newpos
+   def move(self, x, y):
+      self.board.makeMove(self, self.coords, (x, y))
 
 class Pawn(Piece):
-   def __init__(self, board, color, coords):
-      Piece.__init__(self, board, color, coords, 'pawn', '')
+   kind = chess_bitboard.PAWN
+
+   def __init__(self, board, color, coords, sprite=True):
+      Piece.__init__(self, board, color, coords, 'pawn', '', sprite)
 
       self.firstMove = True
       self.enPassant = False
 
-   def update(self, x, y):
-      deltax = abs(x - self.coords[0])
-      deltay = abs(y - self.coords[1])
-
-      if deltax == 1 and self.board[(x, y)] is None and self.board[(x, self.coords[1])] is not None:
-         self.board.remove(x, self.coords[1])
-
-      if self.firstMove and deltay == 2:
-         self.enPassant = True
-      else:
-         self.enPassant = False
-
-      self.firstMove = False
-
-      if y == 0 or y == 7:
-         self.board.promote(x, y)
-
    def isValidMove(self, x, y):
       deltax = abs(x - self.coords[0])
       deltay = y - self.coords[1]
@@ -204,13 +361,12 @@ class Pawn(Piece):
       return moves
 
 class Rook(Piece):
-   def __init__(self, board, color, coords):
-      Piece.__init__(self, board, color, coords, 'rook', 'R')
+   kind = chess_bitboard.ROOK
 
-      self.firstMove = True
+   def __init__(self, board, color, coords, sprite=True):
+      Piece.__init__(self, board, color, coords, 'rook', 'R', sprite)
 
-   def update(self, x, y):
-      self.firstMove = False
+      self.firstMove = True
 
    def isValidMove(self, x, y):
       if x == self.coords[0] or y == self.coords[1]:
@@ -245,8 +401,10 @@ class Rook(Piece):
       return moves;
 
 class Knight(Piece):
-   def __init__(self, board, color, coords):
-      Piece.__init__(self, board, color, coords, 'knight', 'N')
+   kind = chess_bitboard.KNIGHT
+
+   def __init__(self, board, color, coords, sprite=True):
+      Piece.__init__(self, board, color, coords, 'knight', 'N', sprite)
 
    def isValidMove(self, x, y):
       deltax = abs(x - self.coords[0])
@@ -272,8 +430,10 @@ class Knight(Piece):
       return moves
 
 class Bishop(Piece):
-   def __init__(self, board, color, coords):
-      Piece.__init__(self, board, color, coords, 'bishop', 'B')
+   kind = chess_bitboard.BISHOP
+
+   def __init__(self, board, color, coords, sprite=True):
+      Piece.__init__(self, board, color, coords, 'bishop', 'B', sprite)
 
    def isValidMove(self, x, y):
       deltax = x - self.coords[0]
@@ -310,8 +470,10 @@ class Bishop(Piece):
       return moves
 
 class Queen(Bishop, Rook):
-   def __init__(self, board, color, coords):
-      Piece.__init__(self, board, color, coords, 'queen', 'Q')
+   kind = chess_bitboard.QUEEN
+
+   def __init__(self, board, color, coords, sprite=True):
+      Piece.__init__(self, board, color, coords, 'queen', 'Q', sprite)
 
    def isValidMove(self, x, y):
       return Bishop.isValidMove(self, x, y) or Rook.isValidMove(self, x, y)
@@ -320,27 +482,14 @@ class Queen(Bishop, Rook):
       return Bishop.getPossibleMoves(self) + Rook.getPossibleMoves(self)
 
 class King(Piece):
-   def __init__(self, board, color, coords):
-      Piece.__init__(self, board, color, coords, 'king', 'K')
+   kind = chess_bitboard.KING
+
+   def __init__(self, board, color, coords, sprite=True):
+      Piece.__init__(self, board, color, coords, 'king', 'K', sprite)
 
       self.hasBeenInCheck = False
       self.firstMove = True
 
-   def update(self, x, y):
-      deltax = x - self.coords[0]
-      if abs(deltax) == 2 and self.firstMove:
-         if deltax < 0:
-            endx = 0
-         else:
-            endx = self.board.width - 1
-         pos = self.board[(endx, y)]
-         if pos is not None and pos.abbreviation == 'R':
-            if deltax < 0:
-               pos.sprite.move(x + 1, y, local=True)
-            else:
-               pos.sprite.move(x - 1, y, local=True)
-      self.firstMove = False
-
    def isValidMove(self, x, y):
       deltax = abs(x - self.coords[0])
       deltay = abs(y - self.coords[1])
@@ -366,14 +515,16 @@ class King(Piece):
                if self.board[(dx, self.coords[1])] is not None:
                   isValid = False
                   break
-            if isValid and not self.inCheck(self.coords[0] + step, self.coords[1]):
-               return True
+            other = (self.color + 1) % 2
+            if isValid and not self.board.attacked(self.coords[0], y, other) and \
+               not self.board.attacked(self.coords[0] + step, y, other):
+                  return True
       return False
 
    def __checkCastle(self, x, y, endx, step, moves):
       rook = self.board[(endx, y)]
-      if root is not None and root.abbreviation == 'R' and rook.firstMove:
-         for dx in xrange(x, endx, step):
+      if rook is not None and rook.abbreviation == 'R' and rook.firstMove:
+         for dx in xrange(x + step, endx, step):
             pos = self.board[(dx, y)]
             if pos is not None:
                return False
@@ -398,8 +549,28 @@ class King(Piece):
          self.__checkCastle(x, y, self.board.width - 1, 1, moves)
       return moves
 
+PROMOTIONS = {
+   KNIGHT : Knight,
+   BISHOP : Bishop,
+   ROOK   : Rook,
+   QUEEN  : Queen,
+}
+
+PIECES = [Pawn, Knight, Bishop, Rook, Queen, King]
+
+# fen piece letters
+FEN_PIECES = {}
+for _kind, _letter in enumerate('pnbrqk'):
+   FEN_PIECES[_letter]         = (_kind, BLACK)
+   FEN_PIECES[_letter.upper()] = (_kind, WHITE)
+FEN_LETTERS = ['PNBRQK', 'pnbrqk']
+
+STANDARD_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
 class ChessBoard:
-   def __init__(self, ui):
+   def __init__(self, ui=None, fen=None):
+      if ui is None:
+         ui = ChessGUI()
       self.ui         = ui
       self.color      = WHITE
       self.sitColor   = None
@@ -408,14 +579,30 @@ class ChessBoard:
       self.width      = 8
       self.height     = 8
       self.board      = [None] * (self.width * self.height)
+      self.position   = chess_bitboard.Position()
+      self.epSquare   = None
+      self.halfmove   = 0
+      self.fullmove   = 1
+      self.history    = []
+      self.key        = 0
+      self.state      = STATE_NONE
+      self.startFen   = STANDARD_FEN
       self.running    = False
       self.timer      = None
       self.startTime  = 0
 
-      self.standardBoard()
+      if fen is None:
+         self.standardBoard()
+      else:
+         self.load_fen(fen)
 
-      self.piece_width  = self.board[0].sprite.width
-      self.piece_height = self.board[0].sprite.height
+      sprite = self.kings[0].sprite
+      if sprite is not None:
+         self.piece_width  = sprite.width
+         self.piece_height = sprite.height
+      else:
+         self.piece_width  = PIECE_SIZE
+         self.piece_height = PIECE_SIZE
 
    def pos(self, x, y):
       return y * self.width + x
@@ -423,13 +610,39 @@ class ChessBoard:
    def __getitem__(self, p):
       return self.board[self.pos(p[0], p[1])]
 
+   # set a square, keeping the bitboards in sync
+   def put(self, pos, piece):
+      old = self.board[pos]
+      if old is not None:
+         self.position.remove(old.color, old.kind, pos)
+      if piece is not None:
+         self.position.add(piece.color, piece.kind, pos)
+      self.board[pos] = piece
+
+   # move a piece to an empty square, one update of its bitboards
+   def shift(self, frm, to):
+      piece = self.board[frm]
+      self.position.move(piece.color, piece.kind, frm, to)
+      self.board[frm] = None
+      self.board[to]  = piece
+      piece.coords    = COORDS[to]
+
    # reset board
    def __reset(self):
       for i in xrange(len(self.board)):
          if self.board[i] is not None:
             self.board[i].remove()
             self.board[i] = None
-      self.kings = []
+      self.position.clear()
+      self.color    = WHITE
+      self.epSquare = None
+      self.halfmove = 0
+      self.fullmove = 1
+      self.history  = []
+      self.kings    = []
+      self.key      = 0
+      self.state    = STATE_NONE
+      self.startFen = STANDARD_FEN
 
    def standardBoard(self):
       self.__reset()
@@ -440,13 +653,172 @@ class ChessBoard:
             (5, 7, Bishop, WHITE), (6, 7, Knight, WHITE), (7, 7, Rook, WHITE),
       ]
       for piece in pieces:
-         _piece = piece[2](self, piece[3], [piece[0], piece[1]])
-         self.board[self.pos(piece[0], piece[1])] = _piece
+         _piece = piece[2](self, piece[3], (piece[0], piece[1]))
+         self.put(self.pos(piece[0], piece[1]), _piece)
          if piece[2] == King:
             self.kings.append(_piece)
       for i in xrange(8):
-         self.board[self.pos(i, 1)] = Pawn(self, BLACK, [i, 1])
-         self.board[self.pos(i, 6)] = Pawn(self, WHITE, [i, 6])
+         self.put(self.pos(i, 1), Pawn(self, BLACK, (i, 1)))
+         self.put(self.pos(i, 6), Pawn(self, WHITE, (i, 6)))
+      self.rehash()
+
+   @classmethod
+   def from_fen(cls, fen, ui=None):
+      return cls(ui, fen)
+
+   # set up a position from FEN in a single scan of the string
+   def load_fen(self, fen):
+      self.__reset()
+      self.startFen = fen
+      board = self.board
+      n = len(fen)
+      i = 0
+      x = 0
+      y = 0
+      while i < n and fen[i] != ' ':
+         c = fen[i]
+         i += 1
+         if c == '/':
+            x  = 0
+            y += 1
+         elif '1' <= c <= '8':
+            x += ord(c) - ord('0')
+         elif c in FEN_PIECES and x < self.width and y < self.height:
+            kind, color = FEN_PIECES[c]
+            if kind == PAWN and y in (0, self.height - 1):
+               raise TypeError, 'Invalid FEN pawn: ' + fen
+            sq    = y * self.width + x
+            piece = PIECES[kind](self, color, COORDS[sq])
+            if kind == PAWN:
+               if color == WHITE:
+                  piece.firstMove = y == self.height - 2
+               else:
+                  piece.firstMove = y == 1
+            elif kind == KING:
+               piece.firstMove = False
+               self.kings.append(piece)
+            elif kind == ROOK:
+               piece.firstMove = False
+            self.put(sq, piece)
+            x += 1
+         else:
+            raise TypeError, 'Invalid FEN: ' + fen
+      if len(self.kings) != 2 or self.kings[0].color == self.kings[1].color:
+         raise TypeError, 'Invalid FEN kings: ' + fen
+
+      while i < n and fen[i] == ' ':
+         i += 1
+      if i < n and fen[i] == 'b':
+         self.color = BLACK
+      i += 1
+
+      while i < n and fen[i] == ' ':
+         i += 1
+      while i < n and fen[i] != ' ':
+         index = 'KQkq'.find(fen[i])
+         if index >= 0:
+            right, color, kingsq, rooksq = CASTLES[index]
+            king = board[kingsq]
+            rook = board[rooksq]
+            if king is not None and king.kind == KING and king.color == color and \
+               rook is not None and rook.kind == ROOK and rook.color == color:
+                  king.firstMove = True
+                  rook.firstMove = True
+         i += 1
+
+      while i < n and fen[i] == ' ':
+         i += 1
+      if i + 1 < n and 'a' <= fen[i] <= 'h':
+         # the square a pawn of the other side just skipped
+         if fen[i + 1] != (self.color == WHITE and '6' or '3'):
+            raise TypeError, 'Invalid FEN en passant: ' + fen
+         ep = (ord('8') - ord(fen[i + 1])) * self.width + ord(fen[i]) - ord('a')
+         if self.color == WHITE:
+            pawn = board[ep + 8]
+         else:
+            pawn = board[ep - 8]
+         if pawn is None or pawn.kind != PAWN or pawn.color == self.color:
+            raise TypeError, 'Invalid FEN en passant: ' + fen
+         pawn.enPassant = True
+         self.epSquare  = ep
+      while i < n and fen[i] != ' ':
+         i += 1
+
+      for counter in ('halfmove', 'fullmove'):
+         while i < n and fen[i] == ' ':
+            i += 1
+         if i < n:
+            value = 0
+            while i < n and '0' <= fen[i] <= '9':
+               value = value * 10 + ord(fen[i]) - ord('0')
+               i += 1
+            setattr(self, counter, value)
+      if self.fullmove < 1:
+         self.fullmove = 1
+
+      self.rehash()
+
+   def to_fen(self):
+      fen = []
+      for y in xrange(self.height):
+         empty = 0
+         for x in xrange(self.width):
+            piece = self.board[y * self.width + x]
+            if piece is None:
+               empty += 1
+            else:
+               if empty:
+                  fen.append(str(empty))
+                  empty = 0
+               fen.append(FEN_LETTERS[piece.color][piece.kind])
+         if empty:
+            fen.append(str(empty))
+         if y < self.height - 1:
+            fen.append('/')
+      if self.color == WHITE:
+         fen.append(' w ')
+      else:
+         fen.append(' b ')
+      rights = self.castling()
+      if rights:
+         for i in xrange(4):
+            if rights & (1 << i):
+               fen.append('KQkq'[i])
+      else:
+         fen.append('-')
+      if self.epSquare is not None:
+         fen.append(' ' + squarename(self.epSquare))
+      else:
+         fen.append(' -')
+      fen.append(' %d %d' % (self.halfmove, self.fullmove))
+      return ''.join(fen)
+
+   # castling rights as CASTLE_* bits, from the king and rook flags
+   def castling(self):
+      rights = 0
+      board  = self.board
+      for right, color, kingsq, rooksq in CASTLES:
+         king = board[kingsq]
+         rook = board[rooksq]
+         if king is not None and king.kind == KING and king.color == color and king.firstMove and not king.hasBeenInCheck and \
+            rook is not None and rook.kind == ROOK and rook.color == color and rook.firstMove:
+               rights |= right
+      return rights
+
+   # zobrist key of everything but the pieces: side to move, castling rights
+   # and an en passant square that can actually be taken
+   def __stateKey(self):
+      key = chess_bitboard.ZOBRIST_CASTLE[self.castling()]
+      if self.color == BLACK:
+         key ^= chess_bitboard.ZOBRIST_SIDE
+      ep = self.epSquare
+      if ep is not None and chess_bitboard.PAWN_ATTACKS[self.color ^ 1][ep] & self.position.pieces[self.color][PAWN]:
+         key ^= chess_bitboard.ZOBRIST_EP[ep % 8]
+      return key
+
+   # the piece part of the key is kept up to date by put
+   def rehash(self):
+      self.key = self.position.key ^ self.__stateKey()
 
    def tick(self):
       if self.running:
@@ -459,7 +831,6 @@ class ChessBoard:
          self.tick()
 
    def start(self):
-      self.color      = WHITE
       self.checkColor = None
       self.running    = True
       self.startTime  = time.time()
@@ -475,150 +846,346 @@ class ChessBoard:
       piece = self.board[pos]
       if piece is not None and piece.abbreviation == '':
          piece.remove()
-         self.board[pos] = Queen(self, piece.color, [x, y])
+         self.put(pos, Queen(self, piece.color, (x, y)))
+         self.rehash()
 
    def remove(self, x, y):
       pos   = self.pos(x, y)
       piece = self.board[pos]
       if piece is not None:
          piece.remove()
-         self.board[pos] = None
-
-   def makeMove(self, piece, oldpos, newpos, local=False):
+         self.put(pos, None)
+         self.rehash()
+
+   # make a packed move and push its undo record:
+   # (move, piece, captured, capture square, firstMove, en passant square, promoted piece, key, halfmove clock)
+   def make_move(self, move):
+      frm, to, promotion = unpackmove(move)
+      board    = self.board
+      piece    = board[frm]
+      kind     = piece.kind
+      color    = piece.color
+      captured = board[to]
+      capsq    = to
+      first    = piece.firstMove
+      ep       = self.epSquare
+      promoted = None
+
+      if ep is not None:
+         # the pawn that could have been taken en passant no longer can
+         if color == WHITE:
+            epsq = ep + 8
+         else:
+            epsq = ep - 8
+         board[epsq].enPassant = False
+         if kind == PAWN and to == ep:
+            capsq    = epsq
+            captured = board[epsq]
+      self.epSquare = None
+
+      if captured is not None:
+         self.put(capsq, None)
+      if promotion:
+         promoted = PROMOTIONS[promotion](self, color, COORDS[to], sprite=False)
+         self.put(frm, None)
+         self.put(to, promoted)
+         piece.coords = COORDS[to]
+      else:
+         self.shift(frm, to)
+
+      if first:
+         piece.firstMove = False
+      if kind == PAWN:
+         if to - frm == 16 or frm - to == 16:
+            self.epSquare   = (frm + to) / 2
+            piece.enPassant = True
+      elif kind == KING and (to - frm == 2 or frm - to == 2):
+         # castle, the rook lands on the square the king passed
+         if to > frm:
+            rooksq = frm + 3
+         else:
+            rooksq = frm - 4
+         rook = board[rooksq]
+         self.shift(rooksq, (frm + to) / 2)
+         rook.firstMove = False
+
+      self.history.append((move, piece, captured, capsq, first, ep, promoted, self.key, self.halfmove))
+      if kind == PAWN or captured is not None:
+         self.halfmove = 0
+      else:
+         self.halfmove += 1
+      if color == BLACK:
+         self.fullmove += 1
+      self.color = color ^ 1
+      self.rehash()
+
+   def unmake_move(self):
+      move, piece, captured, capsq, first, ep, promoted, key, halfmove = self.history.pop()
+      frm, to, promotion = unpackmove(move)
+      board = self.board
+
+      if piece.kind == KING and (to - frm == 2 or frm - to == 2):
+         rook = board[(frm + to) / 2]
+         if to > frm:
+            rooksq = frm + 3
+         else:
+            rooksq = frm - 4
+         self.shift((frm + to) / 2, rooksq)
+         rook.firstMove = True
+
+      if promoted is not None:
+         self.put(to, None)
+         self.put(frm, piece)
+         piece.coords = COORDS[frm]
+      else:
+         self.shift(to, frm)
+      if captured is not None:
+         self.put(capsq, captured)
+
+      if first:
+         piece.firstMove = True
+      if piece.kind == PAWN:
+         piece.enPassant = False
+
+      self.epSquare = ep
+      if ep is not None:
+         if piece.color == WHITE:
+            board[ep + 8].enPassant = True
+         else:
+            board[ep - 8].enPassant = True
+      self.color    = piece.color
+      self.key      = key
+      self.halfmove = halfmove
+      if piece.color == BLACK:
+         self.fullmove -= 1
+
+   # bring sprites in line with the last move made
+   def __showMove(self, undo):
+      move, piece, captured, capsq, first, ep, promoted, key, halfmove = undo
+      frm, to, promotion = unpackmove(move)
+      if captured is not None:
+         captured.remove()
+      if promoted is not None:
+         piece.remove()
+         promoted.show()
+      elif piece.sprite is not None:
+         piece.sprite.place(*COORDS[to])
+      if piece.kind == KING and (to - frm == 2 or frm - to == 2):
+         rook = self.board[(frm + to) / 2]
+         if rook.sprite is not None:
+            rook.sprite.place(*COORDS[(frm + to) / 2])
+
+   def makeMove(self, piece, oldpos, newpos):
       pos_old = self.pos(oldpos[0], oldpos[1])
       pos_new = self.pos(newpos[0], newpos[1])
-      if self.board[pos_new] is not None:
-         self.board[pos_new].remove()
+      if piece.kind == PAWN and (newpos[1] == 0 or newpos[1] == self.height - 1):
+         promotion = QUEEN
+      else:
+         promotion = 0
+      self.playMove(packmove(pos_old, pos_new, promotion))
+
+   # make a packed move in the game, updating sprites and the ui
+   def playMove(self, move):
+      frm, to, promotion = unpackmove(move)
+      piece = self.board[frm]
+      label = encodesan(self, move, suffix=False)
+      self.make_move(move)
+      undo = self.history[-1]
+      if undo[2] is not None:
          capture = 'x'
       else:
-         if piece.abbreviation == '' and abs(oldpos[0] - newpos[0]) == 1 and abs(oldpos[1] - newpos[1]) == 1:
-            capture = 'x'
-         else:
-            capture = ''
-      self.board[pos_new] = self.board[pos_old]
-      self.board[pos_old] = None
-      if not local:
-         state = self.__checkGameState()
-         if state == STATE_MATE:
-            check = '#'
-         elif state == STATE_CHECK:
-            check = '+'
-         else:
-            check = ''
-         self.ui.add_move(movelabels(piece, capture, check, oldpos, newpos))
-         self.color = (self.color + 1) % 2
-         self.ui.set_turn(COLORS[self.color])
-         if state not in [STATE_NONE, STATE_CHECK]:
-            self.finish(state)
-         elif state == STATE_CHECK:
-            self.ui.in_check(COLORS[self.color])
+         capture = ''
+      self.__showMove(undo)
+
+      state = self.__checkGameState()
+      if state == STATE_MATE:
+         check = '#'
+      elif state == STATE_CHECK:
+         check = '+'
+      else:
+         check = ''
+      simple, unused = movelabels(piece, capture, check, COORDS[frm], COORDS[to])
+      self.ui.add_move((simple, label + check))
+      self.ui.set_turn(COLORS[self.color])
+      if state not in [STATE_NONE, STATE_CHECK]:
+         self.finish(state)
+      elif state == STATE_CHECK:
+         self.ui.in_check(COLORS[self.color])
 
    def finish(self, state):
+      self.state = state
       self.stop()
       self.ui.finish(state)
 
-   def __hasValidMove(self, color):
-      for piece in self.board:
-         if piece is not None and piece.color == color and piece.hasValidMove():
-            return True
-      return False
-
-   def __checkDirection(self, x, y, color, xDelta, yDelta, pieces):
-      x += xDelta
-      y += yDelta
-      while x >= 0 and x < self.width and y >= 0 and y < self.height:
-         piece = self.board[self.pos(x, y)]
-         if piece is not None:
-            if piece.color != color and piece.abbreviation in pieces:
-               return True
-            else:
-               return False
-         x += xDelta
-         y += yDelta
-      return False
-
-   def __checkKnight(self, x, y, color):
-      if x >= 0 and x < self.width and y >= 0 and y < self.height:
-         piece = self.board[self.pos(x, y)]
-         if piece is not None and piece.abbreviation == 'N' and piece.color != color:
-            return True
-      return False
-
-   def __isChecked(self, king, otherKing):
-      x     = king.coords[0]
-      y     = king.coords[1]
-      color = king.color
-
-      if color == BLACK and y < 6:
-         yDelta = 1
+   # PGN result of the game so far
+   def result(self):
+      if self.state == STATE_MATE or self.state == STATE_TIME:
+         # the side to move lost
+         if self.color == WHITE:
+            return '0-1'
+         return '1-0'
+      elif self.state == STATE_STALE:
+         return '1/2-1/2'
+      return '*'
+
+   # note a check on the side to move after a move, a king that has been
+   # in check may no longer castle
+   def markCheck(self):
+      if self.inCheck(self.color):
+         self.checkColor = self.color
+         self.king(self.color).hasBeenInCheck = True
+         self.rehash()
       else:
-         yDelta = -1
-
-      # check for close pawns
-      if x > 0:
-         piece = self.board[self.pos(x - 1, y + yDelta)]
-         if piece is not None and piece.abbreviation == '' and piece.color != color:
-            return True
-      if x < 7:
-         piece = self.board[self.pos(x + 1, y + yDelta)]
-         if piece is not None and piece.abbreviation == '' and piece.color != color:
-            return True
-
-      # check cardinal directions and diagonals
-      if self.__checkDirection(x, y, color, 1, 0, ['R', 'Q']) or \
-         self.__checkDirection(x, y, color, -1, 0, ['R', 'Q']) or \
-         self.__checkDirection(x, y, color, 0, 1, ['R', 'Q']) or \
-         self.__checkDirection(x, y, color, 0, -1, ['R', 'Q']) or \
-         self.__checkDirection(x, y, color, 1, 1, ['B', 'Q']) or \
-         self.__checkDirection(x, y, color, -1, 1, ['B', 'Q']) or \
-         self.__checkDirection(x, y, color, -1, -1, ['B', 'Q']) or \
-         self.__checkDirection(x, y, color, 1, -1, ['B', 'Q']):
-            return True
-
-      # check king proximity
-      deltax = abs(x - otherKing.coords[0])
-      deltay = abs(y - otherKing.coords[1])
-      if deltax <= 1 and deltay <= 1:
-         return True
-
-      # check knights
-      if self.__checkKnight(x - 2, y - 1, color) or \
-         self.__checkKnight(x - 2, y + 1, color) or \
-         self.__checkKnight(x + 2, y - 1, color) or \
-         self.__checkKnight(x + 2, y + 1, color) or \
-         self.__checkKnight(x - 1, y - 2, color) or \
-         self.__checkKnight(x - 1, y + 2, color) or \
-         self.__checkKnight(x + 1, y - 2, color) or \
-         self.__checkKnight(x + 1, y + 2, color):
-            return True
-
-      return False
+         self.checkColor = None
+      return self.checkColor is not None
 
+   # state of the side to move
    def __checkGameState(self):
       state = STATE_NONE
-      if self.__isChecked(self.kings[0], self.kings[1]):
-         self.checkColor = self.kings[0].color
-         self.kings[0].hasBeenInCheck = True
-      elif self.__isChecked(self.kings[1], self.kings[0]):
-         self.checkColor = self.kings[1].color
-         self.kings[1].hasBeenInCheck = True
-      else:
-         self.checkColor = None
-      if self.checkColor is not None:
-         if not self.__hasValidMove(self.checkColor):
-            if self.checkColor == self.color:
-               state = STATE_MATE
-            else:
-               state = STATE_STALE
+      self.markCheck()
+      if not self.legal_moves():
+         if self.checkColor is not None:
+            state = STATE_MATE
          else:
-            state = STATE_CHECK
+            state = STATE_STALE
+      elif self.checkColor is not None:
+         state = STATE_CHECK
       return state
 
-   def inCheck(self, color):
+   def king(self, color):
       if self.kings[0].color == color:
-         return self.__isChecked(self.kings[0], self.kings[1])
+         return self.kings[0]
+      return self.kings[1]
+
+   # every legal move for a color (default the side to move) as packed moves,
+   # pins and checkers are found once up front instead of trying each move,
+   # captures limits them to captures and promotions
+   def legal_moves(self, color=None, captures=False):
+      if color is None:
+         color = self.color
+      BIT            = chess_bitboard.BIT
+      BETWEEN        = chess_bitboard.BETWEEN
+      PAWN_ATTACKS   = chess_bitboard.PAWN_ATTACKS[color]
+      KNIGHT_ATTACKS = chess_bitboard.KNIGHT_ATTACKS
+      rook_attacks   = chess_bitboard.rook_attacks
+      bishop_attacks = chess_bitboard.bishop_attacks
+      squares        = chess_bitboard.squares
+
+      position = self.position
+      other    = color ^ 1
+      pieces   = position.pieces[color]
+      them     = position.pieces[other]
+      own      = position.occupied[color]
+      occupied = position.all
+      enemy    = position.occupied[other]
+      ksq      = position.king(color)
+      moves    = []
+      append   = moves.append
+      if captures:
+         allowed = enemy
       else:
-         return self.__isChecked(self.kings[1], self.kings[0])
+         allowed = ~own & chess_bitboard.ALL_SQUARES
+
+      # the king is lifted off the board so it cannot shield itself from a slider
+      without = occupied ^ BIT[ksq]
+      for to in squares(chess_bitboard.KING_ATTACKS[ksq] & allowed):
+         if not position.attacked(to, other, without):
+            append(ksq | (to << 6))
+
+      checkers = position.checkers(ksq, other)
+      if checkers & (checkers - 1):
+         # double check, only the king can move
+         return moves
+      elif checkers:
+         # capture the checker or block it
+         target = checkers | BETWEEN[ksq][chess_bitboard.lsb(checkers)]
+      else:
+         target = ~own & chess_bitboard.ALL_SQUARES
+         king = self.board[ksq]
+         if king.firstMove and not king.hasBeenInCheck and not captures:
+            for rooksq, step in ((ksq + 3, 1), (ksq - 4, -1)):
+               rook = self.board[rooksq]
+               if rook is not None and rook.kind == ROOK and rook.color == color and rook.firstMove and \
+                  not BETWEEN[ksq][rooksq] & occupied and \
+                  not position.attacked(ksq + step, other) and \
+                  not position.attacked(ksq + step + step, other):
+                     append(ksq | ((ksq + step + step) << 6))
+
+      # pawns keep the full target, pushes are filtered below
+      pawntarget = target
+      target    &= allowed
+      pins = position.pins(ksq, color)
+
+      # destination loops are inlined, this is the hottest code in the search
+      for frm in squares(pieces[KNIGHT]):
+         if frm not in pins:
+            tos = KNIGHT_ATTACKS[frm] & target
+            while tos:
+               low  = tos & -tos
+               tos ^= low
+               append(frm | (low.bit_length() - 1) << 6)
+
+      for frm in squares(pieces[BISHOP] | pieces[QUEEN]):
+         tos = bishop_attacks(frm, occupied) & target
+         if frm in pins:
+            tos &= pins[frm]
+         while tos:
+            low  = tos & -tos
+            tos ^= low
+            append(frm | (low.bit_length() - 1) << 6)
+
+      for frm in squares(pieces[ROOK] | pieces[QUEEN]):
+         tos = rook_attacks(frm, occupied) & target
+         if frm in pins:
+            tos &= pins[frm]
+         while tos:
+            low  = tos & -tos
+            tos ^= low
+            append(frm | (low.bit_length() - 1) << 6)
+
+      if color == WHITE:
+         push  = -8
+         first = range(48, 56)
+         last  = range(8, 16)
+      else:
+         push  = 8
+         first = range(8, 16)
+         last  = range(48, 56)
+      ep = self.epSquare
+      for frm in squares(pieces[PAWN]):
+         tos = PAWN_ATTACKS[frm] & enemy
+         one = frm + push
+         if not occupied & BIT[one] and (not captures or frm in last):
+            tos |= BIT[one]
+            if frm in first and not occupied & BIT[one + push]:
+               tos |= BIT[one + push]
+         tos &= pawntarget
+         if frm in pins:
+            tos &= pins[frm]
+         for to in squares(tos):
+            if to < 8 or to >= 56:
+               for promotion in (QUEEN, ROOK, BISHOP, KNIGHT):
+                  append(frm | (to << 6) | (promotion << 12))
+            else:
+               append(frm | (to << 6))
+         if ep is not None and PAWN_ATTACKS[frm] & BIT[ep]:
+            # both pawns leave their squares, so test the king directly
+            capsq = ep - push
+            after = occupied ^ BIT[frm] ^ BIT[capsq] | BIT[ep]
+            if not (KNIGHT_ATTACKS[ksq] & them[KNIGHT] or
+                    PAWN_ATTACKS[ksq] & them[PAWN] & ~BIT[capsq] or
+                    rook_attacks(ksq, after) & (them[ROOK] | them[QUEEN]) or
+                    bishop_attacks(ksq, after) & (them[BISHOP] | them[QUEEN])):
+               append(frm | (ep << 6))
+
+      return moves
+
+   def attacked(self, x, y, color):
+      return self.position.attacked(self.pos(x, y), color)
+
+   def inCheck(self, color):
+      position = self.position
+      return position.attacked(position.king(color), color ^ 1)
 
    def handleMove(self, move):
       try:
@@ -631,25 +1198,22 @@ class ChessBoard:
                raise TypeError, 'Invalid coord: %d' % coord
          pos = self.board[self.pos(sx, sy)]
          if pos is not None:
-            pos.sprite.move(dx, dy)
+            pos.move(dx, dy)
          else:
             raise TypeError, 'Invalid move position: %d, %d' % (sx, sy)
       except:
          #traceback.print_exc()
          print 'Invalid move:', move
 
-   def savepgn(self, fn, moves):
-      # PGN: http://en.wikipedia.org/wiki/Portable_Game_Notation
-      f = open(fn, 'w')
-      # TODO: STR:
-      f.write('[Event "Match Name"]\n')
-      f.write('[Site "City, Region COUNTRY"]\n') # Format: City, Region COUNTRY
-      f.write('[Date "2000.01.01"]\n')  # Format: YYYY.MM.DD
-      f.write('[Round "1"]\n')
-      f.write('[White "Last1, First1"]\n')  # Format: last name, first name
-      f.write('[Black "Last2, First2"]\n')
-      f.write('[Result "1/2-1/2"]\n')  # "1-0" (White), "0-1" (Black), "1/2-1/2" (Draw), "*" (other/ongoing)
-      for item in moves:
-         f.write(item + '\n')
-      # TODO: any result other than * should be repeated at end
-      f.close()
+   # this game as a PGNGame, tags fill in the seven tag roster
+   def pgn(self, moves, tags=None):
+      tags = dict(tags or {})
+      if 'Date' not in tags:
+         tags['Date'] = time.strftime('%Y.%m.%d')
+      if self.startFen != STANDARD_FEN:
+         tags['SetUp'] = '1'
+         tags['FEN']   = self.startFen
+      return chess_pgn.PGNGame(tags, list(moves), self.result())
+
+   def savepgn(self, fn, moves, tags=None):
+      chess_pgn.writepgnfile(fn, [self.pgn(moves, tags)])
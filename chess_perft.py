@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+# perft: count the leaves of the legal move tree to verify and time the move generator
+
+import argparse
+import multiprocessing
+import sys
+import time
+
+import chess_bitboard
+import chess_game
+
+# name, FEN, expected node counts by depth
+POSITIONS = [
+   ('start', chess_game.STANDARD_FEN, [20, 400, 8902, 197281, 4865609]),
+   ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+      [48, 2039, 97862, 4085603]),
+   ('endgame', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+      [14, 191, 2812, 43238, 674624]),
+   ('mirror', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+      [6, 264, 9467, 422333]),
+   ('promotion', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+      [44, 1486, 62379, 2103487]),
+   ('middlegame', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+      [46, 2079, 89890, 3894594]),
+   ('castling', 'r3k2r/pppq1ppp/2np1n2/2b1p1B1/2B1P1b1/2NP1N2/PPPQ1PPP/R3K2R w KQkq - 4 8',
+      [44, 1896, 80731, 3427165]),
+   ('enpassant', 'r1bqkb1r/p1p1pppp/1pn2n2/3pP3/2B5/5N2/PPPP1PPP/RNBQK2R w KQkq d6 0 5',
+      [33, 1034, 33353, 1040619]),
+   ('pinned', 'r1bqkbnr/ppp2ppp/2np4/1B2p3/4P3/5N2/PPPP1PPP/RNBQ1RK1 b kq - 3 4',
+      [27, 783, 22206, 661281]),
+]
+
+# moves from the piece objects' own generators, to check them against legal_moves
+def legacy_moves(board, color=None):
+   if color is None:
+      color = board.color
+   moves = []
+   for sq in chess_bitboard.squares(board.position.occupied[color]):
+      piece = board.board[sq]
+      for x, y in piece.getPossibleMoves():
+         if piece.checkMove(x, y):
+            to = board.pos(x, y)
+            if piece.kind == chess_game.PAWN and (y == 0 or y == board.height - 1):
+               for promotion in (chess_game.QUEEN, chess_game.ROOK, chess_game.BISHOP, chess_game.KNIGHT):
+                  moves.append(chess_game.packmove(sq, to, promotion))
+            else:
+               moves.append(chess_game.packmove(sq, to))
+   return moves
+
+def generator(board, legacy=False):
+   if legacy:
+      return lambda: legacy_moves(board)
+   return board.legal_moves
+
+def perft(board, depth, generate=None):
+   if generate is None:
+      generate = board.legal_moves
+   moves = generate()
+   if depth <= 1:
+      return len(moves)
+   nodes = 0
+   for move in moves:
+      board.make_move(move)
+      nodes += perft(board, depth - 1, generate)
+      board.unmake_move()
+   return nodes
+
+def __perftRoot(args):
+   fen, move, depth, legacy = args
+   board = chess_game.ChessBoard.from_fen(fen)
+   board.make_move(move)
+   if depth == 0:
+      return 1
+   return perft(board, depth, generator(board, legacy))
+
+# node count below each root move, optionally split across a process pool
+def divide(fen, depth, legacy=False, pool=None):
+   board = chess_game.ChessBoard.from_fen(fen)
+   roots = generator(board, legacy)()
+   jobs  = [(fen, move, depth - 1, legacy) for move in roots]
+   if pool is not None:
+      counts = pool.map(__perftRoot, jobs)
+   else:
+      counts = map(__perftRoot, jobs)
+   return zip(roots, counts)
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description='Count and time move generation over the standard test positions.')
+   parser.add_argument('positions', nargs='*', help='positions to run (default all): ' + ', '.join(p[0] for p in POSITIONS))
+   parser.add_argument('-d', '--depth', type=int, help='maximum depth (default every depth with a known count)')
+   parser.add_argument('-D', '--divide', action='store_true', help='show node counts per root move at the last depth')
+   parser.add_argument('-p', '--processes', type=int, default=1, help='split root moves across this many processes')
+   parser.add_argument('-l', '--legacy', action='store_true', help='use the per piece move generators')
+   parser.add_argument('-f', '--fen', help='run this position instead')
+   args = parser.parse_args(argv)
+
+   if args.fen:
+      if not args.depth:
+         parser.error('--fen needs --depth')
+      positions = [('fen', args.fen, [])]
+   else:
+      positions = [p for p in POSITIONS if not args.positions or p[0] in args.positions]
+   pool = None
+   if args.processes > 1:
+      pool = multiprocessing.Pool(args.processes)
+
+   failures = 0
+   total    = 0
+   start    = time.time()
+   try:
+      for name, fen, expected in positions:
+         depth = args.depth or len(expected)
+         for d in xrange(1, depth + 1):
+            t = time.time()
+            counts = divide(fen, d, args.legacy, pool)
+            t = time.time() - t
+            nodes = sum(count for move, count in counts)
+            total += nodes
+            if d <= len(expected) and nodes != expected[d - 1]:
+               status = 'FAIL expected %d' % expected[d - 1]
+               failures += 1
+            else:
+               status = 'ok'
+            print '%-10s depth %d %12d nodes %8.2fs %10d nps  %s' % (name, d, nodes, t, nodes / max(t, 1e-6), status)
+            if args.divide and d == depth:
+               for move, count in sorted(counts, key=lambda c: chess_game.movename(c[0])):
+                  print '   %-6s %d' % (chess_game.movename(move), count)
+   finally:
+      if pool is not None:
+         pool.close()
+         pool.join()
+
+   t = time.time() - start
+   print 'total %d nodes %.2fs %d nps' % (total, t, total / max(t, 1e-6))
+   return failures and 1 or 0
+
+if __name__ == '__main__':
+   sys.exit(main())
@@ -0,0 +1,219 @@
+# PGN: http://en.wikipedia.org/wiki/Portable_Game_Notation
+
+import re
+
+import chess_game
+
+RESULTS = ['1-0', '0-1', '1/2-1/2', '*']
+
+# seven tag roster, in the required order, with the values for unknown tags
+ROSTER = [
+   ('Event' , '?'),
+   ('Site'  , '?'),
+   ('Date'  , '????.??.??'),
+   ('Round' , '?'),
+   ('White' , '?'),
+   ('Black' , '?'),
+   ('Result', '*'),
+]
+
+LINE_LENGTH = 79
+
+TAG   = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+TOKEN = re.compile(r'\{|;|\(|\)|\$\d+|\d+\.+|1-0|0-1|1/2-1/2|\*|[^\s{};()$]+')
+MOVE_NUMBER = re.compile(r'\d+\.+$')
+
+class PGNGame:
+   def __init__(self, tags, sans, result):
+      self.tags   = tags
+      self.sans   = sans
+      self.result = result
+      self.__moves = None
+
+   def board(self, ui=None):
+      return chess_game.ChessBoard.from_fen(self.tags.get('FEN', chess_game.STANDARD_FEN), ui)
+
+   # make the moves one at a time on a fresh board, yielding the board
+   # before each move along with the packed move
+   def replay(self, board=None):
+      if board is None:
+         board = self.board()
+      for san in self.sans:
+         move = chess_game.decodesan(board, san, board.legal_moves())
+         yield board, move
+         board.make_move(move)
+
+   # packed moves, decoded on first use
+   def moves(self):
+      if self.__moves is None:
+         self.__moves = [move for board, move in self.replay()]
+      return self.__moves
+
+# read games one at a time from a file object, only the current game is
+# held in memory and moves stay as SAN text unless lazy is False
+def readpgn(f, lazy=True):
+   tags    = {}
+   sans    = []
+   result  = None
+   comment = False   # inside a multi-line {} comment
+   depth   = 0       # variation nesting
+
+   for line in f:
+      if comment:
+         end = line.find('}')
+         if end < 0:
+            continue
+         line    = line[end + 1:]
+         comment = False
+      elif line.startswith('%'):
+         continue
+
+      if depth == 0 and line.lstrip().startswith('['):
+         if sans or result is not None:
+            yield __game(tags, sans, result, lazy)
+            tags   = {}
+            sans   = []
+            result = None
+         for match in TAG.finditer(line):
+            tags[match.group(1)] = match.group(2).replace('\\"', '"').replace('\\\\', '\\')
+         continue
+
+      pos = 0
+      while True:
+         match = TOKEN.search(line, pos)
+         if match is None:
+            break
+         token = match.group()
+         pos   = match.end()
+         if token == '{':
+            end = line.find('}', pos)
+            if end < 0:
+               comment = True
+               break
+            pos = end + 1
+         elif token == ';':
+            break
+         elif token == '(':
+            depth += 1
+         elif token == ')':
+            depth = max(depth - 1, 0)
+         elif depth > 0 or token[0] == '$' or MOVE_NUMBER.match(token):
+            continue
+         elif token in RESULTS:
+            result = token
+            yield __game(tags, sans, result, lazy)
+            tags   = {}
+            sans   = []
+            result = None
+         else:
+            sans.append(token.rstrip('!?'))
+
+   if tags or sans:
+      yield __game(tags, sans, result, lazy)
+
+def __game(tags, sans, result, lazy):
+   if result is None:
+      result = tags.get('Result', '*')
+   game = PGNGame(tags, sans, result)
+   if not lazy:
+      game.moves()
+   return game
+
+def __tag(name, value):
+   return '[%s "%s"]\n' % (name, value.replace('\\', '\\\\').replace('"', '\\"'))
+
+# a game as PGN text: the seven tag roster first, then any other tags,
+# then the moves numbered in pairs and wrapped, then the result
+def formatpgn(game):
+   tags = game.tags
+   text = []
+   for name, default in ROSTER:
+      if name == 'Result':
+         text.append(__tag(name, game.result))
+      else:
+         text.append(__tag(name, tags.get(name, default)))
+   for name in sorted(tags):
+      if name not in ('Event', 'Site', 'Date', 'Round', 'White', 'Black', 'Result'):
+         text.append(__tag(name, tags[name]))
+   text.append('\n')
+
+   color  = chess_game.WHITE
+   number = 1
+   if 'FEN' in tags:
+      fields = tags['FEN'].split()
+      if len(fields) > 1 and fields[1] == 'b':
+         color = chess_game.BLACK
+      if len(fields) > 5 and fields[5].isdigit():
+         number = int(fields[5])
+
+   line = []
+   size = 0
+   for i, san in enumerate(game.sans):
+      if color == chess_game.WHITE:
+         token = '%d. %s' % (number, san)
+      elif i == 0:
+         token = '%d... %s' % (number, san)
+      else:
+         token = san
+      if color == chess_game.BLACK:
+         number += 1
+      color ^= 1
+      if size and size + 1 + len(token) > LINE_LENGTH:
+         text.append(' '.join(line) + '\n')
+         line = []
+         size = 0
+      if size:
+         size += 1
+      line.append(token)
+      size += len(token)
+   if size and size + 1 + len(game.result) > LINE_LENGTH:
+      text.append(' '.join(line) + '\n')
+      line = []
+   line.append(game.result)
+   text.append(' '.join(line) + '\n\n')
+   return ''.join(text)
+
+# collects formatted games and writes them out in large blocks
+class PGNWriter:
+   def __init__(self, f, buffersize=1 << 16):
+      self.f          = f
+      self.buffersize = buffersize
+      self.buffer     = []
+      self.size       = 0
+      self.count      = 0
+
+   def write(self, game):
+      text = formatpgn(game)
+      self.buffer.append(text)
+      self.size  += len(text)
+      self.count += 1
+      if self.size >= self.buffersize:
+         self.flush()
+
+   def flush(self):
+      if self.buffer:
+         self.f.write(''.join(self.buffer))
+         self.buffer = []
+         self.size   = 0
+
+def writepgn(f, games):
+   writer = PGNWriter(f)
+   for game in games:
+      writer.write(game)
+   writer.flush()
+   return writer.count
+
+def writepgnfile(fn, games):
+   f = open(fn, 'w')
+   try:
+      return writepgn(f, games)
+   finally:
+      f.close()
+
+def readpgnfile(fn, lazy=True):
+   f = open(fn, 'r')
+   try:
+      for game in readpgn(f, lazy):
+         yield game
+   finally:
+      f.close()
@@ -1,143 +1,607 @@
 # simple text-based protocol to communicate between chess clients
+#
+# a text line is a command token followed by its fields joined with ':',
+# e.g. MOVEE2E4 or SITname:white.  after a BINARY line (answered with
+# BINARY by the server) a connection switches to frames of a 32-bit length,
+# an opcode byte and the fields joined with NUL bytes
 
-from twisted.internet  import reactor, protocol, endpoints
+import re
+import struct
+import time
+
+from twisted.internet  import reactor, protocol, endpoints, interfaces
 from twisted.protocols import basic
+from zope.interface    import implementer
+
+import chess_game
 
 DEFAULT_PORT = 3333
 
-# forward messages to other clients, keep track of users/seats/moves for future connections
-class ChessServerProtocol(basic.LineReceiver):
-   def __init__(self, factory):
-      self.factory = factory
-      self.name    = None
+# a late joiner gets at most this many moves after a position snapshot
+SNAPSHOT_MOVES = 16
+
+# bytes held back for a client that stopped reading before it is dropped
+BUFFER_LIMIT = 256 * 1024
+
+# command token: binary opcode, number of fields
+COMMANDS = {
+   'NAME'   : (1 , 1),
+   'CNAME'  : (2 , 2),
+   'RNAME'  : (3 , 1),
+   'SIT'    : (4 , 2),
+   'MOVE'   : (5 , 1),
+   'NEWGAME': (6 , 0),
+   'CHAT'   : (7 , 1),
+   'JOIN'   : (8 , 1),
+   'LEAVE'  : (9 , 0),
+   'ERROR'  : (10, 1),
+   'BINARY' : (11, 0),
+   # POSITION<index>:<seconds>:<last move>:<FEN>, the game after index moves
+   'POSITION': (12, 4),
+   # RESUME<index>:<last move>:<room>, a client that has seen the first
+   # index moves of the room's game
+   'RESUME' : (13, 3),
+}
+OPCODES = dict((opcode, token) for token, (opcode, count) in COMMANDS.iteritems())
+TOKEN   = re.compile('|'.join(sorted(COMMANDS, key=len, reverse=True)))
+
+# clients that never JOIN share this room, as with a single game server
+DEFAULT_ROOM = ''
+
+# a command as written to the wire, a text line or a length-prefixed frame
+def encode(token, fields, binary):
+   if binary:
+      frame = chr(COMMANDS[token][0]) + '\0'.join(fields)
+      return struct.pack(basic.Int32StringReceiver.structFormat, len(frame)) + frame
+   return token + ':'.join(fields) + basic.LineReceiver.delimiter
+
+# one game: its members, who sits where, the moves played so far and the
+# authoritative board they are checked against
+class ChessRoom:
+   def __init__(self, name):
+      self.name    = name
+      self.clients = set()
+      self.names   = []
+      self.seats   = {}
+      self.newGame()
+
+   # the legal moves of the position are generated once after each move,
+   # checking a move is then a set lookup
+   def newGame(self):
+      self.moves    = []
+      self.board    = chess_game.ChessBoard()
+      self.legal    = set(self.board.legal_moves())
+      self.started  = time.time()
+      self.snapshot = (0, self.board.to_fen())
+
+   # the position after some moves, taken again only once the game has
+   # moved SNAPSHOT_MOVES past it so every joiner shares the same FEN
+   def position(self):
+      index, fen = self.snapshot
+      if len(self.moves) - index > SNAPSHOT_MOVES:
+         self.snapshot = (len(self.moves), self.board.to_fen())
+      return self.snapshot
+
+   # seats belong to connections, a name alone cannot claim one
+   def owner(self, color):
+      for client, seat in self.seats.iteritems():
+         if seat == color:
+            return client
+      return None
+
+   def spectators(self):
+      return set(c for c in self.clients if c not in self.seats)
+
+   # an error for the sender or None once the seat is taken
+   def sit(self, sender, name, color):
+      if name != sender.name:
+         return 'Cannot seat %s' % name
+      if color not in chess_game.COLORS:
+         return 'Invalid seat: %s' % color
+      owner = self.owner(color)
+      if owner is not None and owner is not sender:
+         return 'Seat taken: %s' % color
+      self.seats[sender] = color
+      return None
+
+   # an error for the sender or None once the move is played, the side to
+   # move belongs to whoever sits there and otherwise to anyone not seated
+   # for the other side
+   def play(self, sender, label):
+      board = self.board
+      if not self.legal:
+         return 'Game over: %s' % label
+      color = chess_game.COLORS[board.color]
+      owner = self.owner(color)
+      if owner is None and sender in self.seats or owner is not None and owner is not sender:
+         return 'Not your move: %s' % label
+      try:
+         sx, sy, dx, dy = chess_game.decodemove(label)
+      except TypeError:
+         return 'Invalid move: %s' % label
+      if not (0 <= sx < 8 and 0 <= sy < 8 and 0 <= dx < 8 and 0 <= dy < 8):
+         return 'Invalid move: %s' % label
+      frm   = board.pos(sx, sy)
+      piece = board.board[frm]
+      # the move labels only carry queen promotions
+      promotion = 0
+      if piece is not None and piece.kind == chess_game.PAWN and dy in (0, 7):
+         promotion = chess_game.QUEEN
+      move = chess_game.packmove(frm, board.pos(dx, dy), promotion)
+      if move not in self.legal:
+         return 'Illegal move: %s' % label
+      board.make_move(move)
+      board.markCheck()
+      self.legal = set(board.legal_moves())
+      self.moves.append(label)
+      return None
+
+   # encoded once per framing, every member gets the same string
+   def send(self, source, token, *fields):
+      data = {}
+      for c in self.clients:
+         if c != source:
+            if c.binary not in data:
+               data[c.binary] = encode(token, fields, c.binary)
+            c.write(data[c.binary])
+
+class ChessFrames(basic.Int32StringReceiver):
+   def __init__(self, owner):
+      self.owner = owner
+
+   def stringReceived(self, frame):
+      self.owner.frameReceived(frame)
+
+# both ends of the protocol: commands are parsed from either framing and
+# handed to the do_<TOKEN> method for the command
+class ChessProtocol(basic.LineReceiver):
+   frames = None
+   binary = False
 
+   def __init__(self):
+      self.handlers = {}
+      for token in COMMANDS:
+         handler = getattr(self, 'do_' + token, None)
+         if handler is not None:
+            self.handlers[token] = handler
+
+   # names a text CNAME may start with, names can hold colons
+   def knownNames(self):
+      return []
+
+   def lineReceived(self, line):
+      match = TOKEN.match(line)
+      if match is None:
+         self.unknownCommand(line)
+         return
+      token = match.group()
+      text  = line[len(token):]
+      count = COMMANDS[token][1]
+      if count == 0:
+         fields = []
+      elif count == 1:
+         fields = [text]
+      else:
+         fields = None
+         if token == 'CNAME':
+            for name in self.knownNames():
+               if text.startswith(name + ':'):
+                  fields = [name, text[len(name) + 1:]]
+                  break
+         if fields is None and token in ('CNAME', 'SIT'):
+            # a seat color never holds a colon
+            fields = list(text.rpartition(':')[::2])
+         elif fields is None:
+            # only the last field may hold a colon
+            fields = text.split(':', count - 1)
+            if len(fields) != count:
+               self.unknownCommand(line)
+               return
+      self.dispatch(token, fields)
+
+   def frameReceived(self, frame):
+      token = frame and OPCODES.get(ord(frame[0]))
+      if not token:
+         self.unknownCommand(repr(frame[:8]))
+         return
+      count = COMMANDS[token][1]
+      if count == 0:
+         fields = []
+      elif count == 1:
+         fields = [frame[1:]]
+      else:
+         fields = frame[1:].split('\0')
+         if len(fields) != count:
+            self.unknownCommand(repr(frame[:8]))
+            return
+      self.dispatch(token, fields)
+
+   def dispatch(self, token, fields):
+      handler = self.handlers.get(token)
+      if handler is None:
+         self.unknownCommand(token)
+      else:
+         handler(*fields)
+
+   def unknownCommand(self, data):
+      pass
+
+   def sendCommand(self, token, *fields):
+      self.write(encode(token, fields, self.binary))
+
+   def write(self, data):
+      self.transport.write(data)
+
+   # frames from now on for whatever is sent, reading frames starts with
+   # readFrames once the other end has switched as well
+   def sendFrames(self):
+      self.binary = True
+
+   def readFrames(self):
+      self.frames = ChessFrames(self)
+      self.setRawMode()
+
+   def rawDataReceived(self, data):
+      self.frames.dataReceived(data)
+
+# forward messages to the other clients in the same room, keep track of
+# users/seats/moves for clients joining the room later.  the connection
+# produces for its transport: while the client isn't reading, writes are
+# held back and go out as one once it is, up to BUFFER_LIMIT bytes
+@implementer(interfaces.IPushProducer)
+class ChessServerProtocol(ChessProtocol):
+   def __init__(self, factory):
+      ChessProtocol.__init__(self)
+      self.factory     = factory
+      self.name        = None
+      self.room        = None
+      # writes held back, apart from LineReceiver's paused for reading
+      self.writePaused = False
+      self.pending     = []
+      self.buffered    = 0
+
+   # joining a room waits for the first command, which may be a RESUME
    def connectionMade(self):
+      self.transport.registerProducer(self, True)
       self.factory.clients.add(self)
-      for name in self.factory.names:
-         self.sendLine('NAME' + name)
-      for name, color in self.factory.seats.iteritems():
-         self.sendLine('SIT' + name + ':' + color)
-      for move in self.factory.moves:
-         self.sendLine('MOVE' + move)
+
+   def write(self, data):
+      if not self.writePaused:
+         self.transport.write(data)
+      elif self.pending is not None:
+         self.pending.append(data)
+         self.buffered += len(data)
+         if self.buffered > BUFFER_LIMIT:
+            # a stalled client must not hold on to server memory
+            self.pending = None
+            self.transport.abortConnection()
+
+   def pauseProducing(self):
+      self.writePaused = True
+
+   def resumeProducing(self):
+      self.writePaused = False
+      if self.pending:
+         data = ''.join(self.pending)
+         self.pending  = []
+         self.buffered = 0
+         self.transport.write(data)
+
+   def stopProducing(self):
+      self.pending = None
 
    def connectionLost(self, reason):
       self.factory.clients.remove(self)
+      if self.room is not None:
+         self.leave()
+
+   # send the room's users and game to the new member and introduce it to
+   # the others, it only gets the room's broadcasts from then on
+   def join(self, name, index=0, last=''):
+      room = self.room = self.factory.room(name)
+      for other in room.names:
+         self.sendCommand('NAME', other)
+      for color in chess_game.COLORS:
+         owner = room.owner(color)
+         if owner is not None:
+            self.sendCommand('SIT', owner.name, color)
+      self.catchUp(index, last)
+      room.clients.add(self)
       if self.name:
-         self.factory.names.remove(self.name)
-         self.factory.send('RNAME' + self.name, self)
+         room.names.append(self.name)
+         room.send(self, 'NAME', self.name)
 
-   def lineReceived(self, line):
-      if line.startswith('NAME'):
-         self.name = line[4:]
-         self.factory.names.append(self.name)
-      elif line.startswith('CNAME'):
-         oldName, newName = line[5:].split(':')
-         self.factory.names.remove(oldName)
-         self.factory.names.append(newName)
-      elif line.startswith('RNAME'):
-         self.factory.names.remove(line[5:])
-      elif line.startswith('SIT'):
-         name, color = line[3:].split(':')
-         self.factory.seats[name] = color
-      elif line.startswith('MOVE'):
-         self.factory.moves.append(line[4:])
-      elif line.startswith('NEWGAME'):
-         self.factory.moves = []
-      self.factory.send(line, self)
+   def leave(self):
+      room = self.room
+      room.clients.remove(self)
+      room.seats.pop(self, None)
+      if self.name:
+         room.names.remove(self.name)
+         room.send(self, 'RNAME', self.name)
+      self.factory.close(room)
+      self.room = None
+      return room
+
+   # move to another room, clearing the users and board of the old one
+   def switch(self, name):
+      if self.room is not None:
+         room = self.leave()
+         for other in room.names:
+            self.sendCommand('RNAME', other)
+         self.sendCommand('NEWGAME')
+      self.join(name)
+
+   # the game so far from a client's first index moves: what it lacks when
+   # it still knows the game, otherwise a snapshot and the moves since
+   def catchUp(self, index, last):
+      room  = self.room
+      moves = room.moves
+      if index > len(moves) or index and moves[index - 1] != last:
+         self.sendCommand('NEWGAME')
+         index = 0
+      if not index and len(moves) > SNAPSHOT_MOVES:
+         index, fen = room.position()
+         seconds = int(time.time() - room.started)
+         self.sendCommand('POSITION', str(index), str(seconds), moves[index - 1], fen)
+      for move in moves[index:]:
+         self.sendCommand('MOVE', move)
+
+   def dispatch(self, token, fields):
+      if self.room is None and token not in ('BINARY', 'RESUME', 'JOIN', 'LEAVE'):
+         self.join(DEFAULT_ROOM)
+      ChessProtocol.dispatch(self, token, fields)
+
+   def knownNames(self):
+      if self.room is None:
+         return []
+      return self.room.names
+
+   def unknownCommand(self, data):
+      self.sendCommand('ERROR', 'Unknown command: %s' % data)
+
+   def do_BINARY(self):
+      self.sendCommand('BINARY')
+      self.sendFrames()
+      self.readFrames()
+
+   def do_RESUME(self, index, last, room):
+      if self.room is not None:
+         self.sendCommand('ERROR', 'Already caught up')
+      elif not index.isdigit():
+         self.join(room)
+      else:
+         self.join(room, int(index), last)
+
+   def do_JOIN(self, name):
+      self.switch(name)
+
+   def do_LEAVE(self):
+      self.switch(DEFAULT_ROOM)
+
+   # a connection names itself once, CNAME and RNAME only touch its own name
+   def do_NAME(self, name):
+      if self.name is not None:
+         self.sendCommand('ERROR', 'Already named: %s' % self.name)
+      elif name in self.room.names:
+         self.sendCommand('ERROR', 'Name taken: %s' % name)
+      else:
+         self.name = name
+         self.room.names.append(name)
+         self.room.send(self, 'NAME', name)
+
+   def do_CNAME(self, oldName, newName):
+      room = self.room
+      if oldName != self.name or oldName not in room.names:
+         self.sendCommand('ERROR', 'Cannot rename %s' % oldName)
+      elif newName in room.names:
+         self.sendCommand('ERROR', 'Name taken: %s' % newName)
+      else:
+         room.names.remove(oldName)
+         room.names.append(newName)
+         self.name = newName
+         room.send(self, 'CNAME', oldName, newName)
+
+   def do_RNAME(self, name):
+      room = self.room
+      if name != self.name or name not in room.names:
+         self.sendCommand('ERROR', 'Cannot remove %s' % name)
+      else:
+         room.names.remove(name)
+         room.seats.pop(self, None)
+         self.name = None
+         room.send(self, 'RNAME', name)
+
+   def do_SIT(self, name, color):
+      error = self.room.sit(self, name, color)
+      if error:
+         self.sendCommand('ERROR', error)
+      else:
+         self.room.send(self, 'SIT', name, color)
+
+   def do_MOVE(self, move):
+      error = self.room.play(self, move)
+      if error:
+         self.sendCommand('ERROR', error)
+      else:
+         self.room.send(self, 'MOVE', move)
+
+   def do_NEWGAME(self):
+      if self not in self.room.seats:
+         self.sendCommand('ERROR', 'Not seated')
+      else:
+         self.room.newGame()
+         self.room.send(self, 'NEWGAME')
+
+   def do_CHAT(self, text):
+      self.room.send(self, 'CHAT', text)
 
 class ChessServerFactory(protocol.Factory):
    def __init__(self):
       self.clients = set()
-      self.names   = []
-      self.seats   = {}
-      self.moves   = []
+      self.rooms   = {}
 
    def buildProtocol(self, addr):
       return ChessServerProtocol(self)
 
-   def send(self, line, source):
-      for c in self.clients:
-         if c != source:
-            c.sendLine(line)
+   def room(self, name):
+      room = self.rooms.get(name)
+      if room is None:
+         room = self.rooms[name] = ChessRoom(name)
+      return room
+
+   # rooms go away with their last member, the default room stays
+   def close(self, room):
+      if not room.clients and room.name != DEFAULT_ROOM:
+         del self.rooms[room.name]
 
 # simple test protocol for sending chats and moves
-class ChessClient(basic.LineReceiver):
+class ChessClient(ChessProtocol):
    def __init__(self, factory, parent):
+      ChessProtocol.__init__(self)
       self.name    = None
       self.factory = factory
       self.parent  = parent
       self.users   = []
 
    def changeName(self, name):
-      self.sendLine('CNAME' + self.name + ':' + name)
+      self.sendCommand('CNAME', self.name, name)
       self.name = name
 
    def sendChat(self, text):
-      self.sendLine('CHAT' + text)
+      self.sendCommand('CHAT', text)
 
    def sendMove(self, move):
-      self.sendLine('MOVE' + move)
+      self.factory.played(move)
+      self.sendCommand('MOVE', move)
 
    def sit(self, color):
-      self.sendLine('SIT' + self.name + ':' + color)
+      self.factory.seat = color
+      self.sendCommand('SIT', self.name, color)
 
    def newGame(self):
-      self.sendLine('NEWGAME')
+      self.factory.played(None)
+      self.sendCommand('NEWGAME')
+
+   def join(self, room):
+      self.factory.room = room
+      self.factory.seat = None
+      self.sendCommand('JOIN', room)
+
+   def leave(self):
+      self.factory.room = DEFAULT_ROOM
+      self.factory.seat = None
+      self.sendCommand('LEAVE')
 
    def connectionMade(self):
       #print 'Connected'
       self.factory.clients.add(self)
       self.name = self.parent.getUser()
-      self.sendLine('NAME' + self.name)
-      if self.factory.onConnectionMade:
-         self.factory.onConnectionMade.callback(self)
+      if self.factory.binary:
+         self.sendCommand('BINARY')
+         self.sendFrames()
+      # back after a dropped connection, only the missing moves are needed
+      if self.factory.moves or self.factory.room != DEFAULT_ROOM:
+         self.sendCommand('RESUME', str(self.factory.moves), self.factory.last, self.factory.room)
+      self.sendCommand('NAME', self.name)
+      # the server frees a seat with the connection that held it
+      if self.factory.seat is not None:
+         self.sendCommand('SIT', self.name, self.factory.seat)
+      # only the first connection is reported, not reconnects
+      connected, self.factory.onConnectionMade = self.factory.onConnectionMade, None
+      if connected:
+         connected.callback(self)
 
    def connectionLost(self, reason):
       self.factory.clients.remove(self)
       self.parent.removeUsers(self.users)
 
-   def lineReceived(self, line):
-      if line.startswith('NAME'):
-         name = line[4:]
-         self.parent.addUser(name)
-         self.users.append(name)
-      elif line.startswith('CNAME'):
-         oldName, newName = line[5:].split(':')
-         self.parent.removeUser(oldName)
-         self.parent.addUser(newName)
-         self.users.remove(oldName)
-         self.users.append(newName)
-      elif line.startswith('RNAME'):
-         self.parent.removeUser(line[5:])
-      elif line.startswith('MOVE'):
-         self.parent.handleMove(line[4:])
-      elif line.startswith('CHAT'):
-         self.parent.addChatLine(line[4:])
-      elif line.startswith('SIT'):
-         self.parent.remoteSit(*line[3:].split(':'))
-      elif line.startswith('NEWGAME'):
-         self.parent.remoteNewGame()
-      else:
-         print 'Invalid server command:', line
+   def knownNames(self):
+      return self.users
+
+   def unknownCommand(self, data):
+      print 'Invalid server command:', data
 
-# protocol.ReconnectingClientFactory
-class ChessClientFactory(protocol.ClientFactory):
-   def __init__(self, parent, view_only):
+   def do_BINARY(self):
+      self.readFrames()
+
+   def do_NAME(self, name):
+      self.parent.addUser(name)
+      self.users.append(name)
+
+   def do_CNAME(self, oldName, newName):
+      self.parent.removeUser(oldName)
+      self.parent.addUser(newName)
+      self.users.remove(oldName)
+      self.users.append(newName)
+
+   def do_RNAME(self, name):
+      self.parent.removeUser(name)
+      if name in self.users:
+         self.users.remove(name)
+
+   def do_MOVE(self, move):
+      self.factory.played(move)
+      self.parent.handleMove(move)
+
+   def do_POSITION(self, index, seconds, last, fen):
+      self.factory.moves = int(index)
+      self.factory.last  = last
+      self.parent.remotePosition(fen, int(seconds))
+
+   def do_CHAT(self, text):
+      self.parent.addChatLine(text)
+
+   def do_SIT(self, name, color):
+      self.parent.remoteSit(name, color)
+
+   def do_NEWGAME(self):
+      self.factory.played(None)
+      self.parent.remoteNewGame()
+
+   def do_ERROR(self, text):
+      self.parent.addChatLine('*** server: ' + text)
+
+# a dropped connection is made again and picks the game up with RESUME, a
+# first connection that fails is only reported
+class ChessClientFactory(protocol.ReconnectingClientFactory):
+   def __init__(self, parent, view_only, binary=False):
       self.parent    = parent
       self.view_only = view_only
+      # ask the server for binary frames, bots and busy spectators
+      self.binary    = binary
       self.clients   = set()
+      # the room, the seat taken there and the moves of its game seen so
+      # far, kept across connections
+      self.room      = DEFAULT_ROOM
+      self.seat      = None
+      self.moves     = 0
+      self.last      = ''
+      self.connected = False
 
       self.onConnectionMade = None
 
    def buildProtocol(self, addr):
+      self.connected = True
+      self.resetDelay()
       return ChessClient(self, self.parent)
 
+   # a move made in the game, None for a new game
+   def played(self, move):
+      if move is None:
+         self.moves = 0
+         self.last  = ''
+      else:
+         self.moves += 1
+         self.last   = move
+
    def clientConnectionFailed(self, connector, reason):
       print 'connection failed:', reason.getErrorMessage()
+      if self.connected:
+         protocol.ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
 
    def clientConnectionLost(self, connector, reason):
       #print 'connection lost:', reason.getErrorMessage()
-      pass
+      protocol.ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
 
    def __send(self, method, *args):
       for client in self.clients:
@@ -158,21 +622,27 @@ class ChessClientFactory(protocol.ClientFactory):
    def newGame(self):
       self.__send('newGame')
 
+   def join(self, room):
+      self.__send('join', room)
+
+   def leave(self):
+      self.__send('leave')
+
 class ChessNetwork:
    def __init__(self, frame):
       self.frame  = frame
       self.server = None
       self.client = None
 
-   def connect(self, host, port, view_only, allow_running=False, connected=None):
+   def connect(self, host, port, view_only, allow_running=False, connected=None, binary=False):
       if not allow_running and (self.client is not None or self.server is not None):
          self.stop()
-      self.client = ChessClientFactory(self.frame, view_only)
+      self.client = ChessClientFactory(self.frame, view_only, binary)
       if connected:
          self.client.onConnectionMade = connected
       self.clientPort = reactor.connectTCP(host, port, self.client)
 
-   def serve(self, port):
+   def serve(self, port, connected=None):
       if self.client is not None or self.server is not None:
          self.stop()
       #print 'Running server on port:', port
@@ -180,7 +650,7 @@ class ChessNetwork:
       self.serverPort = None
       d = self.server.listen(ChessServerFactory())
       d.addCallback(self.serving)
-      self.connect('localhost', port, False, True)
+      self.connect('localhost', port, False, True, connected)
 
    def serving(self, port):
       if self.server:
@@ -191,6 +661,7 @@ class ChessNetwork:
    def stop(self):
       d = None
       if self.client:
+         self.client.stopTrying()
          self.clientPort.disconnect()
          self.client = self.clientPort = None
       if self.server:
@@ -218,3 +689,11 @@ class ChessNetwork:
    def newGame(self):
       if self.client:
          self.client.newGame()
+
+   def join(self, room):
+      if self.client:
+         self.client.join(room)
+
+   def leave(self):
+      if self.client:
+         self.client.leave()
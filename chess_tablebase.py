@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+
+# endgame tablebases for a side with a few pieces against a lone king,
+# built by retrograde analysis and probed from memory mapped files
+#
+# a table is named by its material, strongest piece first: KQK, KRK, KBNK,
+# KPK.  tables are built with white as the strong side, a position with
+# black as the strong side is probed upside down.  every position has a
+# signed byte for the side to move: v > 0 mates in v plies, v < 0 is mated
+# in -v - 1 plies and 0 is a draw or not a legal position
+
+import argparse
+import array
+import mmap
+import os
+import re
+import struct
+import sys
+
+import chess_bitboard
+import chess_game
+
+WHITE = chess_game.WHITE
+BLACK = chess_game.BLACK
+
+PAWN   = chess_game.PAWN
+KNIGHT = chess_game.KNIGHT
+BISHOP = chess_game.BISHOP
+ROOK   = chess_game.ROOK
+QUEEN  = chess_game.QUEEN
+KING   = chess_game.KING
+
+BIT            = chess_bitboard.BIT
+KING_ATTACKS   = chess_bitboard.KING_ATTACKS
+KNIGHT_ATTACKS = chess_bitboard.KNIGHT_ATTACKS
+PAWN_ATTACKS   = chess_bitboard.PAWN_ATTACKS[WHITE]
+rook_attacks   = chess_bitboard.rook_attacks
+bishop_attacks = chess_bitboard.bishop_attacks
+
+SIGNATURE = re.compile(r'^K[QRBNP]*K$')
+LETTERS   = 'PNBRQ'
+
+# file header: magic, number of squares in the index, signature
+HEADER = struct.Struct('<4sB11s')
+MAGIC  = 'CHTB'
+SUFFIX = '.ctb'
+
+# strong side piece kinds, strongest first
+def pieces(signature):
+   if not SIGNATURE.match(signature):
+      raise TypeError, 'Invalid tablebase signature: %s' % signature
+   return sorted([LETTERS.index(c) for c in signature[1:-1]], reverse=True)
+
+def signature(kinds):
+   return 'K' + ''.join(LETTERS[kind] for kind in sorted(kinds, reverse=True)) + 'K'
+
+# the index is the side to move followed by the white king, the black king
+# and the pieces in signature order, six bits each
+def index(color, squares):
+   i = color
+   for sq in squares:
+      i = (i << 6) | sq
+   return i
+
+def __decode(i, n):
+   squares = [0] * n
+   for k in xrange(n - 1, -1, -1):
+      squares[k] = i & 63
+      i >>= 6
+   return i, squares
+
+def __attacks(kind, sq, occupied):
+   if kind == KNIGHT:
+      return KNIGHT_ATTACKS[sq]
+   elif kind == BISHOP:
+      return bishop_attacks(sq, occupied)
+   elif kind == ROOK:
+      return rook_attacks(sq, occupied)
+   elif kind == QUEEN:
+      return rook_attacks(sq, occupied) | bishop_attacks(sq, occupied)
+   elif kind == PAWN:
+      return PAWN_ATTACKS[sq]
+   return KING_ATTACKS[sq]
+
+# squares white attacks, sliders see through the black king
+def __white(kinds, squares, occupied):
+   attacks = KING_ATTACKS[squares[0]]
+   occupied &= ~BIT[squares[1]]
+   for k in xrange(len(kinds)):
+      attacks |= __attacks(kinds[k], squares[k + 2], occupied)
+   return attacks
+
+def __legal(kinds, color, squares):
+   occupied = 0
+   for sq in squares:
+      if occupied & BIT[sq]:
+         return False
+      occupied |= BIT[sq]
+   if KING_ATTACKS[squares[0]] & BIT[squares[1]]:
+      return False
+   for k in xrange(len(kinds)):
+      if kinds[k] == PAWN and (squares[k + 2] < 8 or squares[k + 2] >= 56):
+         return False
+   if color == WHITE:
+      return not __white(kinds, squares, occupied) & BIT[squares[1]]
+   return True
+
+# value of a position in a smaller table, no table means nobody can mate
+def __lookup(tables, kinds, color, squares):
+   values = tables[signature(kinds)]
+   if values is None:
+      return 0
+   # keep the pieces in signature order
+   order = sorted(xrange(len(kinds)), key=lambda k: kinds[k], reverse=True)
+   return values[index(color, squares[:2] + [squares[k + 2] for k in order])]
+
+def __subtable(name, tables):
+   if name not in tables:
+      kinds = pieces(name)
+      if not kinds or kinds in ([BISHOP], [KNIGHT]):
+         tables[name] = None
+      else:
+         tables[name] = generate(name, tables)
+   return tables[name]
+
+# positions a move away, split into moves inside the table and exits
+# through a capture or promotion, as values for the side to move
+def __moves(kinds, color, squares, tables):
+   occupied = 0
+   for sq in squares:
+      occupied |= BIT[sq]
+   wk    = squares[0]
+   bk    = squares[1]
+   moves = 0
+   exits = []
+   if color == WHITE:
+      white  = occupied & ~BIT[bk]
+      moves += chess_bitboard.popcount(KING_ATTACKS[wk] & ~white & ~KING_ATTACKS[bk])
+      for k in xrange(len(kinds)):
+         sq = squares[k + 2]
+         if kinds[k] != PAWN:
+            moves += chess_bitboard.popcount(__attacks(kinds[k], sq, occupied) & ~occupied)
+         elif not occupied & BIT[sq - 8]:
+            if sq - 8 < 8:
+               for promotion in (QUEEN, ROOK, BISHOP, KNIGHT):
+                  after = kinds[:k] + [promotion] + kinds[k + 1:]
+                  exits.append(__lookup(tables, after, BLACK, squares[:k + 2] + [sq - 8] + squares[k + 3:]))
+            else:
+               moves += 1
+               if sq >= 48 and not occupied & BIT[sq - 16]:
+                  moves += 1
+      return moves, exits, False
+
+   attacked = __white(kinds, squares, occupied)
+   for to in chess_bitboard.squares(KING_ATTACKS[bk] & ~attacked):
+      if occupied & BIT[to]:
+         k = squares.index(to) - 2
+         __subtable(signature(kinds[:k] + kinds[k + 1:]), tables)
+         exits.append(__lookup(tables, kinds[:k] + kinds[k + 1:], WHITE, [wk, to] + squares[2:k + 2] + squares[k + 3:]))
+      else:
+         moves += 1
+   return moves, exits, attacked & BIT[bk] != 0
+
+# positions a move before, the reverse of the moves inside the table
+def __unmoves(kinds, color, squares):
+   occupied = 0
+   for sq in squares:
+      occupied |= BIT[sq]
+   wk = squares[0]
+   bk = squares[1]
+   if color == WHITE:
+      # black just moved
+      for frm in chess_bitboard.squares(KING_ATTACKS[bk] & ~occupied & ~KING_ATTACKS[wk]):
+         yield index(BLACK, [wk, frm] + squares[2:])
+      return
+
+   for frm in chess_bitboard.squares(KING_ATTACKS[wk] & ~occupied & ~KING_ATTACKS[bk]):
+      before = [frm] + squares[1:]
+      if not __white(kinds, before, occupied ^ BIT[wk] ^ BIT[frm]) & BIT[bk]:
+         yield index(WHITE, before)
+   for k in xrange(len(kinds)):
+      sq = squares[k + 2]
+      if kinds[k] == PAWN:
+         froms = 0
+         if sq + 8 < 56 and not occupied & BIT[sq + 8]:
+            froms = BIT[sq + 8]
+            if 32 <= sq < 40 and not occupied & BIT[sq + 16]:
+               froms |= BIT[sq + 16]
+      else:
+         froms = __attacks(kinds[k], sq, occupied) & ~occupied
+      for frm in chess_bitboard.squares(froms):
+         before = squares[:k + 2] + [frm] + squares[k + 3:]
+         if not __white(kinds, before, occupied ^ BIT[sq] ^ BIT[frm]) & BIT[bk]:
+            yield index(WHITE, before)
+
+# build a table, tables caches the smaller tables captures and promotions
+# lead to and gets the new one as well
+def generate(name, tables=None):
+   if tables is None:
+      tables = {}
+   kinds = pieces(name)
+   n     = len(kinds) + 2
+   size  = 2 << (6 * n)
+   for promotion in (QUEEN, ROOK, BISHOP, KNIGHT):
+      if PAWN in kinds:
+         k = kinds.index(PAWN)
+         __subtable(signature(kinds[:k] + [promotion] + kinds[k + 1:]), tables)
+
+   values  = array.array('b', [0]) * size
+   done    = bytearray(size)
+   count   = array.array('B', [0]) * size
+   # positions that can escape into a draw or lose slower outside the table
+   drawing = set()
+   slowest = {}
+   buckets = [[] for plies in xrange(128)]
+
+   for i in xrange(size):
+      color, squares = __decode(i, n)
+      if not __legal(kinds, color, squares):
+         done[i] = 1
+         continue
+      moves, exits, check = __moves(kinds, color, squares, tables)
+      count[i] = moves
+      win  = None
+      loss = 0
+      for value in exits:
+         if value < 0:
+            if win is None or -value < win:
+               win = -value
+         elif value > 0:
+            loss = max(loss, value + 1)
+         else:
+            drawing.add(i)
+      if win is not None:
+         buckets[win].append((i, True))
+      elif not moves and not exits:
+         if check:
+            buckets[0].append((i, False))
+         else:
+            done[i] = 1
+      elif i not in drawing:
+         if loss:
+            slowest[i] = loss
+         if not moves:
+            buckets[loss].append((i, False))
+
+   # positions are settled in order of distance to mate, so the last move
+   # that lets a position's moves all lose is its longest one
+   for plies in xrange(127):
+      for i, win in buckets[plies]:
+         if done[i]:
+            continue
+         done[i] = 1
+         color, squares = __decode(i, n)
+         if win:
+            values[i] = plies
+            for before in __unmoves(kinds, color, squares):
+               if not done[before]:
+                  count[before] -= 1
+                  if not count[before] and before not in drawing:
+                     buckets[max(plies + 1, slowest.get(before, 0))].append((before, False))
+         else:
+            values[i] = -plies - 1
+            for before in __unmoves(kinds, color, squares):
+               if not done[before]:
+                  buckets[plies + 1].append((before, True))
+      buckets[plies] = None
+
+   tables[name] = values
+   return values
+
+def tablepath(directory, name):
+   return os.path.join(directory, name + SUFFIX)
+
+def save(fn, name, values):
+   f = open(fn, 'wb')
+   try:
+      f.write(HEADER.pack(MAGIC, len(pieces(name)) + 2, name))
+      values.tofile(f)
+   finally:
+      f.close()
+
+# memory mapped tables from a directory, each probe is one byte read
+class Tablebase:
+   def __init__(self, directory):
+      self.tables    = {}
+      self.maxpieces = 0
+      for fn in sorted(os.listdir(directory)):
+         if fn.endswith(SUFFIX):
+            self.load(os.path.join(directory, fn))
+
+   def load(self, fn):
+      f = open(fn, 'rb')
+      try:
+         data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      finally:
+         f.close()
+      magic, n, name = HEADER.unpack(data[:HEADER.size])
+      name = name.rstrip('\0')
+      if magic != MAGIC or len(data) != HEADER.size + (2 << (6 * n)):
+         data.close()
+         raise TypeError, 'Invalid tablebase file: %s' % fn
+      self.tables[name] = data
+      self.maxpieces    = max(self.maxpieces, n)
+
+   def close(self):
+      for data in self.tables.values():
+         data.close()
+      self.tables = {}
+
+   # value for the side to move as stored in the tables, None when there
+   # is no table for the material or castling is still possible
+   def probe(self, board):
+      position = board.position
+      if chess_bitboard.popcount(position.all) > self.maxpieces or board.castling():
+         return None
+      for strong in (WHITE, BLACK):
+         if position.occupied[strong ^ 1] == position.pieces[strong ^ 1][KING]:
+            break
+      else:
+         return None
+      pieces = position.pieces[strong]
+      kinds  = []
+      for kind in (QUEEN, ROOK, BISHOP, KNIGHT, PAWN):
+         kinds += [kind] * chess_bitboard.popcount(pieces[kind])
+      data = self.tables.get(signature(kinds))
+      if data is None:
+         return None
+      # the strong side is white in the tables
+      flip    = strong == BLACK and 56 or 0
+      squares = [position.king(strong) ^ flip, position.king(strong ^ 1) ^ flip]
+      for kind in (QUEEN, ROOK, BISHOP, KNIGHT, PAWN):
+         squares += [sq ^ flip for sq in chess_bitboard.squares(pieces[kind])]
+      value = ord(data[HEADER.size + index(board.color ^ strong, squares)])
+      if value > 127:
+         value -= 256
+      return value
+
+   # game result when the tables know it, for ending finished games early
+   def adjudicate(self, board):
+      value = self.probe(board)
+      if value is None:
+         return None
+      if value == 0:
+         return '1/2-1/2'
+      if (value > 0) == (board.color == WHITE):
+         return '1-0'
+      return '0-1'
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description='Build endgame tablebases or probe them.')
+   parser.add_argument('tables', nargs='*', help='tables to build, e.g. KQK KRK KPK')
+   parser.add_argument('-o', '--directory', default='.', help='directory for the table files (default .)')
+   parser.add_argument('-p', '--probe', help='FEN to look up in the tables in the directory')
+   args = parser.parse_args(argv)
+
+   tables = {}
+   for name in args.tables:
+      values = generate(name, tables)
+      save(tablepath(args.directory, name), name, values)
+      print '%s %d positions' % (name, len(values))
+
+   if args.probe:
+      tablebase = Tablebase(args.directory)
+      value = tablebase.probe(chess_game.ChessBoard.from_fen(args.probe))
+      if value is None:
+         print 'no table'
+      elif value > 0:
+         print 'mate in %d plies' % value
+      elif value < 0:
+         print 'mated in %d plies' % (-value - 1)
+      else:
+         print 'draw'
+      tablebase.close()
+   return 0
+
+if __name__ == '__main__':
+   sys.exit(main())
@@ -0,0 +1,194 @@
+# many positions packed into numpy arrays for bulk evaluation
+#
+# a batch of n positions keeps the board as an n x 64 int8 array using the
+# ChessBoard square layout, 0 for an empty square, kind + 1 for a white
+# piece and -(kind + 1) for a black one
+
+try:
+   import numpy
+except ImportError:
+   numpy = None
+
+import chess_engine
+import chess_game
+
+# rows evaluated at a time, bounds the temporary arrays
+CHUNK = 1 << 16
+
+# signed scores indexed by piece code + 6 and square, white positive
+def __codetable(scores):
+   table = numpy.zeros((13, 64), numpy.int32)
+   for kind in xrange(6):
+      table[6 + kind + 1] = scores[chess_game.WHITE][kind]
+      table[6 - kind - 1] = [-score for score in scores[chess_game.BLACK][kind]]
+   return table
+
+if numpy is not None:
+   SCORES         = __codetable(chess_engine.SCORES)
+   ENDGAME_SCORES = __codetable(chess_engine.ENDGAME_SCORES)
+   # piece code of each plane
+   CODES          = numpy.array(range(1, 7) + range(-1, -7, -1), numpy.int8)
+
+   # piece code of each FEN character once digits are expanded to dots
+   INVALID      = 127
+   LETTER_CODES = numpy.full(256, INVALID, numpy.int8)
+   LETTER_CODES[ord('.')] = 0
+   for _letter, (_kind, _color) in chess_game.FEN_PIECES.iteritems():
+      LETTER_CODES[ord(_letter)] = _color == chess_game.WHITE and _kind + 1 or -_kind - 1
+
+EXPAND         = [(str(n), '.' * n) for n in xrange(1, 9)]
+EP_SQUARES     = dict((chess_game.squarename(sq), sq) for sq in xrange(64))
+EP_SQUARES['-'] = -1
+CASTLE_LETTERS = zip([chess_game.CASTLE_WHITE_KING, chess_game.CASTLE_WHITE_QUEEN,
+                      chess_game.CASTLE_BLACK_KING, chess_game.CASTLE_BLACK_QUEEN], 'KQkq')
+
+class BoardBatch:
+   def __init__(self, squares, color, castling, ep, halfmove, fullmove):
+      if numpy is None:
+         raise ImportError, 'BoardBatch needs numpy'
+      self.squares  = squares
+      self.color    = color
+      self.castling = castling
+      self.ep       = ep
+      self.halfmove = halfmove
+      self.fullmove = fullmove
+
+   @classmethod
+   def empty(cls, n):
+      if numpy is None:
+         raise ImportError, 'BoardBatch needs numpy'
+      return cls(numpy.zeros((n, 64), numpy.int8),
+                 numpy.zeros(n, numpy.int8),
+                 numpy.zeros(n, numpy.uint8),
+                 numpy.full(n, -1, numpy.int8),
+                 numpy.zeros(n, numpy.int16),
+                 numpy.ones(n, numpy.int16))
+
+   # the piece layout comes straight from the bitboards, expanded to
+   # squares for the whole batch at once
+   @classmethod
+   def from_boards(cls, boards):
+      boards = list(boards)
+      batch  = cls.empty(len(boards))
+      bits   = numpy.zeros((len(boards), 12), numpy.uint64)
+      for i, board in enumerate(boards):
+         pieces = board.position.pieces
+         bits[i] = pieces[chess_game.WHITE] + pieces[chess_game.BLACK]
+         batch.color[i]    = board.color
+         batch.castling[i] = board.castling()
+         if board.epSquare is not None:
+            batch.ep[i] = board.epSquare
+         batch.halfmove[i] = board.halfmove
+         batch.fullmove[i] = board.fullmove
+      shifts = numpy.arange(64, dtype=numpy.uint64)
+      for start in xrange(0, len(boards), CHUNK):
+         planes = (bits[start:start + CHUNK, :, None] >> shifts) & numpy.uint64(1)
+         batch.squares[start:start + CHUNK] = (planes.astype(numpy.int8) * CODES[None, :, None]).sum(axis=1)
+      return batch
+
+   # FENs are read directly into the arrays, no ChessBoard is built: the
+   # placements are expanded to 64 characters each and translated in one go
+   @classmethod
+   def from_fens(cls, fens):
+      placements = []
+      colors     = []
+      rights     = []
+      eps        = []
+      halfmoves  = []
+      fullmoves  = []
+      for fen in fens:
+         fields = fen.split()
+         if len(fields) < 4 or fields[1] not in ('w', 'b') or fields[3] not in EP_SQUARES:
+            raise TypeError, 'Invalid FEN: %s' % fen
+         placement = fields[0].replace('/', '')
+         for digit, empty in EXPAND:
+            placement = placement.replace(digit, empty)
+         if len(placement) != 64:
+            raise TypeError, 'Invalid FEN: %s' % fen
+         placements.append(placement)
+         colors.append(fields[1] == 'b' and chess_game.BLACK or chess_game.WHITE)
+         castling = 0
+         for right, letter in CASTLE_LETTERS:
+            if letter in fields[2]:
+               castling |= right
+         rights.append(castling)
+         eps.append(EP_SQUARES[fields[3]])
+         if len(fields) > 5:
+            halfmoves.append(int(fields[4]))
+            fullmoves.append(int(fields[5]))
+         else:
+            halfmoves.append(0)
+            fullmoves.append(1)
+
+      n = len(placements)
+      squares = LETTER_CODES[numpy.frombuffer(''.join(placements), numpy.uint8)].reshape(n, 64)
+      bad = (squares == INVALID).any(axis=1)
+      if bad.any():
+         raise TypeError, 'Invalid FEN: %s' % placements[bad.argmax()]
+      return cls(squares,
+                 numpy.array(colors, numpy.int8),
+                 numpy.array(rights, numpy.uint8),
+                 numpy.array(eps, numpy.int8),
+                 numpy.array(halfmoves, numpy.int16),
+                 numpy.array(fullmoves, numpy.int16))
+
+   def __len__(self):
+      return len(self.squares)
+
+   def fen(self, i):
+      rows = []
+      row  = self.squares[i]
+      for y in xrange(8):
+         text  = ''
+         empty = 0
+         for x in xrange(8):
+            code = int(row[y * 8 + x])
+            if code == 0:
+               empty += 1
+               continue
+            if empty:
+               text += str(empty)
+               empty = 0
+            if code > 0:
+               text += chess_game.FEN_LETTERS[chess_game.WHITE][code - 1]
+            else:
+               text += chess_game.FEN_LETTERS[chess_game.BLACK][-code - 1]
+         if empty:
+            text += str(empty)
+         rows.append(text)
+      castling = ''
+      for right, letter in CASTLE_LETTERS:
+         if self.castling[i] & right:
+            castling += letter
+      if self.ep[i] < 0:
+         ep = '-'
+      else:
+         ep = chess_game.squarename(int(self.ep[i]))
+      return '%s %s %s %s %d %d' % ('/'.join(rows), 'wb'[self.color[i]], castling or '-', ep,
+                                    self.halfmove[i], self.fullmove[i])
+
+   def board(self, i, ui=None):
+      return chess_game.ChessBoard.from_fen(self.fen(i), ui)
+
+   def boards(self):
+      return [self.board(i) for i in xrange(len(self))]
+
+   # one plane per color and kind, white pawn first and black king last
+   def planes(self):
+      return self.squares[:, None, :] == CODES[None, :, None]
+
+   # material and piece square score for the side to move of every
+   # position, the same numbers chess_engine.evaluate gives one at a time
+   def evaluate(self):
+      scores = numpy.empty(len(self), numpy.int32)
+      columns = numpy.arange(64)
+      for start in xrange(0, len(self), CHUNK):
+         squares = self.squares[start:start + CHUNK]
+         index   = squares.astype(numpy.intp) + 6
+         middle  = SCORES[index, columns].sum(axis=1)
+         endgame = ENDGAME_SCORES[index, columns].sum(axis=1)
+         queens  = (numpy.abs(squares) == chess_game.QUEEN + 1).any(axis=1)
+         score   = numpy.where(queens, middle, endgame)
+         black   = self.color[start:start + CHUNK] == chess_game.BLACK
+         scores[start:start + CHUNK] = numpy.where(black, -score, score)
+      return scores
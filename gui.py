@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import os
+import socket
 import sys
 import time
 import traceback
@@ -12,12 +13,19 @@ import tkSimpleDialog
 
 from twisted.internet import tksupport, reactor
 
+import chess_engine
 import chess_images
 import chess_game
 import chess_server
 
 MARGIN = 10
 
+# computer thinking time per move in seconds
+COMPUTER_SECONDS = 3
+
+# computer search processes, None for one per core
+COMPUTER_WORKERS = None
+
 def getuser():
    for env in ['LOGNAME', 'USERNAME', 'USER']:
       user = os.getenv(env)
@@ -33,12 +41,22 @@ def getuser():
       user = os.getlogin()
    return user
 
+# piece images decoded once and shared by every sprite, keyed by name
+# and color such as queen_white, so new games and promotions decode nothing
+IMAGES = {}
+
+def getimage(name):
+   image = IMAGES.get(name)
+   if image is None:
+      image = IMAGES[name] = tk.PhotoImage(data=getattr(chess_images, name))
+   return image
+
 class Highlight:
-   def __init__(self, x, y, width, height, canvas, sprite):
+   def __init__(self, x, y, width, height, canvas, sprite, color='yellow'):
       x = x - width / 2
       y = y - height / 2
       border = 2
-      self.tag    = canvas.create_rectangle((x, y, x + width, y + height), outline='yellow', width=border)
+      self.tag    = canvas.create_rectangle((x, y, x + width, y + height), outline=color, width=border)
       self.canvas = canvas
 
       canvas.tag_raise(sprite.tag)
@@ -46,74 +64,99 @@ class Highlight:
    def hide(self):
       self.canvas.delete(self.tag)
 
+# a piece's canvas image, kept for the life of the canvas: removing a piece
+# hides it and hands it back to the gui to be reused for the next piece
 class TkSprite:
    def __init__(self, gui, model, image, coords, canvas):
       self.gui     = gui
       self.model   = model
-      self.image   = tk.PhotoImage(data=image)
+      self.image   = image
       self.width   = self.image.width()
       self.height  = self.image.height()
       self.canvas  = canvas
       self.current = None
       self.suggest = None
+      # squares the selected piece may move to, worked out once per selection
+      self.targets = set()
+      self.marks   = []
+      self.over    = None
 
       self.x, self.y = self.__make_coords(coords[0], coords[1])
       self.tag = canvas.create_image(self.x, self.y, image=self.image)
-      canvas.tag_bind(self.tag, '<Button-1>'       , self.select)
-      canvas.tag_bind(self.tag, '<ButtonRelease-1>', self.deselect)
-      canvas.tag_bind(self.tag, '<B1-Motion>'      , self.drag)
+
+   def reuse(self, model, image, coords):
+      self.model = model
+      if image is not self.image:
+         self.image = image
+         self.canvas.itemconfig(self.tag, image=image)
+      self.place(coords[0], coords[1])
+      self.canvas.itemconfig(self.tag, state=tk.NORMAL)
 
    def __make_coords(self, x, y):
       x = MARGIN + self.width  / 2 + (x * self.width)
       y = MARGIN + self.height / 2 + (y * self.height)
       return x, y
 
+   def __hide(self):
+      if self.current:
+         self.current.hide()
+         self.current = None
+      if self.suggest:
+         self.suggest.hide()
+         self.suggest = None
+      for mark in self.marks:
+         mark.hide()
+      self.marks   = []
+      self.targets = set()
+      self.over    = None
+
    def remove(self):
-      if self.tag:
-         if self.current:
-            self.current.hide()
-            self.current = None
-         if self.suggest:
-            self.suggest.hide()
-            self.suggest = None
-         self.canvas.delete(self.tag)
-         self.tag = None
-
-   def move(self, x, y, local=False):
-      self.model.update(x, y)
+      if self.model is not None:
+         self.__hide()
+         self.canvas.itemconfig(self.tag, state=tk.HIDDEN)
+         self.model = None
+         self.gui.free(self)
+
+   def place(self, x, y):
       self.x, self.y = self.__make_coords(x, y)
-      self.model.makeMove((x, y), local=local)
       self.canvas.coords(self.tag, (self.x, self.y))
 
+   def move(self, x, y):
+      self.model.move(x, y)
+
    def select(self, e):
       if self.model.canMove():
+         self.__hide()
          self.current = Highlight(self.x, self.y, self.width, self.height, self.canvas, self)
+         self.targets = self.model.getLegalMoves()
+         for tx, ty in self.targets:
+            x, y = self.__make_coords(tx, ty)
+            self.marks.append(Highlight(x, y, self.width, self.height, self.canvas, self, 'green'))
 
    def deselect(self, e):
+      targets = self.targets
+      self.__hide()
       if self.model.canMove():
-         if self.suggest:
-            self.suggest.hide()
-            self.suggest = None
-         if self.current:
-            self.current.hide()
-            self.current = None
          dx = (e.x - MARGIN) / self.width
          dy = (e.y - MARGIN) / self.height
-         if self.model.checkMove(dx, dy):
+         if (dx, dy) in targets:
             self.move(dx, dy)
          else:
             self.canvas.coords(self.tag, (self.x, self.y))
 
    def drag(self, e):
       if self.model.canMove():
-         if self.suggest:
-            self.suggest.hide()
-            self.suggest = None
          dx = (e.x - MARGIN) / self.width
          dy = (e.y - MARGIN) / self.height
-         if self.model.checkMove(dx, dy):
-            x, y = self.__make_coords(dx, dy)
-            self.suggest = Highlight(x, y, self.width, self.height, self.canvas, self)
+         # only redraw the suggestion when the pointer enters another square
+         if (dx, dy) != self.over:
+            self.over = (dx, dy)
+            if self.suggest:
+               self.suggest.hide()
+               self.suggest = None
+            if (dx, dy) in self.targets:
+               x, y = self.__make_coords(dx, dy)
+               self.suggest = Highlight(x, y, self.width, self.height, self.canvas, self)
          self.canvas.coords(self.tag, (e.x, e.y))
 
 class ChessTkGUI(chess_game.ChessGUI):
@@ -121,9 +164,48 @@ class ChessTkGUI(chess_game.ChessGUI):
       self.frame  = frame
       self.canvas = canvas
       self.clock  = clock
+      # every sprite by canvas item, the hidden ones waiting to be reused
+      # and the one being dragged
+      self.sprites  = {}
+      self.pool     = []
+      self.selected = None
+
+      canvas.bind('<Button-1>'       , self.press)
+      canvas.bind('<ButtonRelease-1>', self.release)
+      canvas.bind('<B1-Motion>'      , self.motion)
 
    def make_sprite(self, model, name, coords):
-      return TkSprite(self, model, getattr(chess_images, name), coords, self.canvas)
+      if self.pool:
+         sprite = self.pool.pop()
+         sprite.reuse(model, getimage(name), coords)
+      else:
+         sprite = TkSprite(self, model, getimage(name), coords, self.canvas)
+         self.sprites[sprite.tag] = sprite
+      return sprite
+
+   def free(self, sprite):
+      if sprite is self.selected:
+         self.selected = None
+      self.pool.append(sprite)
+
+   # the topmost piece under the pointer takes the drag
+   def press(self, e):
+      for item in reversed(self.canvas.find_overlapping(e.x, e.y, e.x, e.y)):
+         sprite = self.sprites.get(item)
+         if sprite is not None and sprite.model is not None:
+            self.selected = sprite
+            sprite.select(e)
+            break
+
+   def motion(self, e):
+      if self.selected is not None:
+         self.selected.drag(e)
+
+   def release(self, e):
+      sprite = self.selected
+      self.selected = None
+      if sprite is not None:
+         sprite.deselect(e)
 
    def timer(self, func):
       self.canvas.after(1000, func)
@@ -231,12 +313,45 @@ class Application(tk.Frame):
    def startLocalGame(self):
       self.status.set('Running')
       self.__toggleButtons()
+      self.computerGame = False
       self.board.sitColor = None
       self.board.start()
+      for color in chess_game.COLORS:
+         self.players[color] = self.getUser()
+
+   def startComputerGame(self, e=None):
+      if self.board.running:
+         return
+      self.status.set('Running')
+      self.__toggleButtons()
+      if self.computer is None:
+         self.computer = chess_engine.ParallelEngine(COMPUTER_WORKERS, underpromotions=False)
+      self.computerGame = True
+      self.board.sitColor = chess_game.WHITE
+      self.board.start()
+      self.players['white'] = self.getUser()
+      self.players['black'] = 'Computer'
+
+   # reply for the computer once the last move has been drawn, the search
+   # runs in other processes so the gui stays live
+   def computerMove(self):
+      board = self.board
+      if self.computerGame and board.running and board.color != board.sitColor:
+         self.status.set('Thinking')
+         d = self.computer.searchDeferred(board, COMPUTER_SECONDS)
+         d.addCallback(self.computerMoved, (board.key, len(board.history)))
+         d.addErrback(lambda failure: failure.printTraceback())
+
+   def computerMoved(self, move, position):
+      board = self.board
+      # the game may have moved on while the workers ran
+      if move is not None and board.running and (board.key, len(board.history)) == position:
+         board.playMove(move)
 
    def startWhite(self):
       self.status.set('Running')
       self.__toggleButtons()
+      self.computerGame = False
       self.board.sitColor = chess_game.WHITE
       self.board.start()
       color = chess_game.COLORS[chess_game.WHITE]
@@ -246,6 +361,7 @@ class Application(tk.Frame):
    def startBlack(self):
       self.status.set('Running')
       self.__toggleButtons()
+      self.computerGame = False
       self.board.sitColor = chess_game.BLACK
       self.board.start()
       color = chess_game.COLORS[chess_game.BLACK]
@@ -268,6 +384,12 @@ class Application(tk.Frame):
       # TODO: ask if we should proceed?
       self.__reset()
 
+   # join a game in progress from the server's snapshot of it
+   def remotePosition(self, fen, seconds):
+      self.__reset(fen)
+      self.board.startTime = time.time() - seconds
+      self.setTurn(chess_game.COLORS[self.board.color])
+
    def createWidgets(self):
       self.localGame = tk.Button(self)
       self.localGame['text'] = 'Local Game'
@@ -299,6 +421,9 @@ class Application(tk.Frame):
       self.board = chess_game.ChessBoard(self.gui)
 
       self.lastRemoteMove = None
+      self.players        = {}
+      self.computer       = None
+      self.computerGame   = False
 
       # grid labels
       x = MARGIN + self.board.piece_width / 2
@@ -368,6 +493,7 @@ class Application(tk.Frame):
       self.subMenu = tk.Menu(self.menuBar)
       self.menuBar.add_cascade(label='File', menu=self.subMenu)
       self.subMenu.add_command(label='New Game', underline=0, command=self.__newGame, accelerator='Ctrl+N')
+      self.subMenu.add_command(label='Play Computer', underline=0, command=self.startComputerGame, accelerator='Ctrl+P')
       self.subMenu.add_command(label='Save Moves', underline=0, command=self.__saveGame, accelerator='Ctrl+S')
       self.subMenu.add_command(label='Quit', command=self.quit, accelerator='Ctrl+X')
 
@@ -376,24 +502,31 @@ class Application(tk.Frame):
       self.netMenu.add_command(label='Connect', underline=0, command=self.__connect, accelerator='Ctrl+C')
       self.netMenu.add_command(label='Start Server', command=self.__startServer, accelerator='Ctrl+R')
       self.netMenu.add_command(label='Change User Name', underline=7, command=self.__changeName, accelerator='Ctrl+U')
+      self.netMenu.add_command(label='Join Game', underline=0, command=self.__joinGame, accelerator='Ctrl+J')
 
       self.subMenu = tk.Menu(self.menuBar)
       self.menuBar.add_cascade(label='Help', menu=self.subMenu)
       self.subMenu.add_command(label='About', command=self.__aboutHandler)
 
       self.bind_all('<Control-n>', self.__newGame)
+      self.bind_all('<Control-p>', self.startComputerGame)
       self.bind_all('<Control-s>', self.__saveGame)
       self.bind_all('<Control-x>', self.exit)
       self.bind_all('<Control-c>', self.__connect)
       self.bind_all('<Control-r>', self.__startServer)
       self.bind_all('<Control-u>', self.__changeName)
+      self.bind_all('<Control-j>', self.__joinGame)
 
    def __aboutHandler(self):
       tkMessageBox.showinfo('pychess-twisted', 'A python chess implementation using the twisted networking framework.')
 
-   def __reset(self):
+   # the standard start or, for a game joined late, the position given
+   def __reset(self, fen=None):
       self.board.stop()
-      self.board.standardBoard()
+      if fen is None:
+         self.board.standardBoard()
+      else:
+         self.board.load_fen(fen)
       self.clock.set('')
       self.lastRemoteMove = None
       if self.moves.size() > 0:
@@ -414,7 +547,13 @@ class Application(tk.Frame):
          fn = tkFileDialog.asksaveasfilename(defaultextension='pgn')
          if fn is not None and len(fn) > 0:
             try:
-               self.board.savepgn(fn, self.moves.get(0, tk.END))
+               tags = {
+                  'Event' : 'pychess-twisted game',
+                  'Site'  : socket.gethostname(),
+                  'White' : self.players.get('white', '?'),
+                  'Black' : self.players.get('black', '?'),
+               }
+               self.board.savepgn(fn, self.moves.get(0, tk.END), tags)
                tkMessageBox.showinfo('Moves Saved', 'Moves saved successfully to: ' + fn)
             except:
                traceback.print_exc()
@@ -449,12 +588,19 @@ class Application(tk.Frame):
          self.user.set('User: ' + newuser)
          self.net.changeName(newuser)
 
+   # an empty name goes back to the server's shared game
+   def __joinGame(self, e=None):
+      room = tkSimpleDialog.askstring('Join Game', 'Game name:')
+      if room is not None:
+         self.net.join(room)
+
    def addMove(self, move):
       self.moves.insert(tk.END, move[1])
       self.moves.see(tk.END)
       self.sendMove(move[0])
 
    def showSit(self, name, color):
+      self.players[color] = name
       self.addChatLine('*** %s sat %s' % (name, color))
 
    def showCheck(self, color):
@@ -511,6 +657,8 @@ class Application(tk.Frame):
 
    def setTurn(self, color):
       self.status.set(color + ' turn')
+      if self.computerGame and self.board.color != self.board.sitColor:
+         reactor.callLater(0.1, self.computerMove)
 
    def quit(self):
       #print 'Quit'
@@ -522,6 +670,8 @@ class Application(tk.Frame):
       reactor.callWhenRunning(reactor.stop)
       self.board.stop()
       self.net.stop()
+      if self.computer is not None:
+         self.computer.close()
       if destroy:
          self.master.destroy()
 
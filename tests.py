@@ -1,11 +1,24 @@
 #!/usr/bin/env trial
 
-from twisted.internet import reactor, defer
+import StringIO
+import os
+import struct
+import time
+
+from twisted.internet import reactor, defer, task
 from twisted.trial    import unittest
 from twisted.test     import proto_helpers
 
+import chess_analysis
+import chess_bitboard
+import chess_bot
+import chess_engine
 import chess_game
+import chess_perft
+import chess_pgn
 import chess_server
+import chess_tablebase
+import chess_vector
 
 class TestFrame:
    def __init__(self, name):
@@ -37,6 +50,9 @@ class TestFrame:
    def remoteNewGame(self):
       self.move = None
 
+   def remotePosition(self, fen, seconds):
+      self.move = fen
+
    def handleMove(self, move):
       self.move = move
 
@@ -79,6 +95,30 @@ class ChessServerTestCase(unittest.TestCase):
       reactor.callLater(1, d.callback, None)
       return d
 
+   def test_reconnect(self):
+      factory = self.client.client
+      factory.initialDelay = factory.delay = 0.1
+      self.client.sit('black')
+      d = defer.Deferred()
+      d.addCallback(self._drop)
+      reactor.callLater(0.5, d.callback, None)
+      return d
+
+   def _drop(self, unused):
+      factory = self.client.client
+      old     = list(factory.clients)
+      self.server_frame.seats.clear()
+      old[0].transport.loseConnection()
+      # back with the seat it held
+      d = defer.Deferred()
+      d.addCallback(lambda x: (
+         self.assertEqual(len(factory.clients), 1),
+         self.assertNotIn(old[0], factory.clients),
+         self.assertEqual(self.server_frame.seats, {'name2': 'black'})
+      ))
+      reactor.callLater(1.5, d.callback, None)
+      return d
+
    def test_changename(self):
       d = defer.Deferred()
       d.addCallback(self._check_name_0)
@@ -151,6 +191,349 @@ class ChessServerTestCase(unittest.TestCase):
       reactor.callLater(1, d.callback, None)
       return d
 
+class ChessRoomTestCase(unittest.TestCase):
+   def setUp(self):
+      self.factory = chess_server.ChessServerFactory()
+
+   def _connect(self, name):
+      client = self.factory.buildProtocol(None)
+      client.makeConnection(proto_helpers.StringTransport())
+      client.lineReceived('NAME' + name)
+      return client
+
+   def _lines(self, client):
+      lines = client.transport.value().splitlines()
+      client.transport.clear()
+      return lines
+
+   def test_rooms(self):
+      a = self._connect('a')
+      b = self._connect('b')
+      c = self._connect('c')
+      self.assertEqual(self._lines(c), ['NAME' + 'a', 'NAME' + 'b'])
+      self._lines(a)
+      self._lines(b)
+
+      a.lineReceived('JOIN' + 'g1')
+      self.assertEqual(self._lines(a), ['RNAME' + 'b', 'RNAME' + 'c', 'NEWGAME'])
+      self.assertEqual(self._lines(b), ['RNAME' + 'a'])
+      b.lineReceived('JOIN' + 'g1')
+      self.assertEqual(self._lines(b), ['RNAME' + 'c', 'NEWGAME', 'NAME' + 'a'])
+      self.assertEqual(self._lines(a), ['NAME' + 'b'])
+      self._lines(c)
+
+      # moves only reach the room
+      a.lineReceived('SIT' + 'a:white')
+      a.lineReceived('MOVE' + 'E2E4')
+      self.assertEqual(self._lines(b), ['SIT' + 'a:white', 'MOVE' + 'E2E4'])
+      self.assertEqual(self._lines(c), [])
+      room = self.factory.rooms['g1']
+      self.assertEqual(room.moves, ['E2E4'])
+      self.assertEqual(room.spectators(), set([b]))
+      self.assertEqual(self.factory.rooms[chess_server.DEFAULT_ROOM].moves, [])
+
+      # a late spectator gets the game so far
+      c.lineReceived('JOIN' + 'g1')
+      self.assertEqual(self._lines(c), ['NEWGAME', 'NAME' + 'a', 'NAME' + 'b', 'SIT' + 'a:white', 'MOVE' + 'E2E4'])
+      self.assertEqual(self._lines(a), ['NAME' + 'c'])
+
+      a.lineReceived('LEAVE')
+      self.assertEqual(self._lines(a), ['RNAME' + 'b', 'RNAME' + 'c', 'NEWGAME'])
+      b.connectionLost(None)
+      c.lineReceived('LEAVE')
+      self.assertNotIn('g1', self.factory.rooms)
+      self.assertEqual(self.factory.rooms[chess_server.DEFAULT_ROOM].names, ['a', 'c'])
+
+   def test_catch_up(self):
+      a = self._connect('a')
+      b = self._connect('b')
+      a.lineReceived('SIT' + 'a:white')
+      b.lineReceived('SIT' + 'b:black')
+      shuffle = ['G1F3', 'G8F6', 'F3G1', 'F6G8'] * 5
+      for client, move in zip([a, b] * 10, shuffle):
+         client.lineReceived('MOVE' + move)
+      room = self.factory.rooms[chess_server.DEFAULT_ROOM]
+      self.assertEqual(len(room.moves), 20)
+
+      # a late joiner gets a snapshot and only the moves after it
+      c = self.factory.buildProtocol(None)
+      c.makeConnection(proto_helpers.StringTransport())
+      c.lineReceived('NAME' + 'c')
+      lines = self._lines(c)
+      self.assertEqual(lines[:4], ['NAME' + 'a', 'NAME' + 'b', 'SIT' + 'a:white', 'SIT' + 'b:black'])
+      self.assertEqual(lines[4:], ['POSITION' + '20:0:F6G8:' + room.board.to_fen()])
+      a.lineReceived('MOVE' + 'E2E4')
+      self.assertEqual(self._lines(c), ['MOVE' + 'E2E4'])
+
+      # resuming from a move index gets the missing moves only
+      d = self.factory.buildProtocol(None)
+      d.makeConnection(proto_helpers.StringTransport())
+      d.lineReceived('RESUME' + '18:G8F6:')
+      self.assertEqual(self._lines(d)[5:], ['MOVE' + 'F3G1', 'MOVE' + 'F6G8', 'MOVE' + 'E2E4'])
+      d.lineReceived('RESUME' + '21:E2E4:')
+      self.assertEqual(self._lines(d), ['ERROR' + 'Already caught up'])
+
+      # a history that does not match starts over
+      e = self.factory.buildProtocol(None)
+      e.makeConnection(proto_helpers.StringTransport())
+      e.lineReceived('RESUME' + '18:E2E4:')
+      lines = self._lines(e)
+      self.assertEqual(lines[5:7], ['NEWGAME', 'POSITION' + '20:0:F6G8:' + room.snapshot[1]])
+      self.assertEqual(lines[7:], ['MOVE' + 'E2E4'])
+
+      # a move made before the first command is only sent once
+      f = self.factory.buildProtocol(None)
+      f.makeConnection(proto_helpers.StringTransport())
+      b.lineReceived('MOVE' + 'E7E5')
+      self.assertEqual(f.transport.value(), '')
+      f.lineReceived('NAME' + 'f')
+      self.assertEqual(self._lines(f)[6:], ['MOVE' + 'E2E4', 'MOVE' + 'E7E5'])
+
+   def test_backpressure(self):
+      a = self._connect('a')
+      b = self._connect('b')
+      c = self._connect('c')
+      for client in [a, b, c]:
+         self._lines(client)
+      self.assertIdentical(b.transport.producer, b)
+
+      # the broadcast is encoded once for every member
+      written = []
+      b.write = c.write = written.append
+      a.lineReceived('CHAT' + 'hello')
+      self.assertEqual(written, ['CHAT' + 'hello\r\n'] * 2)
+      self.assertIdentical(written[0], written[1])
+      del b.write, c.write
+
+      # a paused client gets what it missed at once
+      b.pauseProducing()
+      a.lineReceived('CHAT' + 'one')
+      a.lineReceived('CHAT' + 'two')
+      self.assertEqual(self._lines(b), [])
+      self.assertEqual(self._lines(c), ['CHAT' + 'one', 'CHAT' + 'two'])
+      # and still has its own commands read
+      b.dataReceived('CHAT' + 'three\r\n')
+      self.assertEqual(self._lines(c), ['CHAT' + 'three'])
+      b.resumeProducing()
+      self.assertEqual(self._lines(b), ['CHAT' + 'one', 'CHAT' + 'two'])
+
+      # and is dropped once it holds back too much
+      b.pauseProducing()
+      text = 'x' * 1024
+      for i in range(chess_server.BUFFER_LIMIT / len(text) + 1):
+         a.lineReceived('CHAT' + text)
+      self.assertTrue(b.transport.disconnecting)
+      self.assertFalse(c.transport.disconnecting)
+      self.assertIdentical(b.pending, None)
+
+   def test_resume_room(self):
+      a = self._connect('a')
+      a.lineReceived('JOIN' + 'g:1')
+      a.lineReceived('SIT' + 'a:white')
+      a.lineReceived('MOVE' + 'E2E4')
+      self._lines(a)
+
+      # a client remembers its room and game across connections
+      frame   = TestFrame('b')
+      factory = chess_server.ChessClientFactory(frame, False)
+      client  = factory.buildProtocol(None)
+      client.makeConnection(proto_helpers.StringTransport())
+      client.join('g:1')
+      client.lineReceived('MOVE' + 'E2E4')
+      client.connectionLost(None)
+      client = factory.buildProtocol(None)
+      client.makeConnection(proto_helpers.StringTransport())
+      self.assertEqual(self._lines(client), ['RESUME' + '1:E2E4:g:1', 'NAME' + 'b'])
+
+      b = self.factory.buildProtocol(None)
+      b.makeConnection(proto_helpers.StringTransport())
+      b.lineReceived('RESUME' + '1:E2E4:g:1')
+      b.lineReceived('NAME' + 'b')
+      self.assertEqual(self._lines(b), ['NAME' + 'a', 'SIT' + 'a:white'])
+      self.assertEqual(self._lines(a), ['NAME' + 'b'])
+      self.assertIdentical(b.room, self.factory.rooms['g:1'])
+      a.lineReceived('CHAT' + 'hi')
+      self.assertEqual(self._lines(b), ['CHAT' + 'hi'])
+
+   def test_hijack(self):
+      a = self._connect('a')
+      b = self._connect('b')
+      a.lineReceived('SIT' + 'a:white')
+      for client in [a, b]:
+         self._lines(client)
+
+      # the seat stays with the connection that took it
+      b.lineReceived('NAME' + 'a')
+      b.lineReceived('CNAME' + 'a:c')
+      b.lineReceived('CNAME' + 'b:a')
+      b.lineReceived('RNAME' + 'x')
+      self.assertEqual(self._lines(b), ['ERROR' + 'Already named: b', 'ERROR' + 'Cannot rename a', 'ERROR' + 'Name taken: a', 'ERROR' + 'Cannot remove x'])
+      b.lineReceived('MOVE' + 'E2E4')
+      b.lineReceived('NEWGAME')
+      self.assertEqual(self._lines(b), ['ERROR' + 'Not your move: E2E4', 'ERROR' + 'Not seated'])
+      self.assertEqual(self._lines(a), [])
+      room = self.factory.rooms[chess_server.DEFAULT_ROOM]
+      self.assertEqual(room.seats, {a: 'white'})
+
+      # a renamed player keeps its seat
+      a.lineReceived('CNAME' + 'a:c')
+      a.lineReceived('MOVE' + 'E2E4')
+      self.assertEqual(self._lines(b), ['CNAME' + 'a:c', 'MOVE' + 'E2E4'])
+      self.assertEqual(room.names, ['b', 'c'])
+
+   def test_validation(self):
+      a = self._connect('a')
+      b = self._connect('b')
+      c = self._connect('c')
+      for client in [a, b, c]:
+         self._lines(client)
+
+      a.lineReceived('SIT' + 'a:white')
+      self._lines(b)
+      b.lineReceived('SIT' + 'b:white')
+      self.assertEqual(self._lines(b), ['ERROR' + 'Seat taken: white'])
+      b.lineReceived('SIT' + 'a:black')
+      self.assertEqual(self._lines(b), ['ERROR' + 'Cannot seat a'])
+      b.lineReceived('SIT' + 'b:black')
+      self.assertEqual(self._lines(c), ['SIT' + 'a:white', 'SIT' + 'b:black'])
+      self._lines(a)
+
+      b.lineReceived('MOVE' + 'E7E5')
+      self.assertEqual(self._lines(b), ['ERROR' + 'Not your move: E7E5'])
+      a.lineReceived('MOVE' + 'E2E5')
+      a.lineReceived('MOVE' + 'Z2E4')
+      self.assertEqual(self._lines(a), ['ERROR' + 'Illegal move: E2E5', 'ERROR' + 'Invalid move: Z2E4'])
+      self.assertEqual(self._lines(c), [])
+
+      for client, move in [(a, 'F2F3'), (b, 'E7E5'), (a, 'G2G4'), (b, 'D8H4')]:
+         client.lineReceived('MOVE' + move)
+      self.assertEqual(self._lines(c), ['MOVE' + move for move in ['F2F3', 'E7E5', 'G2G4', 'D8H4']])
+      self._lines(a)
+      a.lineReceived('MOVE' + 'E2E4')
+      self.assertEqual(self._lines(a), ['ERROR' + 'Game over: E2E4'])
+
+      # an unseated client may play a side nobody sits at
+      a.lineReceived('NEWGAME')
+      b.connectionLost(None)
+      self._lines(c)
+      c.lineReceived('MOVE' + 'E2E4')
+      self.assertEqual(self._lines(c), ['ERROR' + 'Not your move: E2E4'])
+      a.lineReceived('MOVE' + 'E2E4')
+      c.lineReceived('MOVE' + 'E7E5')
+      self.assertEqual(self.factory.rooms[chess_server.DEFAULT_ROOM].moves, ['E2E4', 'E7E5'])
+
+   def test_binary(self):
+      a = self._connect('a:1')
+      b = self.factory.buildProtocol(None)
+      b.makeConnection(proto_helpers.StringTransport())
+      b.dataReceived('BINARY\r\n' + struct.pack('!IB', 2, 1) + 'b')
+      self.assertEqual(self._lines(a), ['NAME' + 'b'])
+      self.assertEqual(b.transport.value(), 'BINARY\r\n' + struct.pack('!IB', 4, 1) + 'a:1')
+      b.transport.clear()
+
+      # colons in names survive both framings
+      a.lineReceived('CNAME' + 'a:1:a:2')
+      a.lineReceived('SIT' + 'a:2:white')
+      self.assertEqual(self.factory.rooms[chess_server.DEFAULT_ROOM].seats, {a: 'white'})
+      self.assertEqual(a.name, 'a:2')
+      b.dataReceived(struct.pack('!IB', 5, 5) + 'E2E4' + struct.pack('!IB', 1, 99))
+      self.assertEqual(self._lines(a), [])
+      self.assertEqual(b.transport.value()[:26], struct.pack('!IB', 8, 2) + 'a:1\0a:2' + struct.pack('!IB', 10, 4) + 'a:2\0white')
+
+      frame  = TestFrame('c')
+      client = chess_server.ChessClient(None, frame)
+      client.users = ['a:1']
+      frame.users  = ['a:1']
+      client.sendFrames()
+      client.readFrames()
+      client.dataReceived(b.transport.value())
+      self.assertEqual(frame.users, ['a:2'])
+      self.assertEqual(frame.seats, {'a:2': 'white'})
+      self.assertEqual(frame.chats, ['*** server: Not your move: E2E4', "*** server: Unknown command: 'c'"])
+
+class ChessAnalysisTestCase(unittest.TestCase):
+   def test_analyse(self):
+      positions = [
+         '6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1',
+         ['e4', 'e5', 'Qh5', 'Nc6', 'Bc4', 'Nf6'],
+         ('k7/8/8/3q4/8/8/3R4/K7 w - - 0 1', []),
+         'not a fen',
+         [chess_game.packmove(52, 36), 'Ke7'],
+      ]
+      results = list(chess_analysis.analyse(positions, depth=2, workers=2))
+      self.assertEqual([a.index for a in results], range(5))
+      self.assertEqual([a.san for a in results[:3]], ['Ra8#', 'Qxf7#', 'Rxd5'])
+      self.assertEqual(results[1].fen, 'r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 4 4')
+      self.assertTrue(results[0].score > chess_engine.MATE - chess_engine.MAX_PLY)
+      self.assertIsNotNone(results[3].error)
+      self.assertIsNotNone(results[4].error)
+
+      results = list(chess_analysis.analyse(positions * 10, depth=1, workers=2, ordered=False))
+      self.assertEqual(sorted(a.index for a in results), range(50))
+
+      # the input is read a window ahead of the results
+      read = []
+      def endless():
+         while True:
+            read.append(None)
+            yield positions[0]
+      results = chess_analysis.analyse(endless(), depth=1, workers=2)
+      for i in xrange(5):
+         results.next()
+      self.assertEqual(len(read), 2 * chess_analysis.WINDOW + 5)
+      results.close()
+
+      self.assertRaises(TypeError, chess_analysis.analyse(positions).next)
+
+      # a job that fails outside the search is raised, not waited on
+      results = chess_analysis.analyse(positions + [lambda: None], depth=1, workers=2, ordered=False)
+      self.assertRaises(Exception, list, results)
+
+   def test_game_positions(self):
+      game = chess_pgn.readpgn(StringIO.StringIO(PGN)).next()
+      positions = list(chess_analysis.gamepositions(game))
+      self.assertEqual(len(positions), 5)
+      self.assertEqual(positions[0], chess_game.STANDARD_FEN)
+      self.assertEqual(positions[-1], 'rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/PPPPP2P/RNBQKBNR w kq - 1 3')
+      results = list(chess_analysis.analyse(positions, depth=1, workers=1))
+      self.assertEqual(results[3].san, 'Qh4#')
+      self.assertIsNone(results[4].best)
+
+      # a move that does not decode is handed on for the error
+      positions = list(chess_analysis.gamepositions(chess_pgn.PGNGame({}, ['f3', 'Nf6', 'Ke3'], '*')))
+      self.assertEqual(len(positions), 4)
+      self.assertEqual(positions[-1], (positions[-2], ['Ke3']))
+      results = list(chess_analysis.analyse(positions, depth=1, workers=1))
+      self.assertIsNotNone(results[-1].error)
+
+class ChessBotTestCase(unittest.TestCase):
+   def setUp(self):
+      self.server_frame = TestFrame('name1')
+      self.server       = chess_server.ChessNetwork(self.server_frame)
+      self.server.serve(3333)
+
+      connected = defer.Deferred()
+      self.bot = chess_bot.ChessBot('bot', chess_game.BLACK, 0.2, workers=2)
+      self.bot.net.connect('localhost', 3333, False, connected=connected, binary=True)
+      connected.addCallback(self.bot.connected)
+      return connected
+
+   def tearDown(self):
+      self.bot.stop()
+      return self.server.stop()
+
+   def test_reply(self):
+      self.server.sendMove('E2E4')
+      d = defer.Deferred()
+      d.addCallback(lambda x: (
+         self.assertEqual(self.server_frame.seats['bot'], 'black'),
+         self.assertEqual(len(self.bot.board.history), 2),
+         self.assertEqual(self.bot.board.color, chess_game.WHITE),
+         self.assertEqual(self.server_frame.move, chess_game.movename(self.bot.board.history[1][0]).upper())
+      ))
+      reactor.callLater(2, d.callback, None)
+      return d
+
 class FakePiece:
    def __init__(self, abbreviation):
       self.abbreviation = abbreviation
@@ -167,3 +550,624 @@ class ChessGameTestCase(unittest.TestCase):
       self.assertEqual(sy, 6)
       self.assertEqual(dx, 0)
       self.assertEqual(dy, 5)
+
+   def test_headless(self):
+      board = chess_game.ChessBoard()
+      self.assertEqual(board.piece_width, chess_game.PIECE_SIZE)
+      for piece in board.board:
+         if piece is not None:
+            self.assertIsNone(piece.sprite)
+
+      board.start()
+      board.handleMove('E2E4')
+      self.assertEqual(board[(4, 4)].abbreviation, '')
+      self.assertIsNone(board[(4, 6)])
+      self.assertEqual(board.color, chess_game.BLACK)
+
+      board.standardBoard()
+      self.assertEqual(len([p for p in board.board if p is not None]), 32)
+
+   def _check_position(self, board):
+      pieces = [[0] * 6, [0] * 6]
+      for sq in xrange(64):
+         piece = board.board[sq]
+         if piece is not None:
+            pieces[piece.color][piece.kind] |= chess_bitboard.BIT[sq]
+      position = board.position
+      self.assertEqual(position.pieces, pieces)
+      self.assertEqual(position.occupied, [sum(bits) for bits in pieces])
+      self.assertEqual(position.all, position.occupied[0] | position.occupied[1])
+
+   def test_bitboards(self):
+      board = chess_game.ChessBoard()
+      self._check_position(board)
+      self.assertEqual(chess_bitboard.popcount(board.position.all), 32)
+      self.assertEqual(board.position.king(chess_game.WHITE), board.pos(4, 7))
+
+      board.start()
+      for move in ['E2E4', 'D7D5', 'E4D5', 'D8D5', 'B1C3']:
+         board.handleMove(move)
+         self._check_position(board)
+      self.assertEqual(chess_bitboard.popcount(board.position.all), 30)
+
+   def test_make_unmake(self):
+      board = chess_game.ChessBoard()
+      board.start()
+      for move in ['E2E4', 'G8F6', 'E4E5', 'B8C6', 'G1F3', 'B7B6', 'F1C4', 'D7D5']:
+         board.handleMove(move)
+      before = [(p, p and p.coords, p and p.firstMove) for p in board.board]
+      key    = (board.color, board.epSquare, board.position.all)
+
+      # en passant capture
+      sq = board.pos(4, 3)
+      board.make_move(chess_game.packmove(sq, board.pos(3, 2)))
+      self.assertIsNone(board[(3, 3)])
+      self.assertEqual(board.color, chess_game.BLACK)
+      board.unmake_move()
+      self.assertEqual([(p, p and p.coords, p and p.firstMove) for p in board.board], before)
+      self.assertEqual((board.color, board.epSquare, board.position.all), key)
+      self.assertTrue(board[(3, 3)].enPassant)
+
+      # castle
+      board.make_move(chess_game.packmove(board.pos(4, 7), board.pos(6, 7)))
+      self.assertEqual(board[(5, 7)].abbreviation, 'R')
+      self.assertEqual(board[(6, 7)].abbreviation, 'K')
+      self.assertFalse(board[(3, 3)].enPassant)
+      board.unmake_move()
+      self.assertEqual([(p, p and p.coords, p and p.firstMove) for p in board.board], before)
+      self._check_position(board)
+
+   def test_promotion(self):
+      board = chess_game.ChessBoard()
+      board.start()
+      for move in ['H2H4', 'G7G5', 'H4G5', 'G8F6', 'G5G6', 'F6E4', 'G6G7', 'E4C3', 'G7H8']:
+         board.handleMove(move)
+      self.assertEqual(board[(7, 0)].abbreviation, 'Q')
+      self.assertEqual(board[(7, 0)].color, chess_game.WHITE)
+      self._check_position(board)
+
+   def test_mate(self):
+      board = chess_game.ChessBoard()
+      board.start()
+      for move in ['F2F3', 'E7E5', 'G2G4', 'D8H4']:
+         board.handleMove(move)
+      self.assertFalse(board.running)
+      self.assertEqual(board.checkColor, chess_game.WHITE)
+
+   def test_attacks(self):
+      self.assertEqual(chess_bitboard.popcount(chess_bitboard.KNIGHT_ATTACKS[0]), 2)
+      self.assertEqual(chess_bitboard.popcount(chess_bitboard.KNIGHT_ATTACKS[27]), 8)
+      self.assertEqual(chess_bitboard.popcount(chess_bitboard.KING_ATTACKS[63]), 3)
+      self.assertEqual(chess_bitboard.popcount(chess_bitboard.rook_attacks(0, 0)), 14)
+      self.assertEqual(chess_bitboard.popcount(chess_bitboard.bishop_attacks(27, 0)), 13)
+
+      board = chess_game.ChessBoard()
+      self.assertTrue(board.attacked(4, 5, chess_game.WHITE))
+      self.assertTrue(board.attacked(5, 5, chess_game.WHITE))
+      self.assertFalse(board.attacked(4, 4, chess_game.WHITE))
+      self.assertTrue(board.attacked(0, 2, chess_game.BLACK))
+      self.assertFalse(board.attacked(0, 3, chess_game.BLACK))
+      self.assertFalse(board.inCheck(chess_game.WHITE))
+
+   def test_castle_through_check(self):
+      board = chess_game.ChessBoard()
+      board.start()
+      for move in ['E2E4', 'E7E5', 'G1F3', 'B8C6', 'F1C4', 'F8C5', 'F3E5', 'C6E5', 'D2D4', 'D8H4', 'F2F3', 'H4F2']:
+         board.handleMove(move)
+      king = board[(4, 7)]
+      self.assertTrue(board.inCheck(chess_game.WHITE))
+      self.assertFalse(king.checkMove(6, 7))
+      self.assertFalse(king.checkMove(5, 7))
+
+   def test_get_legal_moves(self):
+      for name, fen, expected in chess_perft.POSITIONS:
+         board = chess_game.ChessBoard.from_fen(fen)
+         for piece in list(board.board):
+            if piece is None or piece.color != board.color:
+               continue
+            targets = set((x, y) for x in xrange(8) for y in xrange(8) if piece.checkMove(x, y))
+            self.assertEqual(piece.getLegalMoves(), targets, '%s %s' % (name, piece.name))
+
+   def test_legal_moves(self):
+      board = chess_game.ChessBoard()
+      self.assertEqual(len(board.legal_moves()), 20)
+      self.assertEqual(len(board.legal_moves(chess_game.BLACK)), 20)
+
+      board.start()
+      for move in ['E2E4', 'F7F6', 'D2D4', 'G7G5', 'D1H5']:
+         board.handleMove(move)
+      self.assertFalse(board.running)
+      self.assertEqual(board.legal_moves(), [])
+
+   def test_legal_moves_captures(self):
+      for name, fen, expected in chess_perft.POSITIONS:
+         board = chess_game.ChessBoard.from_fen(fen)
+         for move in board.legal_moves() + [None]:
+            if move is not None:
+               board.make_move(move)
+            captures = [m for m in board.legal_moves() if m >> 12 or board.board[(m >> 6) & 63] is not None or
+                        (board.board[m & 63].kind == chess_game.PAWN and (m >> 6) & 63 == board.epSquare)]
+            self.assertEqual(sorted(board.legal_moves(captures=True)), sorted(captures))
+            if move is not None:
+               board.unmake_move()
+
+   def test_legal_moves_pins(self):
+      board = chess_game.ChessBoard()
+      board.start()
+      for move in ['E2E4', 'E7E5', 'G1F3', 'D7D6', 'F1B5', 'B8C6', 'E1G1']:
+         board.handleMove(move)
+      # the c6 knight is pinned to the king
+      moves = [chess_game.unpackmove(m)[:2] for m in board.legal_moves()]
+      self.assertNotIn(board.pos(2, 2), [frm for frm, to in moves])
+      self.assertIn((board.pos(2, 0), board.pos(3, 1)), moves)
+      for frm, to in moves:
+         board.make_move(chess_game.packmove(frm, to))
+         self.assertFalse(board.inCheck(chess_game.BLACK))
+         board.unmake_move()
+
+   def test_perft(self):
+      for name, fen, expected in chess_perft.POSITIONS:
+         board = chess_game.ChessBoard.from_fen(fen)
+         self.assertEqual(chess_perft.perft(board, 2), expected[1])
+         self.assertEqual(chess_perft.perft(board, 2, chess_perft.generator(board, True)), expected[1])
+         counts = chess_perft.divide(fen, 2)
+         self.assertEqual(sum(count for move, count in counts), expected[1])
+         self.assertEqual(board.to_fen(), fen)
+
+   def test_fen(self):
+      board = chess_game.ChessBoard()
+      self.assertEqual(board.to_fen(), chess_game.STANDARD_FEN)
+      board.start()
+      for move in ['E2E4', 'C7C5', 'G1F3']:
+         board.handleMove(move)
+      self.assertEqual(board.to_fen(), 'rnbqkbnr/pp1ppppp/8/2p5/4P3/5N2/PPPP1PPP/RNBQKB1R b KQkq - 1 2')
+
+      fen   = 'rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3'
+      board = chess_game.ChessBoard.from_fen(fen)
+      self.assertEqual(board.to_fen(), fen)
+      self.assertEqual(board.color, chess_game.WHITE)
+      self.assertTrue(board[(5, 3)].enPassant)
+      self.assertEqual(len(board.legal_moves()), 31)
+
+      # same position reached by moves hashes the same
+      played = chess_game.ChessBoard()
+      played.start()
+      for move in ['E2E4', 'D7D5', 'E4E5', 'F7F5']:
+         played.handleMove(move)
+      self.assertEqual(played.to_fen(), fen)
+      self.assertEqual(played.key, board.key)
+
+      board.load_fen('4k3/8/8/8/8/8/8/4K2R b K - 12 40')
+      self.assertEqual(board.color, chess_game.BLACK)
+      self.assertEqual(board.castling(), chess_game.CASTLE_WHITE_KING)
+      self.assertEqual((board.halfmove, board.fullmove), (12, 40))
+      self.assertRaises(TypeError, board.load_fen, '8/8/8/8/8/8/8/8 w - - 0 1')
+      self.assertRaises(TypeError, board.load_fen, 'rnbqkbnr/ppppxppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1')
+      self.assertRaises(TypeError, board.load_fen, 'rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e1 0 1')
+      self.assertRaises(TypeError, board.load_fen, 'rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e6 0 1')
+      self.assertRaises(TypeError, board.load_fen, 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNP w KQkq - 0 1')
+      self.assertRaises(TypeError, board.load_fen, 'p3k3/8/8/8/8/8/8/4K3 w - - 0 1')
+
+   def test_zobrist(self):
+      board = chess_game.ChessBoard()
+      start = board.key
+      self.assertNotEqual(start, 0)
+
+      board.start()
+      for move in ['G1F3', 'G8F6', 'F3G1', 'F6G8']:
+         board.handleMove(move)
+      self.assertEqual(board.key, start)
+
+      # same placement, different side to move
+      board.handleMove('B1C3')
+      key = board.key
+      for move in ['B8C6', 'C3B1', 'C6B8', 'B1C3']:
+         board.handleMove(move)
+      self.assertEqual(board.key, key)
+
+      # moving the rook out and back loses castling rights
+      for move in ['H7H6', 'H1G1', 'H6H5', 'G1H1']:
+         board.handleMove(move)
+      self.assertNotEqual(board.position.key ^ board.key, chess_bitboard.ZOBRIST_CASTLE[15])
+
+      keys = set()
+      for move in board.legal_moves():
+         board.make_move(move)
+         keys.add(board.key)
+         child = board.key
+         board.rehash()
+         self.assertEqual(board.key, child)
+         key = 0
+         for sq, piece in enumerate(board.board):
+            if piece is not None:
+               key ^= chess_bitboard.ZOBRIST_PIECES[piece.color][piece.kind][sq]
+         self.assertEqual(board.position.key, key)
+         board.unmake_move()
+      self.assertEqual(len(keys), len(board.legal_moves()))
+
+   def test_san(self):
+      for name, fen, expected in chess_perft.POSITIONS:
+         board = chess_game.ChessBoard.from_fen(fen)
+         moves = board.legal_moves()
+         labels = [chess_game.encodesan(board, move, moves) for move in moves]
+         self.assertEqual(len(set(labels)), len(moves))
+         for move, label in zip(moves, labels):
+            self.assertEqual(chess_game.decodesan(board, label, moves), move)
+
+      board = chess_game.ChessBoard.from_fen('8/7k/8/8/Q1Q5/8/Q7/1N1N3K w - - 0 1')
+      labels = set(chess_game.encodesan(board, move) for move in board.legal_moves())
+      for label in ['Qa4b3', 'Qcb3', 'Q2b3', 'Nbc3', 'Ndc3', 'Qa7+', 'Qce2']:
+         self.assertIn(label, labels)
+      self.assertRaises(TypeError, chess_game.decodesan, board, 'Qb3')
+      self.assertRaises(TypeError, chess_game.decodesan, board, 'Nc4')
+
+      board = chess_game.ChessBoard.from_fen('7k/P5pp/8/8/8/8/8/R3K2R w KQ - 0 1')
+      self.assertEqual(chess_game.encodesan(board, chess_game.decodesan(board, 'a8=Q')), 'a8=Q#')
+      self.assertEqual(chess_game.encodesan(board, chess_game.decodesan(board, 'O-O-O')), 'O-O-O')
+      self.assertEqual(chess_game.encodesan(board, chess_game.decodesan(board, 'Rd1')), 'Rd1')
+
+   def test_move_labels(self):
+      moves = []
+      class RecordingGUI(chess_game.ChessGUI):
+         def add_move(self, move):
+            moves.append(move)
+      board = chess_game.ChessBoard(RecordingGUI())
+      board.start()
+      for move in ['E2E4', 'D7D5', 'E4D5', 'G8F6', 'F1B5', 'C7C6', 'D5C6', 'D8D7', 'C6B7', 'D7B5', 'B7A8']:
+         board.handleMove(move)
+      self.assertEqual([san for simple, san in moves],
+         ['e4', 'd5', 'exd5', 'Nf6', 'Bb5+', 'c6', 'dxc6', 'Qd7', 'cxb7', 'Qxb5', 'bxa8=Q'])
+      self.assertEqual(moves[0][0], 'E2E4')
+
+PGN = '''[Event "Test \\"one\\""]
+[Site "Here"]
+[Result "1-0"]
+
+1. f3 e5 2. g4?? {a multi
+line comment} 2... Qh4# ; mate
+0-1
+
+[Event "Two"]
+[SetUp "1"]
+[FEN "7k/P5pp/8/8/8/8/8/R3K2R w KQ - 0 1"]
+
+1. O-O-O (1. a8=Q#) 1... h6 $1 2. a8=Q+ Kh7 *
+% escaped line
+[Event "Three"]
+
+1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 1/2-1/2
+'''
+
+class ChessPGNTestCase(unittest.TestCase):
+   def test_read(self):
+      games = list(chess_pgn.readpgn(StringIO.StringIO(PGN)))
+      self.assertEqual(len(games), 3)
+
+      self.assertEqual(games[0].tags['Event'], 'Test "one"')
+      self.assertEqual(games[0].sans, ['f3', 'e5', 'g4', 'Qh4#'])
+      self.assertEqual(games[0].result, '0-1')
+
+      self.assertEqual(games[1].sans, ['O-O-O', 'h6', 'a8=Q+', 'Kh7'])
+      self.assertEqual(games[1].result, '*')
+      moves = games[1].moves()
+      self.assertEqual(chess_game.movename(moves[2]), 'a7a8q')
+      for board, move in games[1].replay():
+         pass
+      self.assertEqual(board.to_fen(), 'Q7/6pk/7p/8/8/8/8/2KR3R w - - 1 3')
+
+      self.assertEqual(games[2].tags, {'Event': 'Three'})
+      self.assertEqual(len(games[2].moves()), 6)
+      self.assertEqual(games[2].result, '1/2-1/2')
+
+   def test_read_lazy(self):
+      games = chess_pgn.readpgn(StringIO.StringIO('1. e4 e5 2. Ke3 *\n1. d4 *\n'))
+      game = games.next()
+      self.assertEqual(game.sans, ['e4', 'e5', 'Ke3'])
+      self.assertRaises(TypeError, game.moves)
+      self.assertEqual(len(games.next().moves()), 1)
+      self.assertRaises(StopIteration, games.next)
+
+      games = chess_pgn.readpgn(StringIO.StringIO('1. e4 e5 2. Ke3 *\n'), lazy=False)
+      self.assertRaises(TypeError, games.next)
+
+   def test_write(self):
+      game = chess_pgn.PGNGame({'Event': 'Test "one"', 'White': 'A', 'Annotator': 'B'},
+                               ['e4', 'e5', 'Nf3'], '*')
+      self.assertEqual(chess_pgn.formatpgn(game),
+         '[Event "Test \\"one\\""]\n[Site "?"]\n[Date "????.??.??"]\n[Round "?"]\n'
+         '[White "A"]\n[Black "?"]\n[Result "*"]\n[Annotator "B"]\n\n'
+         '1. e4 e5 2. Nf3 *\n\n')
+
+      game = chess_pgn.PGNGame({'FEN': '7k/P5pp/8/8/8/8/8/R3K2R b KQ - 0 12'}, ['h6', 'a8=Q+'], '*')
+      self.assertTrue('\n12... h6 13. a8=Q+ *\n' in chess_pgn.formatpgn(game))
+
+      game = chess_pgn.PGNGame({}, ['Nf3', 'Nf6', 'Ng1', 'Ng8'] * 20, '1/2-1/2')
+      for line in chess_pgn.formatpgn(game).splitlines():
+         self.assertTrue(len(line) <= chess_pgn.LINE_LENGTH)
+
+   def test_write_read(self):
+      games = list(chess_pgn.readpgn(StringIO.StringIO(PGN)))
+      f = StringIO.StringIO()
+      writer = chess_pgn.PGNWriter(f, buffersize=100)
+      for game in games * 10:
+         writer.write(game)
+      writer.flush()
+      self.assertEqual(writer.count, 30)
+      copies = list(chess_pgn.readpgn(StringIO.StringIO(f.getvalue())))
+      self.assertEqual(len(copies), 30)
+      for game, copy in zip(games * 10, copies):
+         self.assertEqual(copy.sans, game.sans)
+         self.assertEqual(copy.result, game.result)
+         self.assertEqual(copy.tags['Event'], game.tags['Event'])
+         self.assertEqual(copy.tags['Result'], game.result)
+
+   def test_board_pgn(self):
+      board = chess_game.ChessBoard()
+      board.standardBoard()
+      sans = []
+      for san in ['f3', 'e5', 'g4', 'Qh4#']:
+         sans.append(san)
+         board.make_move(chess_game.decodesan(board, san))
+      board.finish(chess_game.STATE_MATE)
+      game = board.pgn(sans, {'White': 'A', 'Black': 'B'})
+      self.assertEqual(game.result, '0-1')
+      text = chess_pgn.formatpgn(game)
+      self.assertTrue('[White "A"]' in text)
+      self.assertTrue(text.endswith('1. f3 e5 2. g4 Qh4# 0-1\n\n'))
+
+class ChessEngineTestCase(unittest.TestCase):
+   def test_evaluate(self):
+      board = chess_game.ChessBoard()
+      self.assertEqual(chess_engine.evaluate(board), 0)
+      board.load_fen('4k3/8/8/8/8/8/8/Q3K3 w - - 0 1')
+      score = chess_engine.evaluate(board)
+      self.assertTrue(score > 800)
+      board.load_fen('4k3/8/8/8/8/8/8/Q3K3 b - - 0 1')
+      self.assertEqual(chess_engine.evaluate(board), -score)
+
+   def test_tactics(self):
+      engine = chess_engine.Engine()
+      for fen, best in [
+            ('6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1', 'a1a8'),
+            ('k7/8/8/3q4/8/8/3R4/K7 w - - 0 1', 'd2d5'),
+            ('4k3/8/8/8/8/8/6p1/4K2R b K - 0 1', 'g2h1q'),
+         ]:
+         board = chess_game.ChessBoard.from_fen(fen)
+         move  = engine.search(board, depth=3)
+         self.assertEqual(chess_game.movename(move), best)
+         self.assertEqual(board.to_fen(), fen)
+
+      board = chess_game.ChessBoard.from_fen('8/8/8/8/8/1k6/7q/K7 b - - 0 1')
+      board.make_move(engine.search(board, depth=3))
+      self.assertTrue(engine.score > chess_engine.MATE - chess_engine.MAX_PLY)
+      self.assertTrue(board.inCheck(chess_game.WHITE))
+      self.assertEqual(board.legal_moves(), [])
+
+      engine = chess_engine.Engine(underpromotions=False)
+      board  = chess_game.ChessBoard.from_fen('8/1P3k2/8/8/8/8/8/K7 w - - 0 1')
+      move   = engine.search(board, depth=1)
+      self.assertEqual(chess_game.movename(move), 'b7b8q')
+
+   def test_no_moves(self):
+      engine = chess_engine.Engine()
+      board  = chess_game.ChessBoard.from_fen('k7/2Q5/1K6/8/8/8/8/8 b - - 0 1')
+      self.assertIsNone(engine.search(board, depth=3))
+
+   def test_deadline(self):
+      engine = chess_engine.Engine()
+      board  = chess_game.ChessBoard.from_fen(chess_perft.POSITIONS[1][1])
+      start  = time.time()
+      move   = engine.search(board, 0.5)
+      self.assertTrue(time.time() - start < 2)
+      self.assertTrue(move in board.legal_moves())
+      self.assertEqual(board.to_fen(), chess_perft.POSITIONS[1][1])
+      self.assertEqual(len(board.history), 0)
+
+      # even the first iteration stops at the deadline
+      start = time.time()
+      move  = engine.search(board, 0, depth=6)
+      self.assertTrue(time.time() - start < 0.5)
+      self.assertTrue(move in board.legal_moves())
+      self.assertEqual(engine.depth, 0)
+      self.assertEqual(len(board.history), 0)
+
+   def test_table(self):
+      table = chess_engine.TranspositionTable(1)
+      self.assertTrue(table.size * table.ENTRY_BYTES <= 1 << 20)
+      size = table.size
+      key  = 0x123456789abcdef0
+      self.assertIsNone(table.probe(key))
+      table.store(key, 5, chess_engine.LOWER, -250, 0x1234)
+      self.assertEqual(table.probe(key), (5, chess_engine.LOWER, -250, 0x1234))
+
+      # same bucket: shallower entries go to the always replace slot
+      other = key ^ (1 << 40)
+      table.store(other, 3, chess_engine.EXACT, 10, 1)
+      self.assertEqual(table.probe(key)[0], 5)
+      self.assertEqual(table.probe(other)[0], 3)
+      third = key ^ (2 << 40)
+      table.store(third, 2, chess_engine.UPPER, 20, 2)
+      self.assertEqual(table.probe(key)[0], 5)
+      self.assertIsNone(table.probe(other))
+      self.assertEqual(table.probe(third)[0], 2)
+
+      # deeper entries and entries from a new search take the first slot
+      table.store(other, 6, chess_engine.EXACT, 10, 1)
+      self.assertIsNone(table.probe(key))
+      table.newSearch()
+      table.store(key, 1, chess_engine.EXACT, 0, 3)
+      self.assertEqual(table.probe(key)[0], 1)
+
+      for i in xrange(10000):
+         table.store(i * 0x9e3779b97f4a7c15 & chess_bitboard.ALL_SQUARES, i % 20, chess_engine.EXACT, i, i & 4095)
+      self.assertEqual(len(table.infos), size)
+      table.clear()
+      self.assertIsNone(table.probe(key))
+
+   def test_table_search(self):
+      table  = chess_engine.TranspositionTable(1)
+      engine = chess_engine.Engine(table=table)
+      board  = chess_game.ChessBoard.from_fen(chess_perft.POSITIONS[1][1])
+      move   = engine.search(board, depth=3)
+      nodes  = engine.nodes
+      self.assertEqual(engine.search(board, depth=3), move)
+      self.assertTrue(engine.nodes < nodes)
+      self.assertEqual(chess_engine.Engine(table=table).search(board, depth=3), move)
+
+   def test_parallel(self):
+      engine = chess_engine.ParallelEngine(2)
+      try:
+         for fen, best in [
+               ('6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1', 'a1a8'),
+               ('k7/8/8/3q4/8/8/3R4/K7 w - - 0 1', 'd2d5'),
+            ]:
+            board = chess_game.ChessBoard.from_fen(fen)
+            self.assertEqual(chess_game.movename(engine.search(board, depth=3)), best)
+
+         # the workers replay the game, so they see the repetition
+         board = chess_game.ChessBoard()
+         for san in ['Nf3', 'Nf6', 'Ng1', 'Ng8', 'Nf3', 'Nf6', 'Ng1']:
+            board.make_move(chess_game.decodesan(board, san))
+         played = [undo[0] for undo in board.history]
+         roots  = [chess_game.decodesan(board, 'Ng8')]
+         chess_engine.initworker(1, True)
+         self.assertEqual(chess_engine.searchroots((board.startFen, played, [], roots, None, 2))[:3], (roots[0], 0, 2))
+
+         # nor may a king that has been in check castle there
+         worker = RecordingWorker()
+         setattr(chess_engine, '__worker', worker)
+         fen = '4k3/8/8/8/8/8/8/4K2R w K - 0 1'
+         chess_engine.searchroots((fen, [], [], [], None, 1))
+         self.assertEqual(worker.castling, chess_game.CASTLE_WHITE_KING)
+         chess_engine.searchroots((fen, [], [chess_game.WHITE], [], None, 1))
+         self.assertEqual(worker.castling, 0)
+         self.assertIsNone(engine.search(chess_game.ChessBoard.from_fen('k7/2Q5/1K6/8/8/8/8/8 b - - 0 1'), depth=2))
+      finally:
+         engine.close()
+
+   def test_parallel_few_moves(self):
+      # more workers than root moves, each still searches to full depth
+      engine = chess_engine.ParallelEngine(4)
+      try:
+         board = chess_game.ChessBoard.from_fen('k7/8/8/8/8/8/8/K7 w - - 0 1')
+         self.assertEqual(len(board.legal_moves()), 3)
+         engine.search(board, depth=3)
+         self.assertEqual(engine.depth, 3)
+         # a forced move is not searched any further
+         board = chess_game.ChessBoard.from_fen('k7/8/8/8/8/8/1q6/K7 w - - 0 1')
+         self.assertEqual(chess_game.movename(engine.search(board, depth=3)), 'a1b2')
+         self.assertEqual(engine.depth, 1)
+      finally:
+         engine.close()
+
+   def test_parallel_deferred(self):
+      engine = chess_engine.ParallelEngine(2)
+      board  = chess_game.ChessBoard.from_fen(chess_perft.POSITIONS[1][1])
+      d = engine.searchDeferred(board, 0.3)
+      # the reactor is free while the workers search
+      ticks = []
+      call  = task.LoopingCall(ticks.append, None)
+      call.start(0.05)
+      def check(move):
+         call.stop()
+         self.assertTrue(move in board.legal_moves())
+         self.assertTrue(len(ticks) > 2)
+      d.addCallback(check)
+      d.addBoth(lambda result: (engine.close(), result)[1])
+      return d
+
+# stands in for the engine of a worker, noting the board it was handed
+class RecordingWorker:
+   score = depth = nodes = 0
+
+   def search(self, board, seconds, depth, moves):
+      self.castling = board.castling()
+      return None
+
+class ChessVectorTestCase(unittest.TestCase):
+   if chess_vector.numpy is None:
+      skip = 'numpy is not installed'
+
+   def _boards(self):
+      boards = [chess_game.ChessBoard.from_fen(fen) for name, fen, expected in chess_perft.POSITIONS]
+      board  = chess_game.ChessBoard()
+      for san in ['e4', 'c5', 'e5', 'd5']:
+         board.make_move(chess_game.decodesan(board, san))
+      boards.append(board)
+      boards.append(chess_game.ChessBoard.from_fen('4k3/8/8/8/8/8/8/R3K3 b Q - 12 40'))
+      return boards
+
+   def test_convert(self):
+      boards = self._boards()
+      fens   = [board.to_fen() for board in boards]
+      batch  = chess_vector.BoardBatch.from_boards(boards)
+      self.assertEqual(len(batch), len(boards))
+      self.assertEqual([batch.fen(i) for i in xrange(len(batch))], fens)
+      self.assertEqual([board.to_fen() for board in batch.boards()], fens)
+      self.assertEqual(batch.squares[0][4], -(chess_game.KING + 1))
+      self.assertEqual(batch.squares[0][60], chess_game.KING + 1)
+      self.assertEqual(batch.ep[-2], 19)
+
+      other = chess_vector.BoardBatch.from_fens(fens)
+      for name in ['squares', 'color', 'castling', 'ep', 'halfmove', 'fullmove']:
+         self.assertTrue((getattr(other, name) == getattr(batch, name)).all())
+
+      planes = batch.planes()
+      self.assertEqual(planes.shape, (len(boards), 12, 64))
+      self.assertEqual(planes[0].sum(), 32)
+      self.assertTrue(planes[0][chess_game.PAWN][48:56].all())
+      self.assertTrue(planes[0][6 + chess_game.PAWN][8:16].all())
+
+      self.assertRaises(TypeError, chess_vector.BoardBatch.from_fens, ['8/8/8 w - - 0 1'])
+      self.assertRaises(TypeError, chess_vector.BoardBatch.from_fens, ['8/8/8/8/8/8/8/7x w - - 0 1'])
+
+   def test_evaluate(self):
+      boards = self._boards()
+      batch  = chess_vector.BoardBatch.from_boards(boards)
+      self.assertEqual(list(batch.evaluate()), [chess_engine.evaluate(board) for board in boards])
+
+class ChessTablebaseTestCase(unittest.TestCase):
+   # building a table takes a while, every test shares this one
+   tables = {}
+
+   def _tablebase(self):
+      if 'KQK' not in self.tables:
+         chess_tablebase.generate('KQK', self.tables)
+      directory = self.mktemp()
+      os.mkdir(directory)
+      chess_tablebase.save(chess_tablebase.tablepath(directory, 'KQK'), 'KQK', self.tables['KQK'])
+      tablebase = chess_tablebase.Tablebase(directory)
+      self.addCleanup(tablebase.close)
+      return tablebase
+
+   def test_signature(self):
+      self.assertEqual(chess_tablebase.pieces('KBNK'), [chess_game.BISHOP, chess_game.KNIGHT])
+      self.assertEqual(chess_tablebase.signature([chess_game.KNIGHT, chess_game.BISHOP]), 'KBNK')
+      self.assertRaises(TypeError, chess_tablebase.pieces, 'KQKR')
+
+   def test_probe(self):
+      tablebase = self._tablebase()
+      # the longest queen mate takes ten moves
+      self.assertEqual(max(self.tables['KQK']), 19)
+
+      def probe(fen):
+         return tablebase.probe(chess_game.ChessBoard.from_fen(fen))
+
+      self.assertEqual(probe('8/8/8/8/8/1k6/7q/K7 b - - 0 1'), 1)
+      self.assertEqual(probe('8/8/8/8/8/1k6/7q/K7 w - - 0 1'), -3)
+      self.assertEqual(probe('k7/2Q5/1K6/8/8/8/8/8 b - - 0 1'), 0)
+      self.assertEqual(probe('k7/1Q6/1K6/8/8/8/8/8 b - - 0 1'), -1)
+      self.assertEqual(probe('8/8/8/8/8/1k6/7r/K7 b - - 0 1'), None)
+
+      self.assertEqual(tablebase.adjudicate(chess_game.ChessBoard.from_fen('8/8/8/8/8/1k6/7q/K7 w - - 0 1')), '0-1')
+      self.assertEqual(tablebase.adjudicate(chess_game.ChessBoard.from_fen('k7/2Q5/1K6/8/8/8/8/8 b - - 0 1')), '1/2-1/2')
+      self.assertEqual(tablebase.adjudicate(chess_game.ChessBoard()), None)
+
+   def test_engine(self):
+      engine = chess_engine.Engine(tablebase=self._tablebase())
+      board  = chess_game.ChessBoard.from_fen('8/8/8/3k4/8/8/8/Q3K3 w - - 0 1')
+      value  = engine.tablebase.probe(board)
+      move   = engine.search(board, depth=2)
+      self.assertEqual(engine.score, chess_engine.MATE - value)
+      board.make_move(move)
+      self.assertEqual(engine.tablebase.probe(board), -value)